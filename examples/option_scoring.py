@@ -5,7 +5,7 @@
 This example demonstrates how to score multiple considered options using the PaaS Sandbox. Prior to running the example start the server in a terminal window with the command:
     python -m prog_server
 
-This example creates a session with the server to run prognostics for a BatteryCircuit. Three options with different loading profiles are compared by creating a session for each option and comparing the resulting prediction metrics
+This example creates a session with the server to run prognostics for a BatteryCircuit. Three options with different loading profiles are compared by creating a session for each option and comparing the resulting prediction metrics. Finally, the same options are compared in a single request using the scenarios endpoint of one session
 """
 
 import prog_client
@@ -93,6 +93,15 @@ def run_example():
             best_plan = i
     print(f'Best option using method 2: Option {best_plan}')
 
+    # Step 6: Compare options from a single session
+    # Each option is run from the session's current state estimate, in parallel, and ranked by ToE
+    print('\nScoring options using one session')
+    scenarios = [{'name': f'Option {i}', 'type': 'Variable', 'cfg': LOAD_PROFILES[i]} for i in range(len(LOAD_PROFILES))]
+    result = sessions[0].score_scenarios(scenarios, event='EOD')
+    for scenario in result['scenarios']:
+        print(f"\t{scenario['name']}: {scenario['time_of_event']['EOD']['mean']:0.2f}s")
+    print(f"Best option using method 3: {result['scenarios'][result['ranking'][0]]['name']}")
+
     # Other metrics can be used as well, like probability of mission success given a certain mission time, uncertainty in ToE estimate, final state at end of mission, etc. 
 
 # This allows the module to be executed directly
@@ -2,13 +2,39 @@
 # National Aeronautics and Space Administration.  All Rights Reserved.
 
 import requests, json
+import gzip
+import io
+import numpy as np
 import urllib3
 import pickle
+import time
+from urllib.parse import urlencode
 from progpy.uncertain_data import UncertainData
 from progpy.utils import containers
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# Minimum size (bytes) of request bodies that are compressed, if the server accepts compressed requests
+COMPRESS_MIN_SIZE = 1024
+
+def _accepted_encodings(result):
+    # Encodings the server accepts for request bodies (from the Accept-Encoding response header)
+    return [encoding.strip() for encoding in result.headers.get('Accept-Encoding', '').split(',') if encoding.strip()]
+
+def _post_form(url, data, encodings):
+    # POST form data, gzip compressed if large and accepted by the server
+    body = urlencode(data, doseq=True).encode()
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    if len(body) >= COMPRESS_MIN_SIZE and 'gzip' in encodings:
+        body = gzip.compress(body)
+        headers['Content-Encoding'] = 'gzip'
+    return requests.post(url, data=body, headers=headers)
+
+def _load_pickle(result):
+    # Load a pickled response, decoding any content encoding (e.g., gzip) negotiated by requests
+    result.raw.decode_content = True
+    return pickle.load(result.raw)
+
 
 class Session:
     """
@@ -26,6 +52,12 @@ class Session:
         state_est_cfg (dict, optional): Configuration for state estimator.
         pred (str, optional): Prediction algorithm to use (e.g., MonteCarlo). Class name for prediction algorithm in `progpy.predictors`
         pred_cfg (dict, optional): Configuration for prediction algorithm.
+        pred_deadline (float, optional): Wall-clock time limit for each prediction in seconds. Predictions exceeding it are cancelled. MonteCarlo predictions are run in 10 chunks of samples, and return the chunks completed by the deadline, marked truncated. Predictions with no completed chunk (and those of other predictors) are cancelled without a result, keeping the previous result (reported in get_prediction_status exceptions).
+        cancel_superseded (bool, optional): If in-progress predictions are cancelled when new data or state supersedes them. Defaults to False.
+        async_ingest (bool, optional): If data sent is queued for state estimation, so send_data returns without waiting for estimation. See get_data_status. Defaults to False.
+        async_create (bool, optional): If the session is built by the server in the background, so creation returns without waiting for it. See wait_until_ready. Defaults to False.
+        tags (dict, optional): Tags (key: value) used to look up the session (e.g., {'site': 'ames', 'asset': '12'})
+        history_size (int, optional): Number of prediction summaries kept in the prediction history. Defaults to 100
 
     Use:
         session = prog_client.Session(**config)
@@ -43,13 +75,161 @@ class Session:
         # Start session
         result = requests.put(self.host + '/session', data={'model': model, **kwargs})
 
-        # If error code throw Exception
-        if result.status_code != 201:
+        # If error code throw Exception. 202 if created asynchronously (async_create)
+        if result.status_code not in (201, 202):
             raise Exception(result.text)
         
         # Load information
         self.session_id = json.loads(result.text)['session_id']
         self.host += "/session/" + str(self.session_id)
+        self._request_encodings = _accepted_encodings(result)
+
+    @classmethod
+    def _from_id(cls, session_id, host='127.0.0.1', port=8555, encodings=()):
+        # Create a client Session for an existing server session
+        session = cls.__new__(cls)
+        session.session_id = session_id
+        session.host = 'http://' + host + ':' + str(port) + Session._base_url + "/session/" + str(session_id)
+        session._request_encodings = encodings
+        return session
+
+    @classmethod
+    def create_many(cls, model, overrides=None, n=None, host='127.0.0.1', port=8555, **kwargs):
+        """
+        Create multiple sessions sharing one configuration in a single request. The sessions are built in parallel by the server.
+
+        Args:
+            model (str): The model to use for the sessions (e.g., batt)
+            overrides (list[dict], optional): Per-session overrides (e.g., {'x0': {...}}). One session is created for each
+            n (int, optional): Number of sessions to create without overrides
+            host (str, optional): Host address for PaaS Service. Defaults to '127.0.0.1'
+            port (int, optional): Port for PaaS Service. Defaults to 8555.
+            ... Other session configuration as keywords (see Session)
+
+        Returns:
+            list[Session]: Created sessions
+
+        Raises:
+            Exception: If any session could not be created. No sessions are created in that case
+
+        Example:
+            sessions = prog_client.Session.create_many('BatteryCircuit', n=100)
+        """
+        for key, value in kwargs.items():
+            if isinstance(value, dict) or isinstance(value, list):
+                kwargs[key] = json.dumps(value)
+        if overrides is not None:
+            kwargs['sessions'] = json.dumps(overrides)
+        if n is not None:
+            kwargs['n'] = n
+
+        url = 'http://' + host + ':' + str(port) + Session._base_url + '/session/bulk'
+        result = requests.put(url, data={'model': model, **kwargs})
+
+        # If error code throw Exception
+        if result.status_code != 201:
+            raise Exception(result.text)
+
+        encodings = _accepted_encodings(result)
+        return [cls._from_id(session['session_id'], host, port, encodings) for session in json.loads(result.text)['sessions']]
+
+    @staticmethod
+    def delete_many(sessions, host='127.0.0.1', port=8555):
+        """
+        End multiple sessions in a single request.
+
+        Args:
+            sessions (list[Session or int]): Sessions (or session IDs) to end
+            host (str, optional): Host address for PaaS Service. Defaults to '127.0.0.1'
+            port (int, optional): Port for PaaS Service. Defaults to 8555.
+        """
+        ids = [session.session_id if isinstance(session, Session) else session for session in sessions]
+        url = 'http://' + host + ':' + str(port) + Session._base_url + '/session/bulk'
+        result = requests.delete(url, data={'ids': json.dumps(ids)})
+
+        # If error code throw Exception
+        if result.status_code != 200:
+            raise Exception(result.text)
+
+    @staticmethod
+    def _filter_params(model=None, pred=None, tags=None):
+        params = {}
+        if model is not None:
+            params['model'] = model
+        if pred is not None:
+            params['pred'] = pred
+        if tags is not None:
+            params['tag'] = [f'{key}:{value}' for key, value in tags.items()]
+        return params
+
+    @staticmethod
+    def list_sessions(model=None, pred=None, tags=None, page=None, page_size=100, host='127.0.0.1', port=8555):
+        """
+        Get the IDs of sessions, optionally filtered by model, predictor, or tags.
+
+        Args:
+            model (str, optional): Only include sessions using this model
+            pred (str, optional): Only include sessions using this predictor
+            tags (dict, optional): Only include sessions with these tags
+            page (int, optional): Page number, starting at 0. Defaults to all sessions
+            page_size (int, optional): Number of sessions per page. Defaults to 100
+            host (str, optional): Host address for PaaS Service. Defaults to '127.0.0.1'
+            port (int, optional): Port for PaaS Service. Defaults to 8555.
+
+        Returns:
+            list[int]: Session IDs
+
+        Example:
+            ids = prog_client.Session.list_sessions(tags={'site': 'ames'})
+        """
+        params = Session._filter_params(model, pred, tags)
+        if page is not None:
+            params.update({'page': page, 'page_size': page_size})
+
+        url = 'http://' + host + ':' + str(port) + Session._base_url + '/session'
+        result = requests.get(url, params=params)
+
+        # If error code throw Exception
+        if result.status_code != 200:
+            raise Exception(result.text)
+
+        return json.loads(result.text)['sessions']
+
+    @staticmethod
+    def get_fleet_summary(ids=None, model=None, pred=None, tags=None, sort='id', event=None, page=0, page_size=100, host='127.0.0.1', port=8555):
+        """
+        Get the summary of many sessions in one request, including ToE metrics, current event state, and prediction freshness.
+
+        Args:
+            ids (list[int], optional): Session IDs to include. Defaults to all sessions
+            model (str, optional): Only include sessions using this model
+            pred (str, optional): Only include sessions using this predictor
+            tags (dict, optional): Only include sessions with these tags
+            sort (str, optional): 'id' or 'toe'. Defaults to 'id'
+            event (str, optional): Event used for sorting by ToE. Defaults to first event of each model
+            page (int, optional): Page number, starting at 0
+            page_size (int, optional): Number of sessions per page. Defaults to 100
+            host (str, optional): Host address for PaaS Service. Defaults to '127.0.0.1'
+            port (int, optional): Port for PaaS Service. Defaults to 8555.
+
+        Returns:
+            dict: Summaries ('sessions') and total number of matching sessions ('total')
+        """
+        params = Session._filter_params(model, pred, tags)
+        params.update({'sort': sort, 'page': page, 'page_size': page_size})
+        if ids is not None:
+            params['ids'] = ','.join(str(session_id) for session_id in ids)
+        if event is not None:
+            params['event'] = event
+
+        url = 'http://' + host + ':' + str(port) + Session._base_url + '/fleet/summary'
+        result = requests.get(url, params=params)
+
+        # If error code throw Exception
+        if result.status_code != 200:
+            raise Exception(result.text)
+
+        return json.loads(result.text)
 
     def __str__(self):
         return f'PaaS Session {self.session_id}'
@@ -63,6 +243,36 @@ class Session:
         result = requests.get(self.host + '/initialized')
         return json.loads(result.text)['initialized']
 
+    def wait_until_ready(self, timeout=60, poll_interval=0.1):
+        """Wait until a session created with async_create has been built by the server
+
+        Args:
+            timeout (float, optional): Maximum time to wait (s). Defaults to 60
+            poll_interval (float, optional): Time (s) between checks. Defaults to 0.1
+
+        Returns:
+            bool: If the session has been initialized (see is_init)
+
+        Raises:
+            Exception: If the session could not be built. The failure is reported once, after which the session does not exist
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            result = requests.get(self.host + '/initialized')
+
+            # If error code throw Exception
+            if result.status_code != 200:
+                raise Exception(result.text)
+
+            status = json.loads(result.text)
+            if status['status'] == 'ready':
+                return status['initialized']
+            if status['status'] == 'failed':
+                raise Exception(f"Session creation failed: {status['error']}")
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'Session {self.session_id} not ready after {timeout}s')
+            time.sleep(poll_interval)
+
     def send_data(self, time, **kwargs):
         """Send data to service
 
@@ -73,12 +283,115 @@ class Session:
         Example:
             session.send_data(10.2, t=32.0, v=3.914, i=2)
         """
-        result = requests.post(self.host + '/data', data={'time': time, **kwargs})
+        result = _post_form(self.host + '/data', {'time': time, **kwargs}, self._request_encodings)
+
+        # If error code throw Exception. 202 if queued (async_ingest)
+        if result.status_code not in (202, 204):
+            raise Exception(result.text)
+
+    def get_data_status(self):
+        """Get how far state estimation lags behind the data sent (e.g., for sessions with async_ingest)
+
+        Returns:
+            dict: Number of data points received, estimated, dropped (after an error estimating queued data), and pending, times of the latest data point received and estimated, lag (difference in those times), and the last error estimating queued data
+        """
+        result = requests.get(self.host + '/data/status')
 
         # If error code throw Exception
-        if result.status_code != 204:
+        if result.status_code != 200:
+            raise Exception(result.text)
+
+        return json.loads(result.text)
+
+    def backfill(self, data, format=None, wait=True, progress=None, poll_interval=0.5):
+        """Backfill the session from historical data, instead of calling send_data for each data point. The server runs state estimation through the data without making predictions, then makes one prediction
+
+        Args:
+            data (str, bytes, or dict): Path of a csv, npz, or npy file, file contents, or dict of columns (time, and each input and output of the model)
+            format (str, optional): csv, npz, or npy. Defaults to the file extension, or csv (npz for dict data)
+            wait (bool, optional): If the call blocks until the backfill is done. Defaults to True
+            progress (Callable, optional): Function called with the backfill status (see get_backfill_status) each time it is checked while waiting
+            poll_interval (float, optional): Time (s) between status checks while waiting. Defaults to 0.5
+
+        Returns:
+            dict: Backfill status (see get_backfill_status)
+
+        Example:
+            session.backfill('history.csv', progress=lambda status: print(f"{status['processed']}/{status['total']}"))
+        """
+        if isinstance(data, dict):
+            buffer = io.BytesIO()
+            np.savez(buffer, **{key: np.asarray(value, dtype=float) for key, value in data.items()})
+            data = buffer.getvalue()
+            format = format or 'npz'
+        elif isinstance(data, str):
+            format = format or data.rsplit('.', 1)[-1].lower()
+            with open(data, 'rb') as f:
+                data = f.read()
+        format = format or 'csv'
+
+        headers = {'Content-Type': 'application/octet-stream'}
+        if len(data) >= COMPRESS_MIN_SIZE and 'gzip' in self._request_encodings:
+            data = gzip.compress(data)
+            headers['Content-Encoding'] = 'gzip'
+        result = requests.post(self.host + '/backfill', params={'format': format}, data=data, headers=headers)
+
+        # If error code throw Exception
+        if result.status_code != 202:
+            raise Exception(result.text)
+
+        status = json.loads(result.text)
+        while wait and status['status'] in ('queued', 'running'):
+            if progress is not None:
+                progress(status)
+            time.sleep(poll_interval)
+            status = self.get_backfill_status()
+        if status['status'] == 'failed':
+            raise Exception(f"Backfill failed: {status['error']}")
+        return status
+
+    def get_backfill_status(self):
+        """Get the progress of the latest backfill
+
+        Returns:
+            dict: Backfill status: status (queued, running, complete, failed, or cancelled), processed (number of data points), total, time (of latest data point processed), duration (s), and error (if failed)
+        """
+        result = requests.get(self.host + '/backfill')
+
+        # If error code throw Exception
+        if result.status_code != 200:
+            raise Exception(result.text)
+
+        return json.loads(result.text)
+
+    def set_tags(self, **tags):
+        """
+        Update session tags. Tags set to None are removed.
+
+        Example:
+            session.set_tags(site='ames', asset='12')
+        """
+        result = requests.post(self.host + '/tags', data={'tags': json.dumps(tags)})
+
+        # If error code throw Exception
+        if result.status_code != 200:
             raise Exception(result.text)
 
+    def get_tags(self):
+        """
+        Get session tags
+
+        Returns:
+            dict: Session tags
+        """
+        result = requests.get(self.host + '/tags')
+
+        # If error code throw Exception
+        if result.status_code != 200:
+            raise Exception(result.text)
+
+        return json.loads(result.text)['tags']
+
     def send_loading(self, type: str, cfg: dict):
         """
         Set the future loading profile profile. 
@@ -93,6 +406,32 @@ class Session:
         if result.status_code != 204:
             raise Exception(result.text)
 
+    def score_scenarios(self, scenarios, event=None):
+        """
+        Predict from the current state for each of several loading scenarios and rank them by time of event. This does not change the session's prediction.
+
+        Args:
+            scenarios (list[dict]): Scenarios, each a dict with the 'type' and 'cfg' of a loading profile (see send_loading), and an optional 'name'
+            event (str, optional): Event used for ranking. Defaults to the first event of the model
+
+        Returns:
+            dict: Time of event metrics for each scenario ('scenarios') and scenario indices ranked from latest to earliest mean time of event ('ranking')
+
+        Example:
+            result = session.score_scenarios([
+                {'name': 'plan A', 'type': 'Variable', 'cfg': {0: {'i': 2}, 600: {'i': 1}}},
+                {'name': 'plan B', 'type': 'Const', 'cfg': {'load': {'i': 3}}}])
+            best = result['scenarios'][result['ranking'][0]]
+        """
+        params = {} if event is None else {'event': event}
+        result = requests.post(self.host + '/scenarios', data={'scenarios': json.dumps(scenarios)}, params=params)
+
+        # If error code throw Exception
+        if result.status_code != 200:
+            raise Exception(result.text)
+
+        return json.loads(result.text)
+
     def set_state(self, x):
         """
         Set the model state.
@@ -132,7 +471,7 @@ class Session:
         if result.status_code != 200:
             raise Exception(result.text)
 
-        result = pickle.load(result.raw)
+        result = _load_pickle(result)
         return (result['time'], result['state'])
 
     def get_output(self):
@@ -149,7 +488,7 @@ class Session:
         if result.status_code != 200:
             raise Exception(result.text)
 
-        result = pickle.load(result.raw)
+        result = _load_pickle(result)
         return (result['time'], result['output'])
 
     def get_predicted_state(self):
@@ -166,9 +505,102 @@ class Session:
         if result.status_code != 200:
             raise Exception(result.text)
 
-        result = pickle.load(result.raw)
+        result = _load_pickle(result)
         return (result['prediction_time'], result['states'])
 
+    def _iter_prediction(self, query, return_format):
+        # Request a streamed prediction, returning the prediction time and a generator of (time, value) that reads the rest of the stream lazily
+        result = requests.get(self.host + '/prediction/' + query, params={'return_format': return_format, 'stream': 'true'}, stream=True)
+
+        # If error code throw Exception
+        if result.status_code != 200:
+            raise Exception(result.text)
+
+        if return_format == 'uncertain_data':
+            # Consecutive pickles
+            prediction_time = _load_pickle(result)['prediction_time']
+            def entries():
+                with result:
+                    while True:
+                        try:
+                            entry = _load_pickle(result)
+                        except EOFError:
+                            return
+                        yield (entry['time'], entry['state'])
+        else:
+            # NDJSON
+            lines = result.iter_lines()
+            prediction_time = json.loads(next(lines))['prediction_time']
+            def entries():
+                with result:
+                    for line in lines:
+                        if line:
+                            entry = json.loads(line)
+                            yield (entry['time'], entry['state'])
+        return (prediction_time, entries())
+
+    def iter_predicted_state(self, return_format='uncertain_data'):
+        """Get the predicted model state, streamed one save point at a time. Unlike get_predicted_state, the full prediction is never held in memory by the client or server
+
+        Args:
+            return_format (str, optional): One of 'uncertain_data' (samples at each time), 'mean', 'metrics', or 'multivariate_norm'. Defaults to 'uncertain_data'
+
+        Returns:
+            tuple: \\
+                | float: Time of prediction
+                | Iterator[tuple[float, Any]]: (time, predicted state) at each save point, read as it is iterated
+        """
+        return self._iter_prediction('state', return_format)
+
+    def iter_predicted_output(self, return_format='uncertain_data'):
+        """Get the predicted outputs, streamed one save point at a time. Unlike get_predicted_output, the full prediction is never held in memory by the client or server
+
+        Args:
+            return_format (str, optional): One of 'uncertain_data' (samples at each time), 'mean', 'metrics', or 'multivariate_norm'. Defaults to 'uncertain_data'
+
+        Returns:
+            tuple: \\
+                | float: Time of prediction
+                | Iterator[tuple[float, Any]]: (time, predicted output) at each save point, read as it is iterated
+        """
+        return self._iter_prediction('output', return_format)
+
+    def iter_predicted_event_state(self, return_format='uncertain_data'):
+        """Get the predicted event states, streamed one save point at a time. Unlike get_predicted_event_state, the full prediction is never held in memory by the client or server
+
+        Args:
+            return_format (str, optional): One of 'uncertain_data' (samples at each time), 'mean', 'metrics', or 'multivariate_norm'. Defaults to 'uncertain_data'
+
+        Returns:
+            tuple: \\
+                | float: Time of prediction
+                | Iterator[tuple[float, Any]]: (time, predicted event state) at each save point, read as it is iterated
+        """
+        return self._iter_prediction('event_state', return_format)
+
+    def get_predicted_arrays(self, query='state'):
+        """Get the predicted states, outputs, or event states as arrays. Transfer and decoding is much faster than get_predicted_state (etc.) for large predictions. Only supported for sample-based predictors (e.g., MonteCarlo)
+
+        Args:
+            query (str, optional): One of 'state', 'output', or 'event_state'. Defaults to 'state'
+
+        Returns:
+            dict: Arrays: \\
+                | prediction_time: Time of prediction
+                | times: Save times, shape (times,)
+                | keys: Keys (e.g., state names), shape (keys,)
+                | lengths: Number of save times reached by each sample, shape (samples,)
+                | values: Values, shape (samples, times, keys). NaN where the sample had ended
+        """
+        result = requests.get(self.host + '/prediction/' + query, params={'return_format': 'npz'})
+
+        # If error code throw Exception
+        if result.status_code != 200:
+            raise Exception(result.text)
+
+        with np.load(io.BytesIO(result.content)) as arrays:
+            return {key: arrays[key] for key in arrays.files}
+
     def get_event_state(self):
         """Get the current event state
 
@@ -183,7 +615,7 @@ class Session:
         if result.status_code != 200:
             raise Exception(result.text)
 
-        result = pickle.load(result.raw)
+        result = _load_pickle(result)
         return (result['time'], result['event_state'])
 
     def get_predicted_output(self):
@@ -200,7 +632,7 @@ class Session:
         if result.status_code != 200:
             raise Exception(result.text)
 
-        result = pickle.load(result.raw)
+        result = _load_pickle(result)
         return (result['prediction_time'], result['outputs'])
 
     def get_predicted_event_state(self):
@@ -217,7 +649,7 @@ class Session:
         if result.status_code != 200:
             raise Exception(result.text)
 
-        result = pickle.load(result.raw)
+        result = _load_pickle(result)
         return (result['prediction_time'], result['event_states'])
 
     def get_predicted_toe(self):
@@ -236,9 +668,52 @@ class Session:
         if result.status_code != 200:
             raise Exception(result.text)
             
-        result = pickle.load(result.raw)
+        result = _load_pickle(result)
         return (result['prediction_time'], result['time_of_event'])
 
+    def get_prediction_history(self, start=None, end=None):
+        """Get the summaries of recent predictions, e.g., to track convergence of ToE over time
+
+        Args:
+            start (float, optional): Earliest prediction time (i.e., time of state predicted from)
+            end (float, optional): Latest prediction time
+
+        Returns:
+            dict: Columns of prediction summaries (prediction_time, timestamp, duration, n_samples, truncated, and time_of_event, with mean and percentiles for each event), oldest first
+        """
+        params = {}
+        if start is not None:
+            params['start'] = start
+        if end is not None:
+            params['end'] = end
+        result = requests.get(self.host + '/prediction/history', params=params)
+
+        # If error code throw Exception
+        if result.status_code != 200:
+            raise Exception(result.text)
+
+        return json.loads(result.text)
+
+    def get_status(self):
+        """Get a compact status of the session, which is cheap for the server to provide, for frequent polling
+
+        Returns:
+            dict: Status, including version (increases with each new prediction result), prediction_time (time of the state the latest prediction was from), queued and running (if predictions are queued or running), and error (from the last failed prediction)
+
+        Example:
+            version = session.get_status()['version']
+            session.send_data(...)
+            while session.get_status()['version'] == version:
+                time.sleep(0.1)
+        """
+        result = requests.get(self.host + '/status')
+
+        # If error code throw Exception
+        if result.status_code != 200:
+            raise Exception(result.text)
+
+        return json.loads(result.text)
+
     def get_prediction_status(self):
         """Get the status of the prediction
 
@@ -267,7 +742,7 @@ class Session:
         if result.status_code != 200:
             raise Exception(result.text)
 
-        result = pickle.load(result.raw)
+        result = _load_pickle(result)
         return (result['time'], result['performance_metrics'])
 
     def get_predicted_performance_metrics(self):
@@ -284,9 +759,36 @@ class Session:
         if result.status_code != 200:
             raise Exception(result.text)
 
-        result = pickle.load(result.raw)
+        result = _load_pickle(result)
         return (result['prediction_time'], result['performance_metrics'])
     
+    def profile_next_prediction(self, cprofile=True):
+        """
+        Request a profile of the next prediction. The profile is available from get_profile once the prediction completes.
+
+        Args:
+            cprofile (bool, optional): If full cProfile output is also included. Defaults to True
+        """
+        result = requests.post(self.host + '/profile', data={'cprofile': 'true' if cprofile else 'false'})
+
+        # If error code throw Exception
+        if result.status_code != 204:
+            raise Exception(result.text)
+
+    def get_profile(self):
+        """Get the profile of the latest prediction
+
+        Returns:
+            dict: Timing breakdown (s) by phase of the latest profiled prediction ('prediction') and cProfile output, if requested ('cprofile')
+        """
+        result = requests.get(self.host + '/profile')
+
+        # If error code throw Exception
+        if result.status_code != 200:
+            raise Exception(result.text)
+
+        return json.loads(result.text)
+
     def get_model(self):
         """
         Get the configured PrognosticsModel used by the session
@@ -303,4 +805,4 @@ class Session:
         if result.status_code != 200:
             raise Exception(result.text)
 
-        return pickle.load(result.raw)
+        return _load_pickle(result)
@@ -2,29 +2,76 @@
 # National Aeronautics and Space Administration.  All Rights Reserved.
 
 from prog_server.controllers import *
-from flask import Flask
+from prog_server.models import compression, metrics, profiling
+from flask import Flask, g, request
+from time import monotonic
 
 app = Flask("prog_server")
 app.url_map.strict_slashes = False
+app.wsgi_app = compression.RequestDecompressor(app.wsgi_app)
 
 PREFIX = '/api/v1'
 
+@app.before_request
+def _start_timer():
+    g.start = monotonic()
+    if profiling.is_requested(request):
+        profiling.start()
+
+@app.after_request
+def _record_request(response):
+    # Route template (e.g., /api/v1/session/<int:session_id>/state) rather than path, to bound the number of label values
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.requests_total.inc(route, request.method, response.status_code)
+    if 'start' in g:
+        metrics.request_duration.observe(monotonic() - g.start, route, request.method)
+    profile = profiling.current()
+    if profile is not None:
+        response.headers['Server-Timing'] = profile.server_timing()
+    return response
+
+@app.teardown_request
+def _stop_profiling(exception=None):
+    # Always runs (after_request is skipped if the view raises), so a profile never carries over to the next request on the thread
+    profiling.stop()
+
+@app.after_request
+def _compress_response(response):
+    # Request encodings accepted, so clients can compress request bodies (RFC 7694)
+    response.headers['Accept-Encoding'] = ', '.join(compression.ENCODINGS)
+    return compression.compress_response(response, compression.negotiate(request))
+
 app.add_url_rule(PREFIX, methods=['GET'], view_func=api_v1)
+app.add_url_rule(PREFIX + '/metrics', methods=['GET'], view_func=get_metrics)
 
 # Session
 app.add_url_rule(PREFIX + '/session', methods=['PUT'], view_func=new_session)
 app.add_url_rule(PREFIX + '/session', methods=['GET'], view_func=get_sessions)
+app.add_url_rule(PREFIX + '/session/bulk', methods=['PUT'], view_func=new_sessions)
+app.add_url_rule(PREFIX + '/session/bulk', methods=['DELETE'], view_func=delete_sessions)
 app.add_url_rule(PREFIX + '/session/<int:session_id>', methods=['GET'], view_func=get_session)
 app.add_url_rule(PREFIX + '/session/<int:session_id>', methods=['DELETE'], view_func=delete_session)
 
+# Fleet
+app.add_url_rule(PREFIX + '/fleet/summary', methods=['GET'], view_func=get_fleet_summary)
+
 # Set
 app.add_url_rule(PREFIX + '/session/<int:session_id>/state', methods=['POST'], view_func=set_state)
 app.add_url_rule(PREFIX + '/session/<int:session_id>/loading', methods=['POST'], view_func=set_loading_profile)
 app.add_url_rule(PREFIX + '/session/<int:session_id>/data', methods=['POST'], view_func=send_data)
+app.add_url_rule(PREFIX + '/session/<int:session_id>/backfill', methods=['POST'], view_func=start_backfill)
+app.add_url_rule(PREFIX + '/session/<int:session_id>/tags', methods=['POST'], view_func=set_tags)
+app.add_url_rule(PREFIX + '/session/<int:session_id>/scenarios', methods=['POST'], view_func=score_scenarios)
+app.add_url_rule(PREFIX + '/session/<int:session_id>/profile', methods=['POST'], view_func=set_profiling)
 
 # Get
 app.add_url_rule(PREFIX + '/session/<int:session_id>/loading', methods=['GET'], view_func=get_loading_profile)
 app.add_url_rule(PREFIX + '/session/<int:session_id>/initialized', methods=['GET'], view_func=get_initialized)
+app.add_url_rule(PREFIX + '/session/<int:session_id>/backfill', methods=['GET'], view_func=get_backfill_status)
+app.add_url_rule(PREFIX + '/session/<int:session_id>/tags', methods=['GET'], view_func=get_tags)
+app.add_url_rule(PREFIX + '/session/<int:session_id>/profile', methods=['GET'], view_func=get_profile)
+app.add_url_rule(PREFIX + '/session/<int:session_id>/status', methods=['GET'], view_func=get_status)
+app.add_url_rule(PREFIX + '/session/<int:session_id>/data/status', methods=['GET'], view_func=get_data_status)
 app.add_url_rule(PREFIX + '/session/<int:session_id>/prediction/status', methods=['GET'], view_func=get_prediction_status)
 app.add_url_rule(PREFIX + '/session/<int:session_id>/model', methods=['GET'], view_func=get_model)
 
@@ -40,3 +87,4 @@ app.add_url_rule(PREFIX + '/session/<int:session_id>/prediction/output', methods
 app.add_url_rule(PREFIX + '/session/<int:session_id>/prediction/event_state', methods=['GET'], view_func=get_predicted_event_state)
 app.add_url_rule(PREFIX + '/session/<int:session_id>/prediction/performance_metrics', methods=['GET'], view_func=get_predicted_perf_metrics)
 app.add_url_rule(PREFIX + '/session/<int:session_id>/prediction/events', methods=['GET'], view_func=get_predicted_toe)
+app.add_url_rule(PREFIX + '/session/<int:session_id>/prediction/history', methods=['GET'], view_func=get_prediction_history)
@@ -0,0 +1,151 @@
+# Copyright © 2021 United States Government as represented by the Administrator of the
+# National Aeronautics and Space Administration.  All Rights Reserved.
+
+"""
+Offline batch prognostics over a directory of recorded runs, without the HTTP server. For example, to re-run prognostics for a recorded fleet dataset after a model parameter update.
+
+Each run is a file (csv, npz, or npy, see models.backfill) with columns time and each input and output of the model. Runs are processed in parallel on local cores. For each run, a Session is built from the configuration and state estimation is run through the data (as in backfill), making a prediction at the end (or every predict_every data points). Time of event statistics (see models.history) are written to a columnar file (csv or npz), with one row per prediction.
+
+The configuration is a JSON file with the same keys and semantics as the PUT /session request body (model, model_cfg, x0, state_est, state_est_cfg, load_est, load_est_cfg, pred, pred_cfg, ...), so results match sessions of the online service.
+
+Use:
+    python -m prog_server.batch config.json data_dir [--output toe.csv] [--predict-every N] [--workers N]
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import csv
+from flask import Flask
+import json
+import numpy as np
+import os
+from prog_server.controllers import _parse_session_form
+from prog_server.models import backfill
+from prog_server.models.history import STATS, toe_stats
+from prog_server.models.prediction_handler import predict
+from prog_server.models.session import Session
+import sys
+from werkzeug.exceptions import HTTPException
+
+# Session and state estimator logging and errors need an application context
+_app = Flask('prog_server.batch')
+
+def _session_cfg(config):
+    # Request body form from config, so it is parsed exactly as in PUT /session
+    form = {key: value if isinstance(value, str) else json.dumps(value) for (key, value) in config.items()}
+    with _app.app_context():
+        return _parse_session_form(form)
+
+def _run(path, session_cfg, fmt=None, predict_every=None):
+    # Process one run. Returns (events, list of (prediction_time, toe stats))
+    fmt = fmt or os.path.splitext(path)[1][1:].lower()
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    with _app.app_context():
+        session = Session(0, predict_queue=False, **session_cfg)
+        (times, inputs, outputs) = backfill.load_records(data, fmt, session.model.inputs, session.model.outputs)
+        step = predict_every or max(len(times), 1)
+        rows = []
+        for start in range(0, max(len(times), 1), step):
+            session.backfill(times[start:start+step], inputs[start:start+step], outputs[start:start+step], predict_queue=False)
+            if session.backfill_status['status'] == 'failed':
+                raise ValueError(session.backfill_status['error'])
+            if not session.initialized:
+                # Model requires data to initialize
+                continue
+            predict(session)
+            result = session.results[1]
+            rows.append((result['time'], toe_stats(result['time of event'], session.model.events)))
+        return (session.model.events, rows)
+
+def find_runs(directory):
+    """
+    Get the recorded runs in a directory
+
+    Args:
+        directory (str): Directory
+
+    Returns:
+        list[str]: Paths of files with a supported extension (see models.backfill.FORMATS), sorted by name
+    """
+    return sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if os.path.splitext(name)[1][1:].lower() in backfill.FORMATS)
+
+def run(config, paths, fmt=None, predict_every=None, workers=None):
+    """
+    Run prognostics for recorded runs in parallel
+
+    Args:
+        config (dict): Session configuration, as in the PUT /session request body
+        paths (list[str]): Files of recorded runs (see find_runs)
+        fmt (str, optional): Format of the files. Defaults to each file's extension
+        predict_every (int, optional): Number of data points between predictions. Defaults to one prediction at the end of each run
+        workers (int, optional): Number of worker processes. Defaults to the number of cores
+
+    Returns:
+        tuple:
+            | dict: Columns: run (file name without extension), prediction_time, and <event>_<stat> for each event and each of history.STATS (NaN if event not reached)
+            | list[dict]: Runs that failed (run and error)
+
+    Raises:
+        HTTPException: If the configuration is invalid (as for PUT /session)
+    """
+    session_cfg = _session_cfg(config)
+    columns = {'run': [], 'prediction_time': []}
+    errors = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [(path, executor.submit(_run, path, session_cfg, fmt, predict_every)) for path in paths]
+        for (path, future) in futures:
+            name = os.path.splitext(os.path.basename(path))[0]
+            try:
+                (events, rows) = future.result()
+            except HTTPException as e:
+                errors.append({'run': name, 'error': e.description})
+                continue
+            except Exception as e:
+                errors.append({'run': name, 'error': str(e)})
+                continue
+            for (prediction_time, stats) in rows:
+                columns['run'].append(name)
+                columns['prediction_time'].append(prediction_time)
+                for (i, event) in enumerate(events):
+                    for (j, stat) in enumerate(STATS):
+                        columns.setdefault(f'{event}_{stat}', []).append(float(stats[i, j]))
+    return (columns, errors)
+
+def write_columns(columns, path):
+    """
+    Write columns (e.g., from run) to a csv or npz file, depending on the extension of path
+    """
+    if path.lower().endswith('.npz'):
+        np.savez(path, **{key: np.asarray(values) for (key, values) in columns.items()})
+        return
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns.keys())
+        writer.writerows(zip(*columns.values()))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run prognostics offline for a directory of recorded runs')
+    parser.add_argument('config', help='Session configuration (JSON), with the same keys as the PUT /session request body')
+    parser.add_argument('data', help='Directory of recorded runs (csv, npz, or npy files)')
+    parser.add_argument('--output', default='toe.csv', help='File to write time of event results (csv or npz)')
+    parser.add_argument('--format', default=None, choices=backfill.FORMATS, help='Format of the runs. Defaults to each file\'s extension')
+    parser.add_argument('--predict-every', type=int, default=None, help='Data points between predictions. Defaults to one prediction at the end of each run')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes. Defaults to the number of cores')
+    args = parser.parse_args(argv)
+
+    with open(args.config) as f:
+        config = json.load(f)
+    paths = find_runs(args.data)
+    (columns, errors) = run(config, paths, args.format, args.predict_every, args.workers)
+    write_columns(columns, args.output)
+    print(f"{len(paths) - len(errors)} of {len(paths)} runs processed. Results written to {args.output}")
+    for error in errors:
+        print(f"Run {error['run']} failed: {error['error']}", file=sys.stderr)
+    return 1 if errors else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,241 @@
+# Copyright © 2021 United States Government as represented by the Administrator of the
+# National Aeronautics and Space Administration.  All Rights Reserved.
+
+"""
+Benchmarks for the prog_server hot paths. Starts a server locally and measures:
+
+    * ingest: send_data rate for one session and across many sessions
+    * latency: time from sending data to a prediction based on that data being available
+    * queries: latency of get_predicted_* for each return_format
+    * memory: server memory per session for standard progpy models
+
+Results are written as JSON, so they can be compared across versions.
+
+Use:
+    python -m prog_server.bench [--output results.json] [--compare baseline.json]
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import platform
+import prog_client
+import prog_server
+from prog_server.models.prog_server import server
+from progpy import models
+import requests
+import statistics
+import sys
+import time
+
+BENCH_PORT = 8556
+RETURN_FORMATS = ('mean', 'metrics', 'multivariate_norm', 'uncertain_data')
+QUERIES = ('state', 'output', 'event_state', 'events')
+
+# Session configuration and constant input for each benchmarked model
+MODELS = {
+    'ThrownObject': {
+        'cfg': {'pred_cfg': {'save_freq': 0.5, 'dt': 0.01}},
+        'input': {},
+        'dt': 0.1
+    },
+    'BatteryCircuit': {
+        'cfg': {'pred_cfg': {'save_freq': 100, 'dt': 1, 'n_samples': 20}},
+        'input': {'i': 2},
+        'dt': 1
+    }
+}
+
+def _data(model_name, n):
+    # Simulated measurements (time, data) to send to the server
+    m = getattr(models, model_name)()
+    u = m.InputContainer(MODELS[model_name]['input'])
+    dt = MODELS[model_name]['dt']
+    x = m.initialize(u)
+    data = []
+    for i in range(1, n+1):
+        x = m.next_state(x, u, dt)
+        z = m.output(x)
+        data.append((i*dt, {**{key: float(z[key]) for key in m.outputs}, **{key: float(u[key]) for key in m.inputs}}))
+    return data
+
+def _summarize(durations):
+    durations = sorted(durations)
+    return {
+        'n': len(durations),
+        'mean': statistics.mean(durations),
+        'median': statistics.median(durations),
+        'p95': durations[min(len(durations)-1, int(0.95*len(durations)))],
+        'max': durations[-1]}
+
+def _session(model_name, port):
+    return prog_client.Session(model_name, port=port, **MODELS[model_name]['cfg'])
+
+def _wait_for_prediction(session_id, state_time, port, timeout=120):
+    # Wait until a prediction from a state at or after state_time is available
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        summary = prog_client.Session.get_fleet_summary(ids=[session_id], port=port)['sessions'][0]
+        if summary['prediction_time'] is not None and summary['prediction_time'] >= state_time - 1e-9:
+            return time.perf_counter() - start
+        time.sleep(0.005)
+    raise TimeoutError(f"No prediction for state at {state_time} within {timeout}s")
+
+def bench_ingest(model_name, port, n_points=200, n_sessions=10):
+    """Rate (data points/s) of send_data for one session and across n_sessions in parallel"""
+    data = _data(model_name, n_points)
+
+    session = _session(model_name, port)
+    start = time.perf_counter()
+    for (t, values) in data:
+        session.send_data(t, **values)
+    single = n_points/(time.perf_counter() - start)
+    prog_client.Session.delete_many([session], port=port)
+
+    sessions = prog_client.Session.create_many(model_name, n=n_sessions, port=port, **MODELS[model_name]['cfg'])
+    def send_all(session):
+        for (t, values) in data:
+            session.send_data(t, **values)
+    with ThreadPoolExecutor(max_workers=n_sessions) as executor:
+        start = time.perf_counter()
+        list(executor.map(send_all, sessions))
+        fleet = n_points*n_sessions/(time.perf_counter() - start)
+    prog_client.Session.delete_many(sessions, port=port)
+
+    return {'single_session_rate': single, 'fleet_rate': fleet, 'n_sessions': n_sessions}
+
+def bench_latency(model_name, port, n_trials=10):
+    """Time from sending data to the prediction from that data being available"""
+    data = _data(model_name, n_trials)
+    session = _session(model_name, port)
+    durations = []
+    for (t, values) in data:
+        start = time.perf_counter()
+        session.send_data(t, **values)
+        _wait_for_prediction(session.session_id, t, port)
+        durations.append(time.perf_counter() - start)
+    prog_client.Session.delete_many([session], port=port)
+    return _summarize(durations)
+
+def bench_queries(model_name, port, n_trials=20):
+    """Latency of get_predicted_* for each return format"""
+    (t, values) = _data(model_name, 1)[0]
+    session = _session(model_name, port)
+    session.send_data(t, **values)
+    _wait_for_prediction(session.session_id, t, port)
+
+    results = {}
+    for query in QUERIES:
+        url = f'{session.host}/prediction/{query}'
+        for return_format in RETURN_FORMATS:
+            durations = []
+            for _ in range(n_trials):
+                start = time.perf_counter()
+                result = requests.get(url, params={'return_format': return_format})
+                durations.append(time.perf_counter() - start)
+                if result.status_code != 200:
+                    raise Exception(result.text)
+            results[f'{query}/{return_format}'] = {**_summarize(durations), 'bytes': len(result.content)}
+    prog_client.Session.delete_many([session], port=port)
+    return results
+
+def _server_rss():
+    # Resident memory of the server process in bytes (Linux only)
+    try:
+        with open(f'/proc/{server.process.pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, AttributeError):
+        pass
+    return None
+
+def bench_memory(model_name, port, n_sessions=100):
+    """Server memory per session (bytes)"""
+    before = _server_rss()
+    if before is None:
+        return None
+    sessions = prog_client.Session.create_many(model_name, n=n_sessions, port=port, **MODELS[model_name]['cfg'])
+    time.sleep(1)  # Let initial predictions settle
+    after = _server_rss()
+    prog_client.Session.delete_many(sessions, port=port)
+    return (after - before)/n_sessions
+
+def run(port=BENCH_PORT, model_names=tuple(MODELS.keys()), n_sessions=10, n_points=200):
+    """
+    Run the benchmarks against a server started locally.
+
+    Args:
+        port (int, optional): Port for the local server
+        model_names (list[str], optional): Models to benchmark (keys of MODELS)
+        n_sessions (int, optional): Number of sessions used for fleet ingest and memory benchmarks
+        n_points (int, optional): Number of data points sent per session in ingest benchmarks
+
+    Returns:
+        dict: Benchmark results
+    """
+    results = {
+        'version': prog_server.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'models': {}}
+
+    prog_server.start(port=port)
+    try:
+        for model_name in model_names:
+            print(f'Benchmarking {model_name}')
+            results['models'][model_name] = {
+                'ingest': bench_ingest(model_name, port, n_points, n_sessions),
+                'latency': bench_latency(model_name, port),
+                'queries': bench_queries(model_name, port),
+                'memory_per_session': bench_memory(model_name, port, n_sessions*10)}
+    finally:
+        prog_server.stop()
+    return results
+
+def _flatten(results, prefix=''):
+    flat = {}
+    for (key, value) in results.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+def compare(results, baseline):
+    """
+    Print the ratio of each benchmark result to a baseline (e.g., a previous version)
+
+    Args:
+        results (dict): Results from run
+        baseline (dict): Results from run, for comparison
+    """
+    print(f"\nComparison (version {results['version']} / {baseline['version']}):")
+    current = _flatten(results['models'], 'models.')
+    previous = _flatten(baseline['models'], 'models.')
+    for key in sorted(current.keys() & previous.keys()):
+        if previous[key]:
+            print(f'\t{key}: {current[key]:.4g} ({current[key]/previous[key]:.2f}x)')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark prog_server hot paths')
+    parser.add_argument('--port', type=int, default=BENCH_PORT, help='Port for the local server')
+    parser.add_argument('--models', nargs='+', default=list(MODELS.keys()), choices=list(MODELS.keys()), help='Models to benchmark')
+    parser.add_argument('--sessions', type=int, default=10, help='Number of sessions for fleet benchmarks')
+    parser.add_argument('--points', type=int, default=200, help='Data points per session for ingest benchmarks')
+    parser.add_argument('--output', default='bench_results.json', help='File to write results (JSON)')
+    parser.add_argument('--compare', default=None, help='Results file (JSON) from a previous run to compare against')
+    args = parser.parse_args(argv)
+
+    results = run(args.port, args.models, args.sessions, args.points)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {args.output}')
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,84 +1,295 @@
 # Copyright © 2021 United States Government as represented by the Administrator of the
 # National Aeronautics and Space Administration.  All Rights Reserved.
 from concurrent.futures._base import TimeoutError
-from flask import request, abort, jsonify
+from functools import wraps
+from flask import request, abort, jsonify, make_response, Response, stream_with_context
 from flask import current_app as app
+from werkzeug.exceptions import HTTPException
 import json
 import pickle
-from prog_server.models.session import Session
+from prog_server.models import backfill, compression, metrics, prediction_arrays, profiling
+from prog_server.models.session import Session, backfill_pool, creation_pool
+from prog_server.models.session_index import SessionIndex
 from prog_server.models.load_ests import update_moving_avg
-from progpy.sim_result import SimResult, LazySimResult
+from prog_server.models.prediction_handler import cancel_predictions, predict_scenarios, PredictionCancelled
+from prog_server.models.load_ests import build_load_est
+from prog_server.models.model_cache import rendering
+from prog_server.models.prediction_arrays import PredictionArrays
 from progpy.uncertain_data import UnweightedSamples
-from progpy.predictors import Prediction, UnweightedSamplesPrediction
+from progpy.predictors import Prediction
+from threading import Lock
+from time import monotonic
+from time import time as wall_time
 
 session_count = 0
+session_count_lock = Lock()
 sessions = {}
+session_index = SessionIndex()
+# Sessions being created asynchronously (see new_session): id -> status (pending or failed) and error
+pending_sessions = {}
+pending_lock = Lock()
+# Time (s) a failed session is kept to report its error, if it is never read (see get_initialized)
+FAILED_SESSION_TTL = 600
+
+# Session arguments that can be overridden per-session in bulk creation
+BULK_OVERRIDES = {'x0', 'tags'}
+
+# Number of times computed together when streaming predictions
+STREAM_BLOCK_SIZE = 100
+
+# Maximum number of responses cached per session for the current prediction results
+RENDER_CACHE_SIZE = 32
+
+def _result_ages():
+    # Age (s) of the latest prediction result of each session
+    now = wall_time()
+    ages = {}
+    for session in list(sessions.values()):
+        last_prediction = session.summary['last_prediction']
+        if last_prediction is not None:
+            ages[(session.session_id,)] = now - last_prediction
+    return ages
+
+metrics.registry.add(metrics.Gauge('prog_server_active_sessions', 'Number of active sessions', lambda: len(sessions)))
+metrics.registry.add(metrics.Gauge('prog_server_session_result_age_seconds', 'Age of latest prediction result', _result_ages, ('session_id',)))
+
+def _json(result):
+    with profiling.phase('serialize'):
+        return jsonify(result)
+
+def _pickle(result):
+    with profiling.phase('serialize'):
+        return pickle.dumps(result)
 
 def api_v1():
     return jsonify({'message': 'Welcome to the PaaS Sandbox API!'})
 
-# Session
-def new_session():
+def get_metrics():
     """
-    Create a new session.
-
-    Args:
+    Get operational metrics in the Prometheus text format.
     """
-    global session_count
-    app.logger.debug("Creating New Session")
+    return metrics.registry.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
 
-    if 'model' not in request.form:
+# Session
+def _parse_session_form(form):
+    """
+    Parse the session configuration from a request form into Session keyword arguments. Shared between single and bulk session creation.
+    """
+    if 'model' not in form:
         abort(400, 'model must be specified in request body')
 
-    model_name = request.form['model']
-
-    session_id = session_count
-    session_count += 1
+    cfgs = {}
+    for key in ('model_cfg', 'load_est_cfg', 'pred_cfg', 'state_est_cfg'):
+        try:
+            cfgs[key] = json.loads(form.get(key, '{}'))
+        except json.decoder.JSONDecodeError:
+            abort(400, f'{key} must be valid JSON')
 
     try:
-        model_cfg = json.loads(request.form.get('model_cfg', '{}'))
-    except json.decoder.JSONDecodeError:
-        abort(400, 'model_cfg must be valid JSON')
+        pred_deadline = form.get('pred_deadline', None)
+        if pred_deadline is not None:
+            pred_deadline = float(pred_deadline)
+    except ValueError:
+        abort(400, 'pred_deadline must be a number (seconds)')
 
     try:
-        load_est_cfg = json.loads(request.form.get('load_est_cfg', '{}'))
+        tags = _parse_tags(json.loads(form.get('tags', '{}')))
     except json.decoder.JSONDecodeError:
-        abort(400, 'load_est_cfg must be valid JSON')
+        abort(400, 'tags must be valid JSON')
 
     try:
-        pred_cfg = json.loads(request.form.get('pred_cfg', '{}'))
-    except json.decoder.JSONDecodeError:
-        abort(400, 'pred_cfg must be valid JSON')
+        history_size = int(form.get('history_size', 100))
+    except ValueError:
+        abort(400, 'history_size must be an integer')
+
+    return {
+        'model_name': form['model'],
+        'tags': tags,
+        'history_size': history_size,
+        'x0': form.get('x0', None),
+        'state_est_name': form.get('state_est', 'ParticleFilter'),
+        'load_est_name': form.get('load_est', 'MovingAverage'),
+        'pred_name': form.get('pred', 'MonteCarlo'),
+        'pred_deadline': pred_deadline,
+        'cancel_superseded': form.get('cancel_superseded', 'false').lower() in ('true', '1'),
+        'async_ingest': form.get('async_ingest', 'false').lower() in ('true', '1'),
+        **cfgs
+    }
 
-    try:
-        state_est_cfg = json.loads(request.form.get('state_est_cfg', '{}'))
-    except json.decoder.JSONDecodeError:
-        abort(400, 'state_est_cfg must be valid JSON')
-
-    sessions[session_id] = Session(
-        session_id,
-        model_name,
-        model_cfg=model_cfg,
-        x0=request.form.get('x0', None),
-        state_est_name=request.form.get('state_est', 'ParticleFilter'),
-        state_est_cfg=state_est_cfg,
-        load_est_name=request.form.get('load_est', 'MovingAverage'),
-        load_est_cfg=load_est_cfg,
-        pred_name=request.form.get('pred', 'MonteCarlo'),
-        pred_cfg=pred_cfg
-    )
+def _parse_tags(tags, allow_none=False):
+    # Tags are indexed, so values must be strings
+    if not isinstance(tags, dict):
+        abort(400, 'tags must be a dictionary of key: value')
+    return {str(key): (None if (value is None and allow_none) else str(value)) for key, value in tags.items()}
+
+def _add_session(session):
+    sessions[session.session_id] = session
+    session_index.add(session)
+
+def _remove_session(session_id):
+    session = sessions.pop(session_id, None)
+    if session is not None:
+        session_index.remove(session)
+        cancel_predictions(session)
+    return session
+
+def _filter_session_ids(args):
+    """
+    Get the IDs of sessions matching the filters in request args (model, pred, tag=key:value), sorted
+    """
+    tags = {}
+    for tag in args.getlist('tag'):
+        if ':' not in tag:
+            abort(400, f'tag filter must be in the form key:value, was {tag}')
+        (key, value) = tag.split(':', 1)
+        tags[key] = value
+    ids = session_index.query(args.get('model', None), args.get('pred', None), tags)
+    if ids is None:
+        # No filters
+        ids = list(sessions.keys())
+    return sorted(ids)
+
+def _next_session_id():
+    global session_count
+    with session_count_lock:
+        session_id = session_count
+        session_count += 1
+    return session_id
+
+def new_session():
+    """
+    Create a new session.
+
+    Args:
+        (request body) async_create: If true, the session is built on a worker and the session ID is returned immediately with status pending (202). Readiness is reported by get_initialized
+    """
+    app.logger.debug("Creating New Session")
+
+    session_cfg = _parse_session_form(request.form)
+    session_id = _next_session_id()
+
+    if request.form.get('async_create', 'false').lower() in ('true', '1'):
+        with pending_lock:
+            _expire_failed_sessions()
+            pending_sessions[session_id] = {'status': 'pending', 'error': None}
+        creation_pool.submit(_build_pending, app._get_current_object(), session_id, session_cfg)
+        return jsonify({'session_id': session_id, 'status': 'pending'}), 202
+
+    _add_session(Session(session_id, **session_cfg))
     
     return jsonify(sessions[session_id].to_dict()), 201
 
+def _expire_failed_sessions():
+    # Remove failed sessions kept longer than FAILED_SESSION_TTL. Called with pending_lock held
+    now = monotonic()
+    expired = [session_id for (session_id, pending) in pending_sessions.items() if pending['status'] == 'failed' and pending['failed_at'] + FAILED_SESSION_TTL < now]
+    for session_id in expired:
+        del pending_sessions[session_id]
+
+def _build_pending(app_obj, session_id, session_cfg):
+    # Build a session created with async_create. Errors are kept in pending_sessions until reported (see get_initialized), the session is deleted, or FAILED_SESSION_TTL
+    with app_obj.app_context():
+        session = None
+        error = None
+        try:
+            session = Session(session_id, **session_cfg)
+        except HTTPException as e:
+            error = e.description
+        except Exception as e:
+            error = str(e)
+        with pending_lock:
+            if session_id not in pending_sessions:
+                # Deleted while pending
+                if session is not None:
+                    cancel_predictions(session)
+                return
+            if session is None:
+                app.logger.debug(f"Creating Session {session_id} failed: {error}")
+                pending_sessions[session_id] = {'status': 'failed', 'error': error, 'failed_at': monotonic()}
+                return
+            _add_session(session)
+            del pending_sessions[session_id]
+
+def new_sessions():
+    """
+    Create multiple sessions from a shared template, built in parallel. Either all sessions are created, or none (if any fails, with status 400 and the errors).
+
+    Args:
+        (request body) Same as new_session, plus either:
+            sessions: JSON list of per-session overrides (e.g., x0)
+            n: Number of sessions to create without overrides
+    """
+    template = _parse_session_form(request.form)
+
+    try:
+        overrides = json.loads(request.form.get('sessions', '[]'))
+        if 'n' in request.form:
+            overrides.extend([{}] * int(request.form['n']))
+    except (json.decoder.JSONDecodeError, AttributeError):
+        abort(400, 'sessions must be a valid JSON list')
+    except ValueError:
+        abort(400, 'n must be an integer')
+
+    for override in overrides:
+        if not isinstance(override, dict) or not set(override.keys()) <= BULK_OVERRIDES:
+            abort(400, f'Each session override must be a dict with keys from {sorted(BULK_OVERRIDES)}')
+
+    app.logger.debug(f"Creating {len(overrides)} New Sessions")
+    app_obj = app._get_current_object()
+
+    def build(session_id, override):
+        with app_obj.app_context():
+            if 'tags' in override:
+                override = {**override, 'tags': {**template['tags'], **_parse_tags(override['tags'])}}
+            return Session(session_id, **{**template, **override})
+
+    futures = [(_next_session_id(), i, override) for i, override in enumerate(overrides)]
+    futures = [(session_id, i, creation_pool.submit(build, session_id, override)) for (session_id, i, override) in futures]
+
+    built = []
+    errors = []
+    failure = None
+    for (session_id, i, future) in futures:
+        try:
+            built.append(future.result())
+        except HTTPException as e:
+            errors.append({'index': i, 'error': e.description})
+        except Exception as e:
+            failure = e
+
+    if errors or failure is not None:
+        # Sessions built are discarded (with any predictions they queued), so none are left that the client doesn't know about
+        for session in built:
+            cancel_predictions(session)
+        if failure is not None:
+            raise failure
+        return jsonify({'sessions': [], 'errors': errors}), 400
+
+    for session in built:
+        _add_session(session)
+    return jsonify({'sessions': [session.to_dict() for session in built], 'errors': errors}), 201
+
 def get_sessions():
     """
     Get the sessions.
 
+    Args:
+        (query) model: Only sessions using this model
+        (query) pred: Only sessions using this predictor
+        (query) tag: Only sessions with this tag, in the form key:value. Can be repeated
+        (query) page: Page number, starting at 0. If omitted, all sessions are returned
+        (query) page_size: Number of sessions per page. Defaults to 100
+
     Returns:
         The sessions.
     """
     app.logger.debug("Getting Active Sessions")
-    return jsonify({'sessions': list(sessions.keys())})
+    ids = _filter_session_ids(request.args)
+    total = len(ids)
+    if 'page' in request.args:
+        (page, page_size) = _parse_page(request.args)
+        ids = ids[page*page_size:(page+1)*page_size]
+    return jsonify({'sessions': ids, 'total': total})
 
 def get_session(session_id):
     """
@@ -104,13 +315,184 @@ def delete_session(session_id):
     Args:
         session_id: The session ID.
     """
+    with pending_lock:
+        if pending_sessions.pop(session_id, None) is not None:
+            return jsonify({'id': session_id, 'status': 'stopped'})
     if session_id not in sessions:
         abort(400, f'Session {session_id} does not exist or has ended')
 
     app.logger.debug(f"Ending Session {session_id}")
-    del sessions[session_id]
+    _remove_session(session_id)
     return jsonify({'id': session_id, 'status': 'stopped'})
 
+def delete_sessions():
+    """
+    Delete multiple sessions.
+
+    Args:
+        (request body) ids: JSON list of session IDs
+    """
+    try:
+        session_ids = json.loads(request.form.get('ids', '[]'))
+        session_ids = [int(session_id) for session_id in session_ids]
+    except (json.decoder.JSONDecodeError, TypeError, ValueError):
+        abort(400, 'ids must be a valid JSON list of session IDs')
+
+    app.logger.debug(f"Ending Sessions {session_ids}")
+    result = []
+    for session_id in session_ids:
+        with pending_lock:
+            if pending_sessions.pop(session_id, None) is not None:
+                result.append({'id': session_id, 'status': 'stopped'})
+                continue
+        if _remove_session(session_id) is None:
+            result.append({'id': session_id, 'status': 'not found'})
+            continue
+        result.append({'id': session_id, 'status': 'stopped'})
+    return jsonify({'sessions': result})
+
+def set_tags(session_id):
+    """
+    Update the tags of a session. Tags set to null are removed.
+
+    Args:
+        session_id: The session ID.
+        (request body) tags: JSON dictionary of tag key: value
+    """
+    if session_id not in sessions:
+        abort(400, f'Session {session_id} does not exist or has ended')
+
+    try:
+        tags = _parse_tags(json.loads(request.form.get('tags', '{}')), allow_none=True)
+    except json.decoder.JSONDecodeError:
+        abort(400, 'tags must be valid JSON')
+
+    app.logger.debug(f"Setting tags for Session {session_id}")
+    sessions[session_id].set_tags(tags)
+    session_index.update_tags(sessions[session_id])
+    return get_tags(session_id)
+
+def get_tags(session_id):
+    """
+    Get the tags of a session.
+
+    Args:
+        session_id: The session ID.
+
+    Returns:
+        The tags of the session.
+    """
+    if session_id not in sessions:
+        abort(400, f'Session {session_id} does not exist or has ended')
+
+    return jsonify({'tags': sessions[session_id].tags})
+
+def set_profiling(session_id):
+    """
+    Request a profile of the session's next prediction.
+
+    Args:
+        session_id: The session ID.
+        (request body) cprofile: 'true' to also profile the next prediction with cProfile
+    """
+    if session_id not in sessions:
+        abort(400, f'Session {session_id} does not exist or has ended')
+
+    sessions[session_id].profile_next = True
+    sessions[session_id].cprofile_next = request.form.get('cprofile', 'false').lower() in ('true', '1')
+    return '', 204
+
+def get_profile(session_id):
+    """
+    Get the profile of the session's latest prediction.
+
+    Args:
+        session_id: The session ID.
+
+    Returns:
+        Timing breakdown (s) by phase of the latest profiled prediction, and cProfile output, if requested (see set_profiling)
+    """
+    if session_id not in sessions:
+        abort(400, f'Session {session_id} does not exist or has ended')
+
+    return jsonify({
+        'prediction': sessions[session_id].prediction_profile,
+        'cprofile': sessions[session_id].cprofile_stats})
+
+# Fleet
+def _toe_sort_key(summary, event):
+    # Sessions without a prediction (or event) are sorted last
+    toe = summary['time_of_event']
+    if toe is None or event not in toe or toe[event]['mean'] is None:
+        return (1, 0)
+    return (0, toe[event]['mean'])
+
+def _parse_page(args):
+    try:
+        page = int(args.get('page', 0))
+        page_size = int(args.get('page_size', 100))
+    except ValueError:
+        abort(400, 'page and page_size must be integers')
+    if page < 0 or page_size < 1:
+        abort(400, 'page must be non-negative and page_size positive')
+    return (page, page_size)
+
+def get_fleet_summary():
+    """
+    Get the summary (ToE metrics, current event state, and prediction freshness) of many sessions at once. Computed from cached per-session summaries. Event state is computed for the requested page only, once per state update.
+
+    Args:
+        (query) ids: Comma-separated session IDs. Defaults to all sessions
+        (query) model, pred, tag: Filters, as in get_sessions
+        (query) sort: 'id' (default) or 'toe'
+        (query) event: Event used for sorting by ToE. Defaults to first event of each session's model
+        (query) page: Page number, starting at 0
+        (query) page_size: Number of sessions per page. Defaults to 100
+
+    Returns:
+        Summaries of the requested page of sessions
+    """
+    (page, page_size) = _parse_page(request.args)
+    ids = _filter_session_ids(request.args)
+    if 'ids' in request.args:
+        try:
+            requested = set(int(session_id) for session_id in request.args['ids'].split(',') if session_id)
+        except ValueError:
+            abort(400, 'ids must be integers')
+        ids = [session_id for session_id in ids if session_id in requested]
+
+    # Read references only- summaries are replaced rather than modified, so no locks needed
+    summaries = []
+    for session_id in ids:
+        session = sessions.get(session_id)
+        if session is not None:
+            summaries.append((session, session.summary))
+
+    sort = request.args.get('sort', 'id')
+    if sort == 'toe':
+        event = request.args.get('event', None)
+        summaries.sort(key=lambda item: _toe_sort_key(item[1], event or next(iter(item[0].model.events), None)))
+    elif sort == 'id':
+        summaries.sort(key=lambda item: item[1]['session_id'])
+    else:
+        abort(400, f'Invalid sort: {sort}')
+
+    now = wall_time()
+    result = []
+    for (session, summary) in summaries[page*page_size:(page+1)*page_size]:
+        summary = dict(summary, event_state=session.event_state_summary())
+        if summary['last_prediction'] is not None:
+            summary['prediction_age'] = now - summary['last_prediction']
+        else:
+            summary['prediction_age'] = None
+        result.append(summary)
+
+    return jsonify({
+        'sessions': result,
+        'total': len(summaries),
+        'page': page,
+        'page_size': page_size})
+
 # Set
 def set_state(session_id):
     """
@@ -165,7 +547,7 @@ def set_loading_profile(session_id):
 
 def send_data(session_id):
     """
-    Send data to the session's model.
+    Send data to the session's model. For sessions with async_ingest, the data is queued for state estimation and the request returns immediately (202). Otherwise, state is estimated before returning (204).
 
     Args:
         session_id: The session ID.
@@ -177,6 +559,10 @@ def send_data(session_id):
     app.logger.debug(f"Data received from session {session_id}")
     values = request.form
     session = sessions[session_id]
+    with session.locks['futures']:  # Held by backfill while updating its status
+        running = _backfill_running(session)
+    if running:
+        abort(400, f'Backfill in progress for session {session_id}')
 
     try:
         inputs = {key: float(values[key]) for key in session.model.inputs}
@@ -186,12 +572,174 @@ def send_data(session_id):
         abort(400, f'Data missing for session {session_id}. Expected inputs: {session.model.inputs} and outputs: {session.model.outputs}. Received {list(values.keys())}')
 
     # Update moving average
-    update_moving_avg(inputs, session, session.load_est_cfg)
+    update_moving_avg(inputs, session, session.load_est_cfg, time)
+
+    if session.async_ingest:
+        session.queue_data(time, inputs, outputs)
+        return '', 202
 
     session.add_data(time, inputs, outputs)
 
     return '', 204
 
+def get_data_status(session_id):
+    """
+    Get how far state estimation lags behind the data received (e.g., for sessions with async_ingest).
+
+    Args:
+        session_id: The session ID.
+
+    Returns:
+        Number of data points received, estimated, dropped (after an error estimating queued data), and pending (received, not yet estimated or dropped), times of the latest data point received and estimated, lag (difference in those times), and the last error estimating queued data
+    """
+    if session_id not in sessions:
+        abort(400, f'Session {session_id} does not exist or has ended')
+
+    status = sessions[session_id].ingest_status
+    lag = None
+    if status['received_time'] is not None:
+        lag = status['received_time'] - (status['estimated_time'] if status['estimated_time'] is not None else status['received_time'])
+    return jsonify({
+        **status,
+        'pending': sessions[session_id].ingest_pending(),
+        'lag': lag})
+
+def _backfill_running(session):
+    # Caller must hold session.locks['futures']
+    return session.backfill_status is not None and session.backfill_status['status'] in ('queued', 'running')
+
+def start_backfill(session_id):
+    """
+    Backfill the session from historical data. State estimation is run through the data in the background, without predictions, then one prediction is made. Data sent with send_data is rejected until the backfill is complete.
+
+    Args:
+        session_id: The session ID.
+        (request body) file: Historical data, with columns time and each input and output of the model. Either uploaded as multipart file "file" or as the raw request body
+        (query) format: csv, npz, or npy (see models.backfill). Defaults to the extension of the uploaded file, or csv
+
+    Returns:
+        Backfill progress (as in get_backfill_status)
+    """
+    if session_id not in sessions:
+        abort(400, f'Session {session_id} does not exist or has ended')
+    session = sessions[session_id]
+
+    if 'file' in request.files:
+        upload = request.files['file']
+        data = upload.read()
+        extension = (upload.filename or '').rsplit('.', 1)[-1].lower()
+        default_format = extension if extension in backfill.FORMATS else 'csv'
+    else:
+        data = request.get_data()
+        default_format = 'csv'
+    fmt = request.args.get('format', default_format)
+
+    try:
+        (times, inputs, outputs) = backfill.load_records(data, fmt, session.model.inputs, session.model.outputs)
+    except ValueError as e:
+        abort(400, str(e))
+
+    app.logger.debug(f"Backfilling session {session_id} with {len(times)} data points")
+    with session.locks['futures']:
+        if _backfill_running(session):
+            abort(400, f'Backfill already in progress for session {session_id}')
+        if session.ingest_pending() > 0:
+            abort(400, f'Data sent to session {session_id} has not been estimated yet')
+        session.backfill_status = {
+            'status': 'queued',
+            'processed': 0,
+            'total': len(times),
+            'time': None,
+            'duration': 0,
+            'error': None}
+
+    app_obj = app._get_current_object()
+    def run():
+        with app_obj.app_context():
+            session.backfill(times, inputs, outputs)
+    backfill_pool.submit(run)
+
+    return jsonify(session.backfill_status), 202
+
+def get_backfill_status(session_id):
+    """
+    Get the progress of the session's latest backfill.
+
+    Args:
+        session_id: The session ID.
+
+    Returns:
+        status (queued, running, complete, failed, or cancelled), number of data points processed of total, time of the latest data point processed, duration (s), and error (if failed)
+    """
+    if session_id not in sessions:
+        abort(400, f'Session {session_id} does not exist or has ended')
+    if sessions[session_id].backfill_status is None:
+        abort(400, f'No backfill for session {session_id}')
+    return jsonify(sessions[session_id].backfill_status)
+
+def score_scenarios(session_id):
+    """
+    Predict from the session's current state for each of several loading scenarios (i.e., what-if analysis), and rank them by time of event. The session's prediction results are not changed.
+
+    Args:
+        session_id: The session ID.
+        (request body) scenarios: JSON list of scenarios, each a dict with type and cfg of the load estimator (as in set_loading_profile) and an optional name
+        (query) event: Event used for ranking. Defaults to the first event of the model
+
+    Returns:
+        Time of event metrics for each scenario, and scenario indices ranked from latest to earliest mean time of event. A scenario cancelled by the session's prediction deadline has time of event None and an error. Any other failure of a scenario (e.g., a load profile missing inputs) is an error (400)
+    """
+    if session_id not in sessions:
+        abort(400, f'Session {session_id} does not exist or has ended')
+    session = sessions[session_id]
+    if not session.initialized:
+        abort(400, 'Model not initialized')
+
+    try:
+        scenarios = json.loads(request.form.get('scenarios', '[]'))
+    except json.decoder.JSONDecodeError:
+        abort(400, 'scenarios must be valid JSON')
+    if not isinstance(scenarios, list) or len(scenarios) == 0:
+        abort(400, 'scenarios must be a non-empty list')
+
+    load_ests = []
+    for scenario in scenarios:
+        if not isinstance(scenario, dict) or 'type' not in scenario:
+            abort(400, 'Each scenario must be a dict with a load estimator type')
+        load_ests.append(build_load_est(scenario['type'], scenario.get('cfg', {}), session))
+
+    event = request.args.get('event', next(iter(session.model.events), None))
+    if event not in session.model.events:
+        abort(400, f'Invalid event {event}. Model events: {session.model.events}')
+    app.logger.debug(f"Scoring {len(scenarios)} scenarios for Session {session_id}")
+    (time, results) = predict_scenarios(session, load_ests)
+
+    scored = []
+    for (i, (scenario, toe)) in enumerate(zip(scenarios, results)):
+        result = {
+            'name': scenario.get('name', str(i)),
+            'type': scenario['type']}
+        if isinstance(toe, Exception) and not isinstance(toe, PredictionCancelled):
+            abort(400, f"Scenario {result['name']} failed: {toe!r}")
+        if isinstance(toe, Exception):
+            result['time_of_event'] = None
+            result['error'] = str(toe)
+        else:
+            result['time_of_event'] = toe.metrics()
+        scored.append(result)
+
+    def rank_key(i):
+        toe = scored[i]['time_of_event']
+        if toe is None or event not in toe or toe[event]['mean'] is None:
+            return (1, 0)
+        return (0, -toe[event]['mean'])
+
+    return jsonify({
+        'prediction_time': time,
+        'event': event,
+        'scenarios': scored,
+        'ranking': sorted(range(len(scored)), key=rank_key)})
+
 # Get
 def get_loading_profile(session_id):
     """
@@ -218,12 +766,19 @@ def get_initialized(session_id):
         session_id: The session ID.
 
     Returns:
-        The initialized state of the session.
+        The initialized state of the session, and its status: ready, or for sessions created with async_create, pending (being built) or failed (with error). A failure is reported once, after which the session does not exist
     """
-    if session_id not in sessions:
+    with pending_lock:
+        # Pending sessions are added to sessions before being removed from pending_sessions
+        pending = pending_sessions.get(session_id)
+        if pending is not None and pending['status'] == 'failed':
+            del pending_sessions[session_id]
+    if session_id in sessions:
+        return jsonify({'initialized': sessions[session_id].initialized, 'status': 'ready', 'error': None})
+    if pending is None:
         abort(400, f'Session {session_id} does not exist or has ended')
 
-    return jsonify({'initialized': sessions[session_id].initialized})
+    return jsonify({'initialized': False, 'status': pending['status'], 'error': pending['error']})
 
 def get_prediction_status(session_id):
     """
@@ -245,7 +800,8 @@ def get_prediction_status(session_id):
     status = {
         'exceptions': [],
         'in progress': 0,
-        'last prediction': None
+        'last prediction': None,
+        'truncated': False
     }
 
     with sessions[session_id].locks['futures']:
@@ -263,9 +819,38 @@ def get_prediction_status(session_id):
     with sessions[session_id].locks['results']:
         if sessions[session_id].results is not None:
             status['last prediction'] = sessions[session_id].results[0].strftime("%c")
+            status['truncated'] = sessions[session_id].results[1]['truncated']
     return jsonify(status)
 
+def get_status(session_id):
+    """
+    Get a compact status of the session, for polling. Reads a status record updated as predictions are queued, start, and finish, so is constant time.
+
+    Args:
+        session_id: The session ID.
+
+    Returns:
+        version (number of prediction results, increasing), prediction_time (time of the state the latest prediction was from), last_prediction (wall time completed, s since epoch), queued and running (if predictions are queued or running), truncated, error (message from the last failed prediction), and state_time (time of the current state)
+    """
+    session = sessions.get(session_id)
+    if session is None:
+        abort(400, f'Session {session_id} does not exist or has ended')
+
+    status = session.prediction_status
+    return jsonify({
+        **status,
+        'queued': status['queued'] > 0,
+        'running': status['running'] > 0,
+        'state_time': session.summary['state_time']})
+
 # Get current
+def _sample_through(x, fcn, n=100):
+    # Apply fcn (e.g., model.output) to samples of x
+    with profiling.phase('sampling'):
+        samples = x.sample(n)
+    with profiling.phase('model'):
+        return UnweightedSamples([fcn(x_) for x_ in samples])
+
 def get_state(session_id):
     """
     Get the system state for the session's model.
@@ -296,13 +881,13 @@ def get_state(session_id):
                     'cov': sessions[session_id].state_est.x.cov.tolist(),
                 }
         elif mode == 'uncertain_data':
-            return pickle.dumps({
+            return _pickle({
                 "time": sessions[session_id].state_est.t,
                 "state": sessions[session_id].state_est.x
                 })
         else:
             abort(400, f'Invalid return mode: {mode}')
-        return jsonify({
+        return _json({
             "time": sessions[session_id].state_est.t,
             "state": state})
 
@@ -329,26 +914,23 @@ def get_output(session_id):
             x = sessions[session_id].state_est.x.mean
             z = sessions[session_id].model.output(x)
         elif mode == 'metrics':
-            x = sessions[session_id].state_est.x.sample(100)
-            z = UnweightedSamples([sessions[session_id].model.output(x_) for x_ in x])
+            z = _sample_through(sessions[session_id].state_est.x, sessions[session_id].model.output)
             z = z.metrics()
         elif mode == 'multivariate_norm':
-            x = sessions[session_id].state_est.x.sample(100)
-            z = UnweightedSamples([sessions[session_id].model.output(x_) for x_ in x])
+            z = _sample_through(sessions[session_id].state_est.x, sessions[session_id].model.output)
             z = {
                     'mean': z.mean,
                     'cov': z.cov.tolist()
                 }
         elif mode == 'uncertain_data':
-            x = sessions[session_id].state_est.x.sample(100)
-            z = UnweightedSamples([sessions[session_id].model.output(x_) for x_ in x])
-            return pickle.dumps({
+            z = _sample_through(sessions[session_id].state_est.x, sessions[session_id].model.output)
+            return _pickle({
                 "time": sessions[session_id].state_est.t,
                 "output": z})
         else:
             abort(400, f'Invalid return mode: {mode}')
 
-        return jsonify({
+        return _json({
             "time": sessions[session_id].state_est.t,
             "output": z})
 
@@ -375,26 +957,23 @@ def get_event_state(session_id):
             x = sessions[session_id].state_est.x.mean
             es = sessions[session_id].model.event_state(x)
         elif mode == 'metrics':
-            x = sessions[session_id].state_est.x.sample(100)
-            es = UnweightedSamples([sessions[session_id].model.event_state(x_) for x_ in x])
+            es = _sample_through(sessions[session_id].state_est.x, sessions[session_id].model.event_state)
             es = es.metrics()
         elif mode == 'multivariate_norm':
-            x = sessions[session_id].state_est.x.sample(100)
-            es = UnweightedSamples([sessions[session_id].model.event_state(x_) for x_ in x])
+            es = _sample_through(sessions[session_id].state_est.x, sessions[session_id].model.event_state)
             es = {
                     'mean': es.mean,
                     'cov': es.cov.tolist()
                 }
         elif mode == 'uncertain_data':
-            x = sessions[session_id].state_est.x.sample(100)
-            es = UnweightedSamples([sessions[session_id].model.event_state(x_) for x_ in x])
-            return pickle.dumps({
+            es = _sample_through(sessions[session_id].state_est.x, sessions[session_id].model.event_state)
+            return _pickle({
                 "time": sessions[session_id].state_est.t,
                 "event_state": es})
         else:
             abort(400, f'Invalid return mode: {mode}')
 
-        return jsonify({
+        return _json({
             "time": sessions[session_id].state_est.t,
             "event_state": es})
 
@@ -421,29 +1000,112 @@ def get_perf_metrics(session_id):
             x = sessions[session_id].state_est.x.mean
             pm = sessions[session_id].model.observables(x)
         elif mode == 'metrics':
-            x = sessions[session_id].state_est.x.sample(100)
-            es = UnweightedSamples([sessions[session_id].model.observables(x_) for x_ in x])
+            es = _sample_through(sessions[session_id].state_est.x, sessions[session_id].model.observables)
             pm = es.metrics()
         elif mode == 'multivariate_norm':
-            x = sessions[session_id].state_est.x.sample(100)
-            es = UnweightedSamples([sessions[session_id].model.observables(x_) for x_ in x])
+            es = _sample_through(sessions[session_id].state_est.x, sessions[session_id].model.observables)
             pm = {
                     'mean': es.mean,
                     'cov': es.cov.tolist()
                 }
         elif mode == 'uncertain_data':
-            x = sessions[session_id].state_est.x.sample(100)
-            pm = UnweightedSamples([sessions[session_id].model.observables(x_) for x_ in x])
-            return pickle.dumps({
+            pm = _sample_through(sessions[session_id].state_est.x, sessions[session_id].model.observables)
+            return _pickle({
                 "time": sessions[session_id].state_est.t,
                 "performance_metrics": pm})
         else:
             abort(400, f'Invalid return mode: {mode}') 
 
-        return jsonify({
+        return _json({
             "time": sessions[session_id].state_est.t,
             "performance_metrics": pm})
 
+def _npz(prediction, prediction_time):
+    # Stream a PredictionArrays as a .npz file (return_format npz)
+    if not isinstance(prediction, PredictionArrays):
+        abort(400, 'Return format npz is only supported for sample-based predictions')
+    return Response(prediction.iter_npz(prediction_time=prediction_time), mimetype='application/octet-stream')
+
+def _cached_rendering(view):
+    """
+    Cache the compressed responses of a prediction view for each session, until the prediction results change
+    """
+    @wraps(view)
+    def wrapper(session_id):
+        session = sessions.get(session_id)
+        results = None if session is None else session.results
+        if results is None or _is_streamed():
+            return view(session_id)
+
+        encoding = compression.negotiate(request)
+        key = (request.full_path, encoding)
+        cache = session.render_cache
+        if cache['results'] is not results:
+            cache = session.render_cache = {'results': results}
+        if key in cache:
+            (data, mimetype, content_encoding) = cache[key]
+            response = Response(data, mimetype=mimetype)
+            if content_encoding is not None:
+                response.headers['Content-Encoding'] = content_encoding
+            return response
+
+        response = compression.compress_response(make_response(view(session_id)), encoding)
+        # Only compressed renderings are cached (small ones are cheap to render), and not those of spilled results, which are as large
+        if response.status_code == 200 and not response.is_streamed and 'Content-Encoding' in response.headers and not _spilled(results) and len(cache) <= RENDER_CACHE_SIZE:
+            cache[key] = (response.get_data(), response.mimetype, response.headers['Content-Encoding'])
+        return response
+    return wrapper
+
+def _spilled(results):
+    # If any prediction results are spilled to disk (see prediction_arrays.spill)
+    for name in ('states', 'outputs', 'event_states'):
+        arrays = results[1][name]
+        if isinstance(arrays, prediction_arrays.LazyArrays):
+            arrays = arrays.arrays  # None if not converted yet
+        if getattr(arrays, 'path', None) is not None:
+            return True
+    return False
+
+def _is_streamed():
+    return request.args.get('stream', '').lower() in ('1', 'true')
+
+def _stream_prediction(prediction, mode, prediction_time):
+    """
+    Stream a prediction one time at a time, so the full response is never built in memory.
+
+    JSON return formats are streamed as NDJSON: a first line with the prediction_time, then one line per time ({"time": ..., "state": ...}). Values are computed in blocks of STREAM_BLOCK_SIZE times. uncertain_data is streamed as consecutive pickles in the same layout, each time with the samples at that time.
+    """
+    if mode == 'uncertain_data':
+        def generate():
+            yield pickle.dumps({'prediction_time': prediction_time})
+            for (i, t) in enumerate(prediction.times):
+                yield pickle.dumps({'time': t, 'state': prediction.snapshot(i)})
+        return Response(generate(), mimetype='application/octet-stream')
+
+    if mode not in ('mean', 'metrics', 'multivariate_norm'):
+        abort(400, f'Invalid return mode: {mode}')
+
+    def generate():
+        yield app.json.dumps({'prediction_time': prediction_time}) + '\n'
+        for start in range(0, len(prediction), STREAM_BLOCK_SIZE):
+            for entry in _render_prediction(prediction.slice(start, start + STREAM_BLOCK_SIZE), mode):
+                yield app.json.dumps(entry) + '\n'
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+def _render_prediction(prediction, mode):
+    # Render a PredictionArrays (or PredictionView) for a JSON return format. Returns None if mode is not a JSON format
+    with profiling.phase('reduce'):
+        if mode == 'mean':
+            values = prediction.means()
+        elif mode == 'metrics':
+            values = prediction.metrics()
+        elif mode == 'multivariate_norm':
+            values = prediction.mvn()
+        else:
+            return None
+    return [{'time': t, 'state': value} for (t, value) in zip(prediction.times, values)]
+
+@_cached_rendering
 def get_predicted_states(session_id):
     """
     Get the predicted states for the session's model.
@@ -467,35 +1129,25 @@ def get_predicted_states(session_id):
         
         states = sessions[session_id].results[1]['states']
 
-        if mode == 'mean':
-            states = [{
-                'time': states.times[i],
-                'state': states.snapshot(i).mean
-             } for i in range(len(states.times))]
-        elif mode == 'metrics':
-            states = [{
-                'time': states.times[i],
-                'state': states.snapshot(i).metrics()
-             } for i in range(len(states.times))]
-        elif mode == 'multivariate_norm':
-            states = [{
-                'time': states.times[i],
-                'state': {
-                    'mean': states.snapshot(i).mean,
-                    'cov': states.snapshot(i).cov.tolist()
-                }
-             } for i in range(len(states.times))]
-        elif mode == 'uncertain_data':
-            return pickle.dumps({
+        if _is_streamed():
+            return _stream_prediction(states, mode, sessions[session_id].results[1]['time'])
+
+        if mode == 'uncertain_data':
+            return _pickle({
                 "prediction_time": sessions[session_id].results[1]['time'],
-                "states": states})
-        else:
+                "states": states.to_prediction()})
+        if mode == 'npz':
+            return _npz(states, sessions[session_id].results[1]['time'])
+
+        result = _render_prediction(states, mode)
+        if result is None:
             abort(400, f'Invalid return mode: {mode}') 
         
-        return jsonify({
+        return _json({
             "prediction_time": sessions[session_id].results[1]['time'],
-            "states": states})
+            "states": result})
 
+@_cached_rendering
 def get_predicted_output(session_id):
     """
     Get the predicted outputs for the session's model.
@@ -517,41 +1169,27 @@ def get_predicted_output(session_id):
         if sessions[session_id].results is None:
             abort(400, 'No Completed Prediction')
         
-        zs = sessions[session_id].results[1]['outputs']
+        zs = prediction_arrays.resolve(sessions[session_id].results[1]['outputs'])
 
-        if mode == 'mean':
-            outputs = [{
-                'time': zs.times[i],
-                'state': zs.snapshot(i).mean
-             } for i in range(len(zs.times))]
-        elif mode == 'metrics':
-            outputs = [{
-                'time': zs.times[i],
-                'state': zs.snapshot(i).metrics()
-             } for i in range(len(zs.times))]
-        elif mode == 'multivariate_norm':
-            outputs = [{
-                'time': zs.times[i],
-                'state': {
-                    'mean': zs.snapshot(i).mean,
-                    'cov': zs.snapshot(i).cov.tolist()
-                }
-             } for i in range(len(zs.times))]
-        elif mode == 'uncertain_data':
-            if isinstance(zs, UnweightedSamplesPrediction) and isinstance(zs[0], LazySimResult):
-                # LazySimResult is un-pickleable in prog_models v1.2.2, so we need to convert it to a SimResult
-                zs2 = [SimResult(output.times, output.data) for output in zs]
-                zs = UnweightedSamplesPrediction(zs.times, zs2)
-            return pickle.dumps({
+        if _is_streamed():
+            return _stream_prediction(zs, mode, sessions[session_id].results[1]['time'])
+
+        if mode == 'uncertain_data':
+            return _pickle({
                 'prediction_time': sessions[session_id].results[1]['time'],
-                'outputs': zs})
-        else:
+                'outputs': zs.to_prediction()})
+        if mode == 'npz':
+            return _npz(zs, sessions[session_id].results[1]['time'])
+
+        outputs = _render_prediction(zs, mode)
+        if outputs is None:
             abort(400, f'Invalid return mode: {mode}')
 
-        return jsonify({
+        return _json({
             "prediction_time": sessions[session_id].results[1]['time'],
             "outputs": outputs})
 
+@_cached_rendering
 def get_predicted_event_state(session_id):
     """
     Get the predicted event state for the session's model.
@@ -573,41 +1211,27 @@ def get_predicted_event_state(session_id):
         if sessions[session_id].results is None:
             abort(400, 'No Completed Prediction')
         
-        es = sessions[session_id].results[1]['event_states']
+        es = prediction_arrays.resolve(sessions[session_id].results[1]['event_states'])
 
-        if mode == 'mean':
-            event_states = [{
-                'time': es.times[i],
-                'state': es.snapshot(i).mean
-             } for i in range(len(es.times))]
-        elif mode == 'metrics':
-            event_states = [{
-                'time': es.times[i],
-                'state': es.snapshot(i).metrics()
-             } for i in range(len(es.times))]
-        elif mode == 'multivariate_norm':
-            event_states = [{
-                'time': es.times[i],
-                'state': {
-                    'mean': es.snapshot(i).mean,
-                    'cov': es.snapshot(i).cov.tolist()
-                }
-             } for i in range(len(es.times))]
-        elif mode == 'uncertain_data':
-            if isinstance(es, UnweightedSamplesPrediction) and isinstance(es[0], LazySimResult):
-                # LazySimResult is un-pickleable in prog_models v1.2.2, so we need to convert it to a SimResult
-                es2 = [SimResult(event_state.times, event_state.data) for event_state in es]
-                es = UnweightedSamplesPrediction(es.times, es2)
-            return pickle.dumps({
+        if _is_streamed():
+            return _stream_prediction(es, mode, sessions[session_id].results[1]['time'])
+
+        if mode == 'uncertain_data':
+            return _pickle({
                 'prediction_time': sessions[session_id].results[1]['time'],
-                'event_states': es})
-        else:
+                'event_states': es.to_prediction()})
+        if mode == 'npz':
+            return _npz(es, sessions[session_id].results[1]['time'])
+
+        event_states = _render_prediction(es, mode)
+        if event_states is None:
             abort(400, f'Invalid return mode: {mode}')
 
-        return jsonify({
+        return _json({
             "prediction_time": sessions[session_id].results[1]['time'],
             "event_states": event_states})
 
+@_cached_rendering
 def get_predicted_perf_metrics(session_id):
     """
     Get the predicted performance metrics for the session's model.
@@ -630,17 +1254,20 @@ def get_predicted_perf_metrics(session_id):
             abort(400, 'No Completed Prediction')
         
         states = sessions[session_id].results[1]['states']
+        model = sessions[session_id].model
 
         if mode == 'mean':
-            pm = [{
-                'time': states.times[i],
-                'state': sessions[session_id].model.observables(states.snapshot(i).mean)
-             } for i in range(len(states.times))]
+            with profiling.phase('reduce'):
+                means = states.means()
+            with profiling.phase('model'):
+                pm = [{
+                    'time': t,
+                    'state': model.observables(model.StateContainer(x))
+                } for (t, x) in zip(states.times, means)]
         elif mode == 'metrics':
             pm = list()
             for i in range(len(states.times)):
-                samples = states.snapshot(i).sample(100)
-                samples = UnweightedSamples([sessions[session_id].model.observables(x_) for x_ in samples])
+                samples = _sample_through(states.snapshot(i), model.observables)
                 pm.append({
                     'time': states.times[i],
                     'state': samples.metrics()
@@ -648,8 +1275,7 @@ def get_predicted_perf_metrics(session_id):
         elif mode == 'multivariate_norm':
             pm = list()
             for i in range(len(states.times)):
-                samples = states.snapshot(i).sample(100)
-                samples = UnweightedSamples([sessions[session_id].model.observables(x_) for x_ in samples])
+                samples = _sample_through(states.snapshot(i), model.observables)
                 pm.append({
                     'time': states.times[i],
                     'state': {
@@ -660,20 +1286,20 @@ def get_predicted_perf_metrics(session_id):
         elif mode == 'uncertain_data':
             pm = list()
             for i in range(len(states.times)):
-                samples = states.snapshot(i).sample(100)
-                samples = UnweightedSamples([sessions[session_id].model.observables(x_) for x_ in samples])
+                samples = _sample_through(states.snapshot(i), model.observables)
                 pm.append(samples)
             
-            return pickle.dumps({
+            return _pickle({
                 "prediction_time": sessions[session_id].results[1]['time'],
                 "performance_metrics": Prediction(states.times, pm)})
         else:
             abort(400, f'Invalid return mode: {mode}')
         
-        return jsonify({
+        return _json({
             "prediction_time": sessions[session_id].results[1]['time'],
             "performance_metrics": pm})
 
+@_cached_rendering
 def get_predicted_toe(session_id):
     """
     Get the predicted Time of Event (ToE) for the session's model.
@@ -705,25 +1331,55 @@ def get_predicted_toe(session_id):
                 'cov': sessions[session_id].results[1]['time of event'].cov.tolist()
             }
         elif mode == 'uncertain_data':
-            return pickle.dumps({
+            return _pickle({
                 "prediction_time": sessions[session_id].results[1]['time'],
-                'time_of_event': sessions[session_id].results[1]['time of event']})
+                'time_of_event': sessions[session_id].results[1]['time of event'],
+                'truncated': sessions[session_id].results[1]['truncated']})
         else:
             abort(400, f'Invalid return mode: {mode}')
 
-        return jsonify({
+        return _json({
             "prediction_time": sessions[session_id].results[1]['time'],
-            "time_of_event": toe})
+            "time_of_event": toe,
+            "truncated": sessions[session_id].results[1]['truncated']})
+
+def get_prediction_history(session_id):
+    """
+    Get the summaries of the session's recent predictions (ToE statistics, number of samples, and duration), for tracking ToE convergence over time.
+
+    Args:
+        session_id: The session ID.
+        (query) start: Earliest prediction time (i.e., time of state predicted from)
+        (query) end: Latest prediction time
+
+    Returns:
+        Columns of prediction summaries, oldest first
+    """
+    if session_id not in sessions:
+        abort(400, f'Session {session_id} does not exist or has ended')
+
+    try:
+        (start, end) = (request.args.get(key, None) for key in ('start', 'end'))
+        start = None if start is None else float(start)
+        end = None if end is None else float(end)
+    except ValueError:
+        abort(400, 'start and end must be numbers')
+
+    app.logger.debug(f"Get prediction history for session {session_id}")
+    return jsonify(sessions[session_id].history.query(start, end))
 
 def get_model(session_id):
     if session_id not in sessions:
         abort(400, f'Session {session_id} does not exist or has ended')
     
     mode = request.args.get('return_format', 'json')
+    model = sessions[session_id].model
+    key = sessions[session_id].model_key
 
+    # Renderings are shared between sessions with the same model configuration
     if mode == 'json':
-        return sessions[session_id].model.to_json()
+        return rendering(key, model, 'json', model.to_json)
     elif mode == 'pickle':
-        return pickle.dumps(sessions[session_id].model)
+        return rendering(key, model, 'pickle', lambda: pickle.dumps(model))
     else:
         abort(400, f'Invalid return mode: {mode}')
@@ -0,0 +1,79 @@
+# Copyright © 2021 United States Government as represented by the Administrator of the
+# National Aeronautics and Space Administration.  All Rights Reserved.
+
+"""
+Loading of historical data for backfilling sessions (see Session.backfill).
+
+Supported formats:
+    * csv: Header row with column names (time, and each input and output of the model), then one row per time
+    * npz: NumPy .npz file with one 1-D array per column
+    * npy: NumPy .npy file with a structured array, with one field per column
+"""
+
+import csv
+import io
+import numpy as np
+
+FORMATS = ('csv', 'npz', 'npy')
+
+def _columns_csv(data):
+    text = io.StringIO(data.decode('utf-8-sig'))
+    header = [name.strip() for name in next(csv.reader(text), [])]
+    values = np.loadtxt(text, delimiter=',', ndmin=2)
+    if values.size > 0 and values.shape[1] != len(header):
+        raise ValueError(f'CSV rows have {values.shape[1]} values, but the header has {len(header)} columns')
+    return {name: values[:, i] for (i, name) in enumerate(header)}
+
+def _columns_npz(data):
+    with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+        return {name: arrays[name] for name in arrays.files}
+
+def _columns_npy(data):
+    array = np.load(io.BytesIO(data), allow_pickle=False)
+    if array.dtype.names is None:
+        raise ValueError('npy data must be a structured array, with one field per column')
+    return {name: array[name] for name in array.dtype.names}
+
+def load_records(data, fmt, inputs, outputs):
+    """
+    Load historical data
+
+    Args:
+        data (bytes): File contents
+        fmt (str): Format, one of FORMATS
+        inputs (list[str]): Inputs of the model
+        outputs (list[str]): Outputs of the model
+
+    Returns:
+        tuple:
+            | list[float]: Times, in increasing order
+            | list[dict]: Inputs at each time
+            | list[dict]: Outputs at each time
+
+    Raises:
+        ValueError: If the data is invalid or is missing columns
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Invalid format {fmt}. Supported formats: {', '.join(FORMATS)}")
+    try:
+        columns = {'csv': _columns_csv, 'npz': _columns_npz, 'npy': _columns_npy}[fmt](data)
+    except Exception as e:
+        raise ValueError(f'Could not read {fmt} data: {e}')
+
+    missing = [key for key in ['time'] + list(inputs) + list(outputs) if key not in columns]
+    if len(missing) > 0:
+        raise ValueError(f'Data missing columns {missing}. Expected time, inputs: {list(inputs)} and outputs: {list(outputs)}')
+    try:
+        columns = {key: np.asarray(columns[key], dtype=float).reshape(-1) for key in ['time'] + list(inputs) + list(outputs)}
+    except ValueError as e:
+        raise ValueError(f'Data must be numeric: {e}')
+    if len({len(column) for column in columns.values()}) > 1:
+        raise ValueError('All columns must have the same length')
+
+    # Sorted by time (stable, so records at the same time keep their order)
+    order = np.argsort(columns['time'], kind='stable')
+    columns = {key: column[order].tolist() for (key, column) in columns.items()}
+    times = columns['time']
+    input_values = [{key: columns[key][i] for key in inputs} for i in range(len(times))]
+    output_values = [{key: columns[key][i] for key in outputs} for i in range(len(times))]
+    return (times, input_values, output_values)
@@ -0,0 +1,288 @@
+# Copyright © 2021 United States Government as represented by the Administrator of the
+# National Aeronautics and Space Administration.  All Rights Reserved.
+
+"""
+Vectorized MonteCarlo prediction for several sessions sharing a model and predictor (see prediction_handler.predict_batch).
+
+The samples of every session in a batch are stacked as columns of one state matrix and simulated together, one vectorized model step at a time, instead of one Python-level simulation per sample. Each column keeps its own time, save times, and remaining events, so the results follow the semantics of progpy's MonteCarlo.predict (simulate_to_threshold for each event, in turn): the same save times, time of event at the first step an event's threshold is met, and the state at the final event not saved. Results are split back per session as PredictionArrays.
+
+Only configurations this reproduces are batched (see supports). Others are predicted per session by the predictor.
+
+A session's columns are dropped from the simulation when it is cancelled, or when the batch reaches its time limit, so a session that never reaches its event (e.g., with no load) can't hold up the others.
+"""
+
+from copy import deepcopy
+import numpy as np
+from numbers import Number
+from time import monotonic
+from prog_server.models.prediction_arrays import PredictionArrays
+from progpy.predictors import MonteCarlo
+from progpy.uncertain_data import UnweightedSamples
+
+DEFAULT_N_SAMPLES = 100  # Matches progpy MonteCarlo default when state is not UnweightedSamples
+DEFAULT_SAVE_FREQ = 10.0  # Matches progpy simulate_to_threshold default
+INITIAL_CAPACITY = 16  # Initial number of saved times per sample. Doubled as needed
+
+def _step_mode(params):
+    # (mode, dt) as in simulate_to_threshold, or None if not supported (e.g., dt is a function)
+    dt = params.get('dt', ('auto', 1.0))
+    if isinstance(dt, Number) and not isinstance(dt, bool):
+        return ('constant', float(dt))
+    if isinstance(dt, tuple) and len(dt) == 2 and dt[0] in ('auto', 'constant') and isinstance(dt[1], Number):
+        return (dt[0], float(dt[1]))
+    if dt == 'constant':
+        return ('constant', 1.0)
+    if dt == 'auto':
+        return ('auto', np.inf)
+    return None
+
+def _save_freq(params):
+    # (origin, step) of save times. origin None means each simulate_to_threshold call starts its own grid (save_freq not set)
+    save_freq = params.get('save_freq', None)
+    if save_freq is None:
+        return (None, DEFAULT_SAVE_FREQ)
+    if isinstance(save_freq, tuple):
+        return (float(save_freq[0]), float(save_freq[1]))
+    return ('t0', float(save_freq))
+
+def supports(session):
+    """
+    Check if predictions for a session can be batched
+
+    Returns:
+        bool: If the session's prediction can be computed by simulate
+    """
+    pred = getattr(session, 'pred', None)  # Not set yet for predictions queued while the session is built
+    if type(pred) is not MonteCarlo or not session.model.is_vectorized or not hasattr(session.load_est, 'batch'):
+        return False
+    if session.pred_deadline is not None or session.cancel_superseded or session.cprofile_next:
+        # Need cancellable (chunked) prediction, or cProfile of the predictor
+        return False
+    params = pred.parameters
+    save_freq = params.get('save_freq', None)
+    return (
+        _step_mode(params) is not None and
+        (save_freq is None or isinstance(save_freq, Number) or (isinstance(save_freq, tuple) and len(save_freq) == 2)) and
+        params.get('event_strategy', 'all') in ('all', 'first', 'any') and
+        not params.get('constant_noise', False) and
+        len(params.get('save_pts', [])) == 0 and
+        len(params.get('eval_pts', [])) == 0 and
+        'integration_method' not in params and
+        'thresholds_met_eqn' not in params)
+
+def sample_matrix(model, x, n_samples=None):
+    """
+    Get the samples a MonteCarlo prediction starts from, as a matrix (states x samples)
+
+    Args:
+        model (PrognosticsModel): Model
+        x (UncertainData): State
+        n_samples (int, optional): Number of samples (predictor n_samples parameter)
+
+    Returns:
+        np.ndarray: Samples
+    """
+    if not (isinstance(x, UnweightedSamples) and (n_samples is None or len(x) == n_samples)):
+        x = x.sample(n_samples or DEFAULT_N_SAMPLES)
+    return np.array([[sample[key] for sample in x] for key in model.states], dtype=float).reshape(len(model.states), -1)
+
+def _rows(values, keys, n):
+    # Matrix (keys x n) from a container or dict of (vectorized) values
+    return np.array([np.broadcast_to(np.asarray(values[key], dtype=float), (n,)) for key in keys]).reshape(len(keys), n)
+
+class _Simulation():
+    # State of a batched simulation. Columns are samples of all sessions
+    def __init__(self, model, params, starts):
+        self.model = model
+        self.events = list(params.get('events', None) or model.events)
+        self.first_only = params.get('event_strategy', 'all') in ('first', 'any')
+        (self.mode, self.dt) = _step_mode(params)
+        (origin, self.save_step) = _save_freq(params)
+
+        self.x = np.concatenate([x for (x, _) in starts], axis=1)
+        n = self.x.shape[1]
+        self.t = np.concatenate([np.full(x.shape[1], t0, dtype=float) for (x, t0) in starts])
+        self.horizon = self.t + params.get('horizon', np.inf)
+        # Save grid origin for each column. NaN: grid starts at the beginning of each segment
+        if origin is None:
+            self.origin = np.full(n, np.nan)
+        elif origin == 't0':
+            self.origin = self.t.copy()
+        else:
+            self.origin = np.full(n, origin)
+        self.remaining = np.ones((n, len(self.events)), dtype=bool)
+        self.toe = np.full((n, len(self.events)), np.nan)
+        self.reported = np.zeros((n, len(self.events)), dtype=bool)  # If event is in time of event (reached, or None at horizon)
+        self.active = np.ones(n, dtype=bool)
+
+        self.values = np.empty((n, INITIAL_CAPACITY, len(model.states)))
+        self.times = np.empty((n, INITIAL_CAPACITY))
+        self.counts = np.zeros(n, dtype=np.int64)
+        self.last_saved = np.full(n, np.nan)
+
+        columns = np.arange(n)
+        self.save(columns)
+        self.next_save = self._first_save(columns)
+        if len(self.events) == 0:
+            self.resolve(columns[self.t >= self.horizon])
+
+    def _first_save(self, columns):
+        # Next save time at the start of a segment (as itertools.count in simulate_to_threshold, skipping the current time)
+        t = self.t[columns]
+        origin = np.where(np.isnan(self.origin[columns]), t, self.origin[columns])
+        return np.maximum(origin, t - np.mod(t - origin, self.save_step)) + self.save_step
+
+    def save(self, columns):
+        if len(columns) == 0:
+            return
+        if self.counts[columns].max() >= self.values.shape[1]:
+            capacity = 2*self.values.shape[1]
+            self.values = np.concatenate([self.values, np.empty_like(self.values)], axis=1)[:, :capacity]
+            self.times = np.concatenate([self.times, np.empty_like(self.times)], axis=1)[:, :capacity]
+        self.values[columns, self.counts[columns]] = self.x[:, columns].T
+        self.times[columns, self.counts[columns]] = self.t[columns]
+        self.counts[columns] += 1
+        self.last_saved[columns] = self.t[columns]
+
+    def thresholds(self, columns):
+        # Remaining events met by each column (columns x events)
+        met = self.model.threshold_met(self.model.StateContainer(self.x[:, columns]))
+        return _rows(met, self.events, len(columns)).T.astype(bool) & self.remaining[columns]
+
+    def resolve(self, columns, met=None):
+        # End segments of columns that met an event or reached the horizon, as MonteCarlo does between simulate_to_threshold calls
+        if met is None:
+            met = np.zeros((len(columns), len(self.events)), dtype=bool)
+        while len(columns) > 0:
+            # Horizon
+            horizon = ~met.any(axis=1)
+            ended = columns[horizon]
+            self.save(ended[self.last_saved[ended] != self.t[ended]])
+            self.reported[ended] |= self.remaining[ended]
+            self.active[ended] = False
+            (columns, met) = (columns[~horizon], met[~horizon])
+            if len(columns) == 0:
+                break
+
+            # First event met (in order of events)
+            event = np.argmax(met, axis=1)
+            self.toe[columns, event] = self.t[columns]
+            self.reported[columns, event] = True
+            # State at event is removed from the results (if saved on the save grid)
+            self.counts[columns[self.last_saved[columns] == self.t[columns]]] -= 1
+            if self.first_only:
+                self.remaining[columns] = False
+            else:
+                self.remaining[columns, event] = False
+            done = ~self.remaining[columns].any(axis=1)
+            self.active[columns[done]] = False
+            columns = columns[~done]
+
+            # Next segment, starting from the state at event. At the horizon, it ends without a step
+            self.save(columns)
+            self.next_save[columns] = self._first_save(columns)
+            columns = columns[self.t[columns] >= self.horizon[columns]]
+            if len(columns) > 0:
+                met = self.thresholds(columns)
+
+    def step(self, load_batches):
+        columns = np.flatnonzero(self.active)
+        t = self.t[columns]
+        if self.mode == 'constant':
+            dt = np.full(len(columns), self.dt)
+        else:
+            gap = self.next_save[columns] - t
+            dt = np.where(gap > 0, np.minimum(self.dt, gap), self.dt)
+
+        # Load at midpoint of step, from each session's load estimator
+        t_load = t + dt/2
+        u = np.empty((len(self.model.inputs), len(columns)))
+        for (start, stop, load_batch) in load_batches:
+            selected = np.flatnonzero((columns >= start) & (columns < stop))
+            for value in np.unique(t_load[selected]):
+                where = selected[t_load[selected] == value]
+                u[:, where] = load_batch(value, self.x[:, columns[where]])
+
+        # Columns with the same step size are stepped together
+        for value in np.unique(dt):
+            where = np.flatnonzero(dt == value)
+            x = self.model.StateContainer(self.x[:, columns[where]])
+            x = self.model.next_state(x, self.model.InputContainer(u[:, where]), value)
+            if not isinstance(x, self.model.StateContainer):
+                x = self.model.StateContainer(x)
+            x = self.model.apply_limits(self.model.apply_process_noise(x, value))
+            self.x[:, columns[where]] = _rows(x, self.model.states, len(where))
+        self.t[columns] = t + dt
+
+        due = columns[self.t[columns] >= self.next_save[columns]]
+        self.next_save[due] += self.save_step
+        self.save(due)
+
+        met = self.thresholds(columns)
+        ended = met.any(axis=1) | (self.t[columns] >= self.horizon[columns])
+        self.resolve(columns[ended], met[ended])
+
+    def results(self, start, stop):
+        # Results for the columns of one session
+        lengths = self.counts[start:stop].copy()
+        n_times = int(lengths.max()) if len(lengths) > 0 else 0
+        times = self.times[start + int(np.argmax(lengths)), :n_times].tolist() if n_times > 0 else []
+        valid = np.arange(n_times)[None, :] < lengths[:, None]
+        states = np.full((stop - start, n_times, len(self.model.states)), np.nan)
+        states[valid] = self.values[start:stop, :n_times][valid]
+
+        # Outputs and event states of all saved states at once
+        flat = states[valid].T
+        derived = []
+        for (fcn, keys) in ((self.model.output, self.model.outputs), (self.model.event_state, self.model.events)):
+            values = np.full((stop - start, n_times, len(keys)), np.nan)
+            if flat.shape[1] > 0:
+                values[valid] = _rows(fcn(self.model.StateContainer(flat)), keys, flat.shape[1]).T
+            derived.append(PredictionArrays(times, keys, values, lengths.copy()))
+
+        toe = UnweightedSamples([
+            {event: (None if np.isnan(self.toe[c, j]) else float(self.toe[c, j]))
+                for (j, event) in enumerate(self.events) if self.reported[c, j]}
+            for c in range(start, stop)])
+        return (toe, PredictionArrays(times, self.model.states, states, lengths), derived[0], derived[1])
+
+def simulate(model, params, starts, load_batches, cancelled=None, time_limit=None):
+    """
+    Run a MonteCarlo prediction for several sessions together
+
+    Args:
+        model (PrognosticsModel): Model shared by the sessions. Must be vectorized
+        params (dict): Predictor parameters shared by the sessions (see supports)
+        starts (list[tuple]): For each session, samples (matrix, states x samples, see sample_matrix) and time to predict from
+        load_batches (list[Callable]): For each session, batched load estimator f(t, x) -> load matrix (see load_ests.build_load_est)
+        cancelled (list[Callable], optional): For each session, function returning True if its prediction was cancelled. Checked at every step
+        time_limit (float, optional): Wall-clock time (s) after which sessions that have not completed are stopped. None for no limit
+
+    Returns:
+        list[tuple]: For each session, time of event (UnweightedSamples), and states, outputs, and event states (PredictionArrays), or None if it was stopped (cancelled, or not complete by the time limit)
+    """
+    params = deepcopy(params)
+    simulation = _Simulation(model, params, starts)
+    bounds = np.cumsum([0] + [x.shape[1] for (x, _) in starts])
+    batches = [(bounds[i], bounds[i+1], load_batch) for (i, load_batch) in enumerate(load_batches)]
+    deadline = None if time_limit is None else monotonic() + time_limit
+    stopped = [False]*len(starts)
+
+    def stop(i):
+        stopped[i] = True
+        simulation.active[bounds[i]:bounds[i+1]] = False
+
+    while simulation.active.any():
+        if cancelled is not None:
+            for (i, is_cancelled) in enumerate(cancelled):
+                if not stopped[i] and is_cancelled():
+                    stop(i)
+            if not simulation.active.any():
+                break
+        if deadline is not None and monotonic() > deadline:
+            for i in range(len(starts)):
+                if simulation.active[bounds[i]:bounds[i+1]].any():
+                    stop(i)
+            break
+        simulation.step(batches)
+    return [None if stopped[i] else simulation.results(bounds[i], bounds[i+1]) for i in range(len(starts))]
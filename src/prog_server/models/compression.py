@@ -0,0 +1,141 @@
+# Copyright © 2021 United States Government as represented by the Administrator of the
+# National Aeronautics and Space Administration.  All Rights Reserved.
+
+"""
+Compression of responses (negotiated with the Accept-Encoding header) and of request bodies (Content-Encoding header).
+
+gzip is always supported. zstd is also supported if the optional zstandard package is installed.
+"""
+
+import io
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge, UnsupportedMediaType
+from werkzeug.wsgi import get_input_stream
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+min_size = 1024  # Minimum size (bytes) of responses that are compressed
+max_request_size = 256 * 2**20  # Maximum size (bytes) of decompressed request bodies
+
+# Supported encodings, in order of preference
+ENCODINGS = ('zstd', 'gzip') if zstandard is not None else ('gzip',)
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+class DataTooLarge(ValueError):
+    """
+    Decompressed data is larger than the maximum size
+    """
+
+def negotiate(request):
+    """
+    Get the encoding to use for the response to a request
+
+    Returns:
+        str: Encoding, or None if the client does not accept any supported encoding
+    """
+    return request.accept_encodings.best_match(ENCODINGS)
+
+def _compressor(encoding):
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)  # wbits=31: gzip container
+
+def compress(data, encoding):
+    compressor = _compressor(encoding)
+    return compressor.compress(data) + compressor.flush()
+
+def _flush_block(compressor, encoding):
+    # Flush what was compressed so far, without ending the stream
+    if encoding == 'zstd':
+        return compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+    return compressor.flush(zlib.Z_SYNC_FLUSH)
+
+def _compress_chunks(chunks, encoding):
+    # Each chunk is flushed, so the client can decompress (e.g., a streamed prediction) as it is received
+    compressor = _compressor(encoding)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        data = compressor.compress(chunk) + _flush_block(compressor, encoding)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def decompress(data, encoding, max_size=None):
+    """
+    Decompress data
+
+    Raises:
+        DataTooLarge: If the data decompresses to more than max_size bytes
+        ValueError: If the data is invalid
+    """
+    max_size = max_request_size if max_size is None else max_size
+    try:
+        if encoding == 'zstd':
+            with zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data)) as reader:
+                result = reader.read(max_size + 1)
+        else:
+            decompressor = zlib.decompressobj(31)
+            result = decompressor.decompress(data, max_size + 1)
+    except (zlib.error, getattr(zstandard, 'ZstdError', zlib.error)) as e:
+        raise ValueError(f'Invalid {encoding} data: {e}')
+    if len(result) > max_size:
+        raise DataTooLarge(f'Decompressed data larger than {max_size} bytes')
+    return result
+
+def compress_response(response, encoding):
+    """
+    Compress a response with encoding, if it is successful and large enough (or streamed)
+
+    Args:
+        response (flask.Response): Response
+        encoding (str): Encoding (from negotiate), or None for no compression
+
+    Returns:
+        flask.Response: The response
+    """
+    response.vary.add('Accept-Encoding')
+    if encoding is None or response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+    if response.is_streamed:
+        response.response = _compress_chunks(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        response.set_data(compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+class RequestDecompressor():
+    """
+    WSGI middleware decompressing request bodies with a Content-Encoding, before they are parsed
+
+    Args:
+        app (Callable): WSGI application
+    """
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get('HTTP_CONTENT_ENCODING', 'identity').strip().lower()
+        if encoding == 'identity':
+            return self.app(environ, start_response)
+        if encoding not in ENCODINGS:
+            return UnsupportedMediaType(f"Unsupported Content-Encoding {encoding}. Supported: {', '.join(ENCODINGS)}")(environ, start_response)
+        try:
+            data = decompress(get_input_stream(environ).read(), encoding)
+        except DataTooLarge as e:
+            return RequestEntityTooLarge(str(e))(environ, start_response)
+        except ValueError as e:
+            return BadRequest(str(e))(environ, start_response)
+        environ['wsgi.input'] = io.BytesIO(data)
+        environ['CONTENT_LENGTH'] = str(len(data))
+        del environ['HTTP_CONTENT_ENCODING']
+        return self.app(environ, start_response)
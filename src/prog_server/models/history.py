@@ -0,0 +1,117 @@
+# Copyright © 2021 United States Government as represented by the Administrator of the
+# National Aeronautics and Space Administration.  All Rights Reserved.
+
+import numpy as np
+from progpy.uncertain_data import UnweightedSamples
+from threading import Lock
+
+PERCENTILES = (5, 50, 95)
+STATS = ('mean',) + tuple(f'p{p}' for p in PERCENTILES)
+N_SAMPLES_NON_SAMPLED = 1000  # Number of samples used to compute statistics of ToE distributions that are not samples (e.g., MultivariateNormalDist)
+
+def toe_stats(toe, events):
+    """
+    Get statistics of a time of event distribution
+
+    Args:
+        toe (UncertainData): Time of event
+        events (list[str]): Events
+
+    Returns:
+        np.ndarray: Statistics, shape (len(events), len(STATS)). NaN where no sample reached the event
+    """
+    if not isinstance(toe, UnweightedSamples):
+        toe = toe.sample(N_SAMPLES_NON_SAMPLED)
+    values = np.array(
+        [[np.nan if sample[event] is None else sample[event] for event in events] for sample in toe],
+        dtype=float).reshape(-1, len(events))
+    stats = np.full((len(events), len(STATS)), np.nan)
+    reached = ~np.all(np.isnan(values), axis=0)
+    if np.any(reached):
+        stats[reached, 0] = np.nanmean(values[:, reached], axis=0)
+        stats[reached, 1:] = np.nanpercentile(values[:, reached], PERCENTILES, axis=0).T
+    return stats
+
+class PredictionHistory():
+    """
+    Bounded history of per-prediction summaries, stored in preallocated arrays used as a ring buffer. When full, the oldest entry is overwritten.
+
+    Args:
+        events (list[str]): Events of the model
+        capacity (int, optional): Maximum number of predictions kept. Defaults to 100
+    """
+    def __init__(self, events, capacity=100):
+        self.events = list(events)
+        self.capacity = max(int(capacity), 1)
+        self._timestamp = np.empty(self.capacity)
+        self._prediction_time = np.empty(self.capacity)
+        self._duration = np.empty(self.capacity)
+        self._n_samples = np.empty(self.capacity, dtype=np.int64)
+        self._truncated = np.empty(self.capacity, dtype=bool)
+        self._toe = np.empty((self.capacity, len(self.events), len(STATS)))
+        self._next = 0
+        self._count = 0
+        self._lock = Lock()
+
+    def __len__(self):
+        return self._count
+
+    def append(self, timestamp, prediction_time, duration, toe, truncated=False):
+        """
+        Add the summary of a prediction
+
+        Args:
+            timestamp (float): Wall time prediction completed (s since epoch)
+            prediction_time (float): Time of the state the prediction was from
+            duration (float): Prediction duration (s)
+            toe (UncertainData): Time of event
+            truncated (bool, optional): If the prediction was truncated
+        """
+        stats = toe_stats(toe, self.events)
+        n_samples = len(toe) if isinstance(toe, UnweightedSamples) else 0
+        with self._lock:
+            i = self._next
+            self._timestamp[i] = timestamp
+            self._prediction_time[i] = prediction_time
+            self._duration[i] = duration
+            self._n_samples[i] = n_samples
+            self._truncated[i] = truncated
+            self._toe[i] = stats
+            self._next = (i + 1) % self.capacity
+            self._count = min(self._count + 1, self.capacity)
+
+    def query(self, start=None, end=None):
+        """
+        Get the summaries of predictions from states between start and end (inclusive), oldest first
+
+        Args:
+            start (float, optional): Earliest prediction time
+            end (float, optional): Latest prediction time
+
+        Returns:
+            dict: Columns of prediction summaries
+        """
+        with self._lock:
+            index = (self._next - self._count + np.arange(self._count)) % self.capacity
+            prediction_time = self._prediction_time[index]
+            keep = np.ones(len(index), dtype=bool)
+            if start is not None:
+                keep &= prediction_time >= start
+            if end is not None:
+                keep &= prediction_time <= end
+            index = index[keep]
+            toe = self._toe[index]
+            result = {
+                'prediction_time': self._prediction_time[index].tolist(),
+                'timestamp': self._timestamp[index].tolist(),
+                'duration': self._duration[index].tolist(),
+                'n_samples': self._n_samples[index].tolist(),
+                'truncated': self._truncated[index].tolist()}
+
+        # NaN is not valid JSON- events not reached are None
+        result['time_of_event'] = {
+            event: {
+                stat: [None if np.isnan(value) else value for value in toe[:, i, j].tolist()]
+                for (j, stat) in enumerate(STATS)}
+            for (i, event) in enumerate(self.events)}
+        return result
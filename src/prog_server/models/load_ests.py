@@ -1,23 +1,91 @@
 # Copyright © 2021 United States Government as represented by the Administrator of the
 # National Aeronautics and Space Administration.  All Rights Reserved.
 
+from bisect import bisect_left
 from flask import abort
 from functools import partial
+import numpy as np
 from numpy.random import normal
-from statistics import mean
+from threading import RLock
+
+extra_load_estimators = {}
+
+class PiecewiseLoad():
+    """
+    Piecewise load profile compiled from a Variable load estimator configuration into sorted breakpoints, so the load at a time is found by bisection instead of a scan over the configuration.
+
+    Args:
+        cfg (dict): Variable load estimator configuration (see Variable)
+    """
+    INTERPOLATION_MODES = ('step', 'linear')
+
+    def __init__(self, cfg):
+        self.interpolation = cfg.get('interpolation', 'step')
+        if self.interpolation not in PiecewiseLoad.INTERPOLATION_MODES:
+            raise ValueError(f"Invalid interpolation {self.interpolation}, must be one of {PiecewiseLoad.INTERPOLATION_MODES}")
+
+        segments = sorted((float(time), load) for (time, load) in cfg.items() if time != 'interpolation')
+        if len(segments) == 0:
+            raise ValueError("Load profile must have at least one segment")
+        self.breakpoints = [time for (time, _) in segments]
+        self.loads = [load for (_, load) in segments]
+        self.inputs = list(self.loads[0].keys())
+        self.values = np.array([[load[key] for key in self.inputs] for load in self.loads], dtype=float)
+        self._times = np.array(self.breakpoints)
+
+    def __call__(self, t):
+        # Segment i applies for breakpoints[i] < t <= breakpoints[i+1] (i.e., t is not in segment i at exactly breakpoints[i])
+        i = bisect_left(self.breakpoints, t) - 1
+        if i < 0:
+            return self.loads[0]
+        if self.interpolation == 'step' or i == len(self.breakpoints) - 1:
+            return self.loads[i]
+        ratio = (t - self.breakpoints[i])/(self.breakpoints[i+1] - self.breakpoints[i])
+        return {key: self.values[i, j] + ratio * (self.values[i+1, j] - self.values[i, j]) for (j, key) in enumerate(self.inputs)}
+
+    def at(self, times):
+        """
+        Get the load at each of an array of times
+
+        Args:
+            times (array[float]): Times
+
+        Returns:
+            np.ndarray: Loads, shape (len(times), len(inputs)), with columns in the order of self.inputs
+        """
+        times = np.asarray(times, dtype=float)
+        if self.interpolation == 'linear':
+            return np.stack([np.interp(times, self._times, self.values[:, j]) for j in range(len(self.inputs))], axis=-1)
+        i = np.searchsorted(self._times, times, side='left') - 1
+        return self.values[np.clip(i, 0, len(self.breakpoints) - 1)]
 
 def Variable(t, x=None, session=None, cfg=None):
     """Variable (i.e. piecewise) load estimator. The piecewise load function is defined in the load_est_cfg as ordered dictionary starting_time: load. 
 
-    cfg: ordered dictionary starting_time: load. First key should always be 0
+    cfg: dictionary starting_time: load. First key should always be 0
         e.g., {'0': {'u1': 0.1}, '100': {'u1': 0.2}, '300': {'u1': 0.3}, '500': {'u1': 0.0}}
+        Optionally, cfg can include 'interpolation': 'step' (default) or 'linear' (linear between starting times)
+        The cfg is compiled into a PiecewiseLoad when the load estimator is built
     """
-    keys = list(cfg.keys())
-    keys.reverse()
-    for time in keys:
-        if t > float(time):
-            return cfg[time]
-    return cfg[keys[-1]]
+    if not isinstance(cfg, PiecewiseLoad):
+        cfg = PiecewiseLoad(cfg)
+    return cfg(t)
+
+def _n_samples(x):
+    # Number of samples (columns) in a sample matrix (ndarray or container with a matrix attribute)
+    return np.shape(getattr(x, 'matrix', x))[-1]
+
+def _broadcast(load, x, session):
+    # Load (dict) repeated for each sample, as a matrix with rows in the order of model.inputs
+    column = np.array([load[key] for key in session.model.inputs], dtype=float).reshape(-1, 1)
+    return np.repeat(column, _n_samples(x), axis=1)
+
+def _variable_batch(t, x, session=None, cfg=None):
+    if not isinstance(cfg, PiecewiseLoad):
+        cfg = PiecewiseLoad(cfg)
+    return _broadcast(cfg(t), x, session)
+
+Variable.batch = _variable_batch
 
 def Const(t, x=None, session=None, cfg=None):
     """Constant load estimator. Load is assumed to be constant over time. 
@@ -27,29 +95,281 @@ def Const(t, x=None, session=None, cfg=None):
     """
     return cfg['load']
 
+def _const_batch(t, x, session=None, cfg=None):
+    return _broadcast(cfg['load'], x, session)
+
+Const.batch = _const_batch
+
+class MovingAverageBuffer():
+    """
+    Ring buffer of recent inputs with running sums, so the moving average (and variance) is updated in O(1) per sample. The window is either the last `window_size` samples or, if `window_time` is set, the samples within `window_time` seconds of the latest.
+
+    Updates are serialized by the buffer's lock, so data can be sent concurrently (e.g., send_data requests for the same session). Hold `lock` to make several calls atomic
+
+    Args:
+        inputs (list[str]): Input names
+        window_size (int, optional): Number of samples in window. Defaults to 10
+        window_time (float, optional): Length of window in seconds. Overrides window_size
+    """
+    INITIAL_CAPACITY = 16  # Initial capacity for time-based windows, which grow as needed
+
+    def __init__(self, inputs, window_size=10, window_time=None):
+        self.inputs = list(inputs)
+        self.lock = RLock()
+        self._values = np.empty((0, len(self.inputs)))
+        self._times = np.empty(0)
+        self._start = 0
+        self._count = 0
+        self.configure(window_size, window_time)
+
+    def configure(self, window_size=10, window_time=None):
+        """
+        Change the window, keeping the most recent samples that fit in it
+        """
+        with self.lock:
+            (values, times) = self._ordered()
+            self.window_size = max(int(window_size), 1)
+            self.window_time = window_time
+            if window_time is None:
+                values, times = values[-self.window_size:], times[-self.window_size:]
+                capacity = self.window_size
+            else:
+                capacity = max(MovingAverageBuffer.INITIAL_CAPACITY, 2*len(times))
+            self._reset(values, times, capacity)
+            if window_time is not None and self._count > 0:
+                self._evict_older_than(self._times[(self._start + self._count - 1) % capacity] - window_time)
+
+    def __len__(self):
+        with self.lock:
+            return self._count
+
+    def append(self, u, t=None):
+        """
+        Add a sample
+
+        Args:
+            u (dict): Input values
+            t (float, optional): Time of the sample. Required for time-based windows
+        """
+        with self.lock:
+            capacity = len(self._times)
+            if self.window_time is None and self._count == self.window_size:
+                self._pop()
+            elif self._count == capacity:
+                # Time-based window is full- grow
+                (values, times) = self._ordered()
+                self._reset(values, times, 2*capacity)
+                capacity = len(self._times)
+
+            i = (self._start + self._count) % capacity
+            row = self._values[i]
+            for (j, key) in enumerate(self.inputs):
+                row[j] = u[key]
+            self._times[i] = np.nan if t is None else t
+            self._count += 1
+            self._sum += row
+            self._sumsq += row*row
+
+            if self.window_time is not None and t is not None:
+                self._evict_older_than(t - self.window_time)
+
+            # Running sums accumulate rounding error- recompute exactly once per buffer length (amortized O(1))
+            self._updates += 1
+            if self._updates >= capacity:
+                self._recompute()
+            self._update_mean()
+
+    def variance(self):
+        """
+        Get the variance of each input in the window
+
+        Returns:
+            dict: Variance of each input
+        """
+        with self.lock:
+            if self._count == 0:
+                raise ValueError("No inputs received for moving average")
+            mean = self._sum/self._count
+            var = np.maximum(self._sumsq/self._count - mean*mean, 0)
+        return {key: float(var[j]) for (j, key) in enumerate(self.inputs)}
+
+    def _pop(self):
+        row = self._values[self._start]
+        self._sum -= row
+        self._sumsq -= row*row
+        self._start = (self._start + 1) % len(self._times)
+        self._count -= 1
+
+    def _evict_older_than(self, t):
+        while self._count > 0 and self._times[self._start] < t:
+            self._pop()
+
+    def _ordered(self):
+        # Samples in the window, oldest first
+        index = (self._start + np.arange(self._count)) % max(len(self._times), 1)
+        return (self._values[index], self._times[index])
+
+    def _reset(self, values, times, capacity):
+        self._values = np.empty((capacity, len(self.inputs)))
+        self._times = np.empty(capacity)
+        self._values[:len(times)] = values
+        self._times[:len(times)] = times
+        self._start = 0
+        self._count = len(times)
+        self._recompute()
+        self._update_mean()
+
+    def _recompute(self):
+        (values, _) = self._ordered()
+        self._sum = values.sum(axis=0)
+        self._sumsq = (values*values).sum(axis=0)
+        self._updates = 0
+
+    def _update_mean(self):
+        # Mean only changes when samples are added, so it is computed here rather than in the load estimator
+        if self._count == 0:
+            self.mean = None
+        else:
+            self.mean = {key: float(self._sum[j]/self._count) for (j, key) in enumerate(self.inputs)}
+
+class NoiseBlock():
+    """
+    Source of standard normal noise, generated in large blocks and consumed by index, replacing one random number generator call per value.
+
+    Args:
+        seed (int, optional): Seed. If provided, reset() restarts the same noise sequence, so predictions are reproducible
+    """
+    BLOCK_SIZE = 8192
+
+    def __init__(self, seed=None):
+        self.seed = seed
+        self.reset()
+
+    def reset(self):
+        """
+        Restart the noise sequence (if seeded). Called at the start of each prediction
+        """
+        if self.seed is not None or not hasattr(self, '_rng'):
+            self._rng = np.random.default_rng(self.seed)
+            self._block = np.empty(0)
+            self._index = 0
+
+    def take(self, n):
+        """
+        Get the next n standard normal values
+
+        Returns:
+            np.ndarray: Noise values
+        """
+        if self._index + n > len(self._block):
+            self._block = self._rng.standard_normal(max(NoiseBlock.BLOCK_SIZE, n))
+            self._index = 0
+        values = self._block[self._index:self._index+n]
+        self._index += n
+        return values
+
+class MovingAverageCfg(dict):
+    """
+    Compiled MovingAverage load estimator configuration. Same as the configuration dict, with the noise source for the load estimator
+    """
+    def __init__(self, cfg):
+        super().__init__(cfg)
+        seed = cfg.get('seed', None)
+        self.noise = NoiseBlock(None if seed is None else int(seed))
+
+    def reset(self):
+        self.noise.reset()
+
+def _noise(cfg, n):
+    # Standard normal noise from the compiled configuration, if available
+    if isinstance(cfg, MovingAverageCfg):
+        return cfg.noise.take(n)
+    return normal(size=n)
+
 def MovingAverage(t, x=None, session=None, cfg=None):
-    """Moving average load estimator. Load is estimated as the mean of the last `window_size` samples. Noise can be added using the following optional configuration parameters:
+    """Moving average load estimator. Load is estimated as the mean of the last `window_size` samples (default 10), or of the samples in the last `window_time` seconds, if provided. Noise can be added using the following optional configuration parameters:
 
         * base_std: standard deviation of noise
         * std_slope: Increase in std with time (e.g., 0.1 = increase of 0.1 in std per second)
         * t0: Starting time for calculation of std
 
     std of applied noise is defined as base_std + std_slope (t-t0). By default no noise is added
+
+    Noise is pre-generated in blocks. Optionally, a `seed` can be provided, in which case each prediction uses the same noise sequence (e.g., for regression testing)
     """
+    load = session.moving_avg_loads.mean
+    if load is None:
+        if len(session.model.inputs) == 0:
+            return {}
+        raise ValueError("No inputs received for moving average")
     std = cfg.get('base_std',0)  + cfg.get('std_slope', 0) * (t - cfg.get('t0', 0))
-    load = {key : mean(session.moving_avg_loads[key]) for key in session.model.inputs} 
-    return {key : normal(load[key], std) for key in load.keys()}
+    if std == 0:
+        # No noise - return mean directly (no allocation)
+        return load
+    noise = _noise(cfg, len(load))
+    return {key : load[key] + std * noise[i] for (i, key) in enumerate(load.keys())}
 
-def update_moving_avg(u, session=None, cfg={}):
-    for key in session.model.inputs:
-        session.moving_avg_loads[key].append(u[key])
-        if len(session.moving_avg_loads[key]) > cfg.get('window_size', 10):
-            del session.moving_avg_loads[key][0]  # Remove first item
+def _moving_average_batch(t, x, session=None, cfg=None):
+    load = session.moving_avg_loads.mean
+    if load is None:
+        if len(session.model.inputs) == 0:
+            return np.empty((0, _n_samples(x)))
+        raise ValueError("No inputs received for moving average")
+    std = cfg.get('base_std',0)  + cfg.get('std_slope', 0) * (t - cfg.get('t0', 0))
+    loads = _broadcast(load, x, session)
+    if std != 0:
+        loads += std * _noise(cfg, loads.size).reshape(loads.shape)
+    return loads
+
+MovingAverage.batch = _moving_average_batch
+
+def update_moving_avg(u, session=None, cfg={}, t=None):
+    buffer = session.moving_avg_loads
+    window_size = cfg.get('window_size', 10)
+    window_time = cfg.get('window_time', None)
+    with buffer.lock:
+        if window_size != buffer.window_size or window_time != buffer.window_time:
+            buffer.configure(window_size, window_time)
+        buffer.append(u, t)
+
+# Built-in load estimators. Extended with extra_load_estimators
+load_estimators = {
+    'Variable': Variable,
+    'Const': Const,
+    'MovingAverage': MovingAverage
+}
+
+# Load estimators with configurations compiled once when the load estimator is built
+COMPILERS = {
+    'Variable': PiecewiseLoad,
+    'MovingAverage': MovingAverageCfg
+}
 
 def build_load_est(name, cfg, session):
-    if name not in globals():
+    """
+    Build the load estimator used in prediction.
+
+    Load estimators are functions f(t, x=None, session=None, cfg=None) -> load (dict). A load estimator can optionally provide a batched form as the attribute `batch`, f(t, x, session=None, cfg=None) -> load matrix, where x is a sample matrix (states x samples) and the load matrix is (inputs x samples), with rows in the order of model.inputs. If present, it is available as the `batch` attribute of the built load estimator, so predictors that support it can avoid per-sample calls.
+    """
+    if name in extra_load_estimators:
+        load_est_fcn = extra_load_estimators[name]
+    elif name in load_estimators:
+        load_est_fcn = load_estimators[name]
+    else:
         abort(400, f"{name} is not a valid load estimation method")
-    load_est_fcn = globals()[name]
-    return partial(load_est_fcn,
+    if name in COMPILERS and name not in extra_load_estimators:
+        try:
+            cfg = COMPILERS[name](cfg)
+        except (ValueError, TypeError, AttributeError, KeyError) as e:
+            abort(400, f"Invalid configuration for load estimator {name}: {e}")
+    load_est = partial(load_est_fcn,
         cfg=cfg,
         session=session)
+    if hasattr(load_est_fcn, 'batch'):
+        load_est.batch = partial(load_est_fcn.batch,
+            cfg=cfg,
+            session=session)
+    if hasattr(cfg, 'reset'):
+        # Called at the start of each prediction
+        load_est.reset = cfg.reset
+    return load_est
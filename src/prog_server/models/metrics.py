@@ -0,0 +1,168 @@
+# Copyright © 2021 United States Government as represented by the Administrator of the
+# National Aeronautics and Space Administration.  All Rights Reserved.
+
+"""
+Operational metrics, exposed in the Prometheus text format.
+
+Metrics are updated from request and pool threads, so each metric's updates are serialized by its own (uncontended in the common case) lock, and no updates are lost.
+"""
+
+from bisect import bisect_left
+from math import inf
+from threading import Lock
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, inf)
+
+def _format_labels(names, values):
+    if len(names) == 0:
+        return ''
+    labels = ','.join(f'{name}="{value}"' for (name, value) in zip(names, values))
+    return '{' + labels + '}'
+
+def _format_value(value):
+    if value == inf:
+        return '+Inf'
+    return repr(float(value))
+
+class Counter():
+    """
+    Monotonically increasing count (e.g., number of requests)
+
+    Args:
+        name (str): Metric name
+        description (str): Description (HELP)
+        labels (tuple[str], optional): Label names
+    """
+    type = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._values = {}
+        self._lock = Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for (label_values, value) in values:
+            yield (self.name, _format_labels(self.labels, label_values), value)
+
+class Gauge():
+    """
+    Value that can go up and down. Either set directly (inc/dec) or computed when metrics are collected (callback)
+
+    Args:
+        name (str): Metric name
+        description (str): Description (HELP)
+        callback (Callable, optional): Function returning the value, or a dict of label value (tuple): value if labels are given
+        labels (tuple[str], optional): Label names
+    """
+    type = 'gauge'
+
+    def __init__(self, name, description, callback=None, labels=()):
+        self.name = name
+        self.description = description
+        self.callback = callback
+        self.labels = labels
+        self.value = 0
+        self._lock = Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def samples(self):
+        if self.callback is None:
+            yield (self.name, '', self.value)
+        elif len(self.labels) == 0:
+            yield (self.name, '', self.callback())
+        else:
+            for (label_values, value) in self.callback().items():
+                yield (self.name, _format_labels(self.labels, label_values), value)
+
+class Histogram():
+    """
+    Distribution of observed values (e.g., durations in seconds)
+
+    Args:
+        name (str): Metric name
+        description (str): Description (HELP)
+        labels (tuple[str], optional): Label names
+        buckets (tuple[float], optional): Upper bounds of buckets. Must be sorted and end with inf
+    """
+    type = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}  # label values -> [bucket counts, sum]
+        self._lock = Lock()
+
+    def observe(self, value, *label_values):
+        bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None:
+                entry = self._values[label_values] = [[0] * len(self.buckets), 0.0]
+            entry[0][bucket] += 1
+            entry[1] += value
+
+    def samples(self):
+        with self._lock:
+            values = [(label_values, (list(counts), total)) for (label_values, (counts, total)) in self._values.items()]
+        for (label_values, (counts, total)) in values:
+            cumulative = 0
+            for (bound, count) in zip(self.buckets, counts):
+                cumulative += count
+                yield (self.name + '_bucket', _format_labels(self.labels + ('le',), label_values + (_format_value(bound),)), cumulative)
+            labels = _format_labels(self.labels, label_values)
+            yield (self.name + '_sum', labels, total)
+            yield (self.name + '_count', labels, cumulative)
+
+class Registry():
+    """
+    Collection of metrics, rendered together in the Prometheus text format
+    """
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.description}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for (name, labels, value) in metric.samples():
+                lines.append(f'{name}{labels} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+# Requests
+requests_total = registry.add(Counter('prog_server_requests_total', 'Number of requests', ('route', 'method', 'status')))
+request_duration = registry.add(Histogram('prog_server_request_duration_seconds', 'Request duration', ('route', 'method')))
+
+# State estimation
+estimate_duration = registry.add(Histogram('prog_server_estimate_duration_seconds', 'Duration of state estimation for one data point'))
+estimate_batch_size = registry.add(Histogram('prog_server_estimate_batch_size', 'Number of data points estimated together', buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, inf)))
+
+# Prediction
+prediction_duration = registry.add(Histogram('prog_server_prediction_duration_seconds', 'Duration of prediction'))
+prediction_queue_wait = registry.add(Histogram('prog_server_prediction_queue_wait_seconds', 'Time between a prediction being queued and starting'))
+predictions_total = registry.add(Counter('prog_server_predictions_total', 'Number of predictions by outcome', ('outcome',)))
+prediction_batch_size = registry.add(Histogram('prog_server_prediction_batch_size', 'Number of sessions predicted together', buckets=(1, 2, 5, 10, 20, 50, inf)))
+pool_active = registry.add(Gauge('prog_server_pool_active_workers', 'Number of prediction pool workers currently running'))
@@ -0,0 +1,90 @@
+# Copyright © 2021 United States Government as represented by the Administrator of the
+# National Aeronautics and Space Administration.  All Rights Reserved.
+
+"""
+Interning cache for objects that can be shared between sessions with identical configuration (e.g., models and predictors).
+
+Entries are weakly referenced, so an object is released once the last session using it is deleted.
+
+Renderings of shared objects (e.g., model JSON) are also cached here, so sessions sharing an object share its renderings.
+"""
+
+import hashlib
+import json
+from threading import Lock
+from weakref import finalize, WeakValueDictionary
+
+_cache = WeakValueDictionary()
+_lock = Lock()
+
+# (key, id(obj)) -> {name: rendering}, for objects interned with key. Removed when obj is garbage collected
+_renderings = {}
+
+def config_key(*args):
+    """
+    Get a hash key for a configuration.
+
+    Args:
+        *args: JSON-serializable configuration (e.g., type name and cfg dict)
+
+    Returns:
+        str: Hash of the configuration, or None if the configuration cannot be hashed (i.e., is not JSON-serializable)
+    """
+    try:
+        serialized = json.dumps(args, sort_keys=True)
+    except (TypeError, ValueError):
+        return None
+    return hashlib.sha1(serialized.encode()).hexdigest()
+
+def intern(key, factory):
+    """
+    Get the shared object for key, creating it with factory if none exists.
+
+    Args:
+        key (str): Key from config_key. If None, the object is not cached
+        factory (Callable): Function with no arguments that creates the object
+
+    Returns:
+        Shared object for key
+    """
+    if key is None:
+        return factory()
+    with _lock:
+        obj = _cache.get(key)
+    if obj is not None:
+        return obj
+
+    # Built outside of lock so creation of unrelated objects is not serialized
+    obj = factory()
+    with _lock:
+        # Another thread may have created it in the meantime- use that one
+        return _cache.setdefault(key, obj)
+
+def rendering(key, obj, name, render):
+    """
+    Get a cached rendering (e.g., JSON) of a shared object (e.g., a model). Shared objects are not changed after they are built (see intern), so their renderings are cached until the object is garbage collected.
+
+    Args:
+        key (str): Key the object was interned with (see intern). If None, the object is not shared (and may change), so it is rendered on every call
+        obj: Object
+        name (str): Name of the rendering (e.g., 'json')
+        render (Callable): Function with no arguments that creates the rendering
+
+    Returns:
+        Rendering of obj
+    """
+    if key is None:
+        return render()
+    with _lock:
+        entry = _renderings.get((key, id(obj)))
+        if entry is None:
+            entry = _renderings[(key, id(obj))] = {}
+            finalize(obj, _renderings.pop, (key, id(obj)), None)
+        result = entry.get(name)
+    if result is not None:
+        return result
+
+    # Rendered outside of lock so renderings of unrelated objects are not serialized
+    result = render()
+    with _lock:
+        return entry.setdefault(name, result)
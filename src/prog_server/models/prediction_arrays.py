@@ -0,0 +1,358 @@
+# Copyright © 2021 United States Government as represented by the Administrator of the
+# National Aeronautics and Space Administration.  All Rights Reserved.
+
+"""
+Compact storage of prediction results (e.g., predicted states) for serving the get_predicted_* endpoints.
+
+Sample-based predictions (UnweightedSamplesPrediction) are converted once, when the prediction completes, into a dense array (samples x times x keys). Snapshot statistics are then computed with vectorized reductions along the sample axis. Other predictions are wrapped in a PredictionView with the same interface. Results that are often never queried (outputs and event states, which progpy computes from the states) are kept as a LazyArrays, and converted when first used (see resolve).
+
+If spill_dir is set, arrays of at least spill_threshold bytes are written to memory-mapped files in spill_dir, so only a handle to the file is kept in memory. The file is removed when the arrays are no longer used.
+"""
+
+import io
+import numpy as np
+import os
+import tempfile
+from threading import Lock
+import warnings
+import weakref
+import zipfile
+from progpy.predictors import UnweightedSamplesPrediction
+from progpy.sim_result import SimResult
+from progpy.uncertain_data import UnweightedSamples
+
+# Percentiles reported in metrics (name, numerator, denominator), as in progpy's calc_metrics:
+# order statistic at index n*numerator//denominator, only when there are at least denominator samples
+PERCENTILES = (('0.01', 1, 10000), ('0.1', 1, 1000), ('1', 1, 100), ('10', 1, 10), ('25', 1, 4), ('50', 1, 2), ('75', 3, 4))
+CHUNK_SIZE = 2**20  # Bytes read from spill files per chunk when streaming
+
+spill_dir = None  # Directory for memory-mapped prediction arrays. None to keep arrays in memory
+spill_threshold = 64 * 2**20  # Minimum size (bytes) of arrays that are spilled
+
+def _none_if_nan(value):
+    value = float(value)
+    return None if np.isnan(value) else value
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+class _ChunkWriter(io.RawIOBase):
+    # Unseekable stream collecting written bytes, so a zip archive can be generated in chunks
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def spill(arrays):
+    """
+    Spill arrays to a memory-mapped file if spilling is enabled and they are large enough
+
+    Args:
+        arrays (PredictionArrays or PredictionView): Arrays
+
+    Returns:
+        PredictionArrays or PredictionView: The same arrays
+    """
+    if spill_dir is not None and isinstance(arrays, PredictionArrays) and arrays.values.nbytes >= spill_threshold:
+        arrays.spill(spill_dir)
+    return arrays
+
+def resolve(arrays):
+    """
+    Get prediction results for a query, converting them if they were deferred
+
+    Args:
+        arrays (PredictionArrays, PredictionView, or LazyArrays): Stored results
+
+    Returns:
+        PredictionArrays or PredictionView: Results
+    """
+    if isinstance(arrays, LazyArrays):
+        return arrays.get()
+    return arrays
+
+class LazyArrays():
+    """
+    Prediction converted (see PredictionArrays.from_prediction) and spilled (see spill) when first used
+
+    Args:
+        prediction (Prediction): Prediction
+    """
+    def __init__(self, prediction):
+        self.prediction = prediction
+        self.arrays = None
+        self.lock = Lock()
+
+    def get(self):
+        with self.lock:
+            if self.arrays is None:
+                self.arrays = spill(PredictionArrays.from_prediction(self.prediction))
+                self.prediction = None
+            return self.arrays
+
+class PredictionArrays():
+    """
+    Sample-based prediction stored as a dense array
+
+    Args:
+        times (array[float]): Prediction times
+        keys (list[str]): Keys (e.g., state names)
+        values (np.ndarray): Values, shape (samples, times, keys). NaN where the sample has ended before the time
+        lengths (np.ndarray): Number of times in each sample
+    """
+    def __init__(self, times, keys, values, lengths):
+        self.times = list(times)
+        self.keys = list(keys)
+        self.key_index = {key: i for (i, key) in enumerate(self.keys)}
+        self.values = values
+        self.lengths = lengths
+        self.path = None  # Path of spill file, if spilled
+
+    @classmethod
+    def from_prediction(cls, prediction):
+        """
+        Convert a prediction to arrays
+
+        Args:
+            prediction (Prediction): Prediction to convert
+
+        Returns:
+            PredictionArrays or PredictionView: PredictionArrays if prediction is sample-based, otherwise a PredictionView of it
+        """
+        if not isinstance(prediction, UnweightedSamplesPrediction) or len(prediction) == 0:
+            return PredictionView(prediction)
+
+        samples = list(prediction)
+        keys = next((list(sample.data[0].keys()) for sample in samples if len(sample.data) > 0), [])
+        lengths = np.array([len(sample.data) for sample in samples], dtype=np.int64)
+        values = np.full((len(samples), len(prediction.times), len(keys)), np.nan)
+        for (i, sample) in enumerate(samples):
+            if lengths[i] > 0:
+                values[i, :lengths[i]] = [[entry[key] for key in keys] for entry in sample.data]
+        return cls(prediction.times, keys, values, lengths)
+
+    def __len__(self):
+        return len(self.times)
+
+    def slice(self, start, stop):
+        """
+        Get the times from index start to stop, without copying values
+
+        Returns:
+            PredictionArrays: Arrays for times[start:stop]
+        """
+        stop = min(stop, len(self.times))
+        lengths = np.clip(self.lengths - start, 0, max(stop - start, 0))
+        return PredictionArrays(self.times[start:stop], self.keys, self.values[:, start:stop], lengths)
+
+    def spill(self, directory):
+        """
+        Move values to a memory-mapped (.npy) file in directory. The file is removed when this object is garbage collected
+
+        Args:
+            directory (str): Directory for the file. Created if it does not exist
+        """
+        if self.path is not None:
+            return
+        os.makedirs(directory, exist_ok=True)
+        (fd, path) = tempfile.mkstemp(prefix='prediction_', suffix='.npy', dir=directory)
+        os.close(fd)
+        weakref.finalize(self, _remove, path)
+        values = np.lib.format.open_memmap(path, mode='w+', dtype=self.values.dtype, shape=self.values.shape)
+        values[:] = self.values
+        values.flush()
+        del values
+        self.values = np.load(path, mmap_mode='r')
+        self.path = path
+
+    def iter_npz(self, **extra):
+        """
+        Generate the arrays as an (uncompressed) .npz file, in chunks. Contains times, keys, lengths, and values (see PredictionArrays). Spilled values are copied from the file in chunks, without being loaded into memory
+
+        Args:
+            **extra: Additional arrays (e.g., prediction_time) to include in the file
+
+        Yields:
+            bytes: Chunks of the .npz file
+        """
+        buffer = _ChunkWriter()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+            fields = tuple((name, np.asarray(value)) for (name, value) in extra.items()) + (
+                ('times', np.asarray(self.times, dtype=float)),
+                ('keys', np.array(self.keys, dtype=str)),
+                ('lengths', self.lengths))
+            for (name, array) in fields:
+                with archive.open(name + '.npy', 'w') as f:
+                    np.lib.format.write_array(f, array, allow_pickle=False)
+                yield buffer.take()
+            with archive.open('values.npy', 'w', force_zip64=True) as f:
+                if self.path is None:
+                    np.lib.format.write_array(f, self.values, allow_pickle=False)
+                else:
+                    # Spill file is already in .npy format
+                    with open(self.path, 'rb') as source:
+                        chunk = source.read(CHUNK_SIZE)
+                        while chunk:
+                            f.write(chunk)
+                            yield buffer.take()
+                            chunk = source.read(CHUNK_SIZE)
+        yield buffer.take()
+
+    def _dict(self, row):
+        return {key: _none_if_nan(value) for (key, value) in zip(self.keys, row)}
+
+    def snapshot(self, i):
+        """
+        Get the samples at time index i (only samples that had not ended)
+
+        Returns:
+            UnweightedSamples: Samples at time index i
+        """
+        valid = self.lengths > i
+        return UnweightedSamples([dict(zip(self.keys, row.tolist())) for row in self.values[valid, i]])
+
+    def _mean(self):
+        # (times, keys)
+        counts = np.maximum((self.lengths[:, None] > np.arange(len(self.times))).sum(axis=0), 1)
+        return np.nansum(self.values, axis=0)/counts[:, None]
+
+    def means(self):
+        """
+        Returns:
+            list[dict]: Mean at each time
+        """
+        return [self._dict(row) for row in self._mean()]
+
+    def mvn(self):
+        """
+        Returns:
+            list[dict]: Mean and covariance at each time
+        """
+        counts = (self.lengths[:, None] > np.arange(len(self.times))).sum(axis=0)
+        mean = self._mean()
+        centered = np.nan_to_num(self.values - mean[None, :, :])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cov = np.einsum('stk,stl->tkl', centered, centered)/(counts - 1)[:, None, None]
+        return [{'mean': self._dict(mean[i]), 'cov': cov[i].tolist()} for i in range(len(self.times))]
+
+    def _geometric_median(self):
+        # Sample closest (sum of squared distances) to all other samples at each time, as in UnweightedSamples.median. (times, keys)
+        valid = self.lengths[:, None] > np.arange(len(self.times))
+        x = np.nan_to_num(self.values)
+        squared = (x**2).sum(axis=2)
+        total = valid.sum(axis=0)*squared + (squared*valid).sum(axis=0) - 2*np.einsum('stk,tk->st', x, (x*valid[:, :, None]).sum(axis=0))
+        total[~valid] = np.inf
+        median = x[np.argmin(total, axis=0), np.arange(len(self.times))]
+        median[~valid.any(axis=0)] = np.nan
+        return median
+
+    def metrics(self):
+        """
+        Returns:
+            list[dict]: Metrics (as in UncertainData.metrics) at each time
+        """
+        # Reductions along sample axis, for all times and keys at once. Ended samples (NaN) sort last
+        ordered = np.sort(self.values, axis=0)
+        counts = (~np.isnan(self.values)).sum(axis=0)
+
+        def order_statistic(numerator, denominator):
+            index = np.minimum(counts*numerator//denominator, max(len(ordered) - 1, 0))
+            return np.take_along_axis(ordered, index[None], axis=0)[0]
+
+        with warnings.catch_warnings():
+            # All-NaN slices (every sample ended) are expected, and give NaN
+            warnings.simplefilter('ignore', RuntimeWarning)
+            mean = np.nanmean(self.values, axis=0)
+            median = order_statistic(1, 2)
+            stats = {
+                'min': ordered[0],
+                'mean': mean,
+                'std': np.nanstd(self.values, axis=0),
+                'max': np.take_along_axis(ordered, np.maximum(counts - 1, 0)[None], axis=0)[0],
+                'median absolute deviation': np.nanmean(np.abs(self.values - median[None]), axis=0),
+                'mean absolute deviation': np.nanmean(np.abs(self.values - mean[None]), axis=0)}
+        percentiles = {
+            name: np.where(counts >= denominator, order_statistic(numerator, denominator), np.nan)
+            for (name, numerator, denominator) in PERCENTILES}
+        # As in UncertainData.metrics, the median is the geometric median
+        percentiles['50'] = geometric_median = self._geometric_median()
+
+        result = []
+        for i in range(len(self.times)):
+            metrics = {}
+            for (j, key) in enumerate(self.keys):
+                metrics[key] = {
+                    'min': _none_if_nan(stats['min'][i, j]),
+                    'percentiles': {name: _none_if_nan(values[i, j]) for (name, values) in percentiles.items()},
+                    'median': _none_if_nan(geometric_median[i, j]),
+                    'mean': _none_if_nan(stats['mean'][i, j]),
+                    'std': _none_if_nan(stats['std'][i, j]),
+                    'max': _none_if_nan(stats['max'][i, j]),
+                    'median absolute deviation': _none_if_nan(stats['median absolute deviation'][i, j]),
+                    'mean absolute deviation': _none_if_nan(stats['mean absolute deviation'][i, j]),
+                    'number of samples': int(counts[i, j])}
+            result.append(metrics)
+        return result
+
+    def to_prediction(self):
+        """
+        Convert back to a progpy prediction (e.g., for the uncertain_data return format)
+
+        Returns:
+            UnweightedSamplesPrediction: Prediction
+        """
+        samples = []
+        for (i, length) in enumerate(self.lengths):
+            data = [dict(zip(self.keys, row)) for row in self.values[i, :length].tolist()]
+            samples.append(SimResult(self.times[:length], data))
+        return UnweightedSamplesPrediction(self.times, samples)
+
+class PredictionView():
+    """
+    Same interface as PredictionArrays, for predictions that are not sample-based (e.g., from UnscentedTransformPredictor)
+
+    Args:
+        prediction (Prediction): Prediction
+    """
+    def __init__(self, prediction, start=0, stop=None):
+        self.prediction = prediction
+        self.start = start
+        self.times = prediction.times[start:stop]
+
+    def __len__(self):
+        return len(self.times)
+
+    def slice(self, start, stop):
+        return PredictionView(self.prediction, self.start + start, self.start + min(stop, len(self.times)))
+
+    def snapshot(self, i):
+        return self.prediction.snapshot(self.start + i)
+
+    def means(self):
+        return [self.snapshot(i).mean for i in range(len(self.times))]
+
+    def mvn(self):
+        result = []
+        for i in range(len(self.times)):
+            snapshot = self.snapshot(i)
+            result.append({'mean': snapshot.mean, 'cov': snapshot.cov.tolist()})
+        return result
+
+    def metrics(self):
+        return [self.snapshot(i).metrics() for i in range(len(self.times))]
+
+    def to_prediction(self):
+        return self.prediction
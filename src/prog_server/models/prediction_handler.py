@@ -1,43 +1,471 @@
 # Copyright © 2021 United States Government as represented by the Administrator of the
 # National Aeronautics and Space Administration.  All Rights Reserved.
 
-from concurrent.futures import ThreadPoolExecutor as PoolExecutor
+from concurrent.futures import Future, ThreadPoolExecutor as PoolExecutor
+from contextlib import ExitStack
 from copy import deepcopy
 from datetime import datetime
 from flask import current_app as app
+from math import ceil
+from functools import partial
+from prog_server.models import batched_prediction, metrics, prediction_arrays, profiling
+from prog_server.models.prediction_arrays import PredictionArrays
+from progpy.predictors import MonteCarlo, UnweightedSamplesPrediction
+from progpy.uncertain_data import UnweightedSamples
+from threading import Lock
+from time import monotonic
+from time import time as wall_time
 
 pool = PoolExecutor(max_workers=5)
+# Pool for what-if scenario predictions (see predict_scenarios). Separate from session predictions, so scoring requests don't wait behind queued session predictions, or delay them
+scenario_pool = PoolExecutor(max_workers=5)
+metrics.registry.add(metrics.Gauge('prog_server_pool_max_workers', 'Number of prediction pool workers', lambda: pool._max_workers))
+
+# Number of sample chunks a cancellable MonteCarlo prediction is split into.
+# Cancellation is checked between chunks, so completed chunks can be returned as a truncated result
+PREDICTION_CHUNKS = 10
+DEFAULT_N_SAMPLES = 100  # Matches progpy MonteCarlo default when state is not UnweightedSamples
+
+# Predictions of sessions sharing a model and predictor are batched into one vectorized simulation (see predict_batch), if supported (see batched_prediction.supports)
+batching = True
+MAX_BATCH_SESSIONS = 64  # Maximum number of sessions predicted together
+# Wall-clock time (s) after which sessions still running in a batch are predicted on their own, so a session that never reaches its event (e.g., with no load) doesn't hold up the others
+BATCH_TIME_LIMIT = 10.0
+_batches = {}  # (id(model), id(predictor)) -> list of (session, future, queued_at) waiting for a batch. Present while a drain task is queued or running
+_batch_lock = Lock()
+
+class PredictionCancelled(Exception):
+    """Raised from within a prediction that was cancelled or exceeded its deadline"""
+    pass
+
+class CancellationToken():
+    """
+    Cooperative cancellation token for a single prediction run.
+
+    Args:
+        deadline (float, optional): Wall-clock time limit for the prediction in seconds. None for no limit.
+    """
+    def __init__(self, deadline=None):
+        self.reason = None
+        self.deadline = None if deadline is None else monotonic() + deadline
+
+    def cancel(self, reason='cancelled'):
+        if self.reason is None:
+            self.reason = reason
+
+    @property
+    def cancelled(self):
+        if self.reason is None and self.deadline is not None and monotonic() > self.deadline:
+            self.reason = 'deadline exceeded'
+        return self.reason is not None
+
+    def check(self):
+        if self.cancelled:
+            raise PredictionCancelled(self.reason)
+
+def _cancellable(load_est, token):
+    # The load estimator is called at every simulation step, so it is where cancellation is checked
+    def future_loading(t, x=None):
+        token.check()
+        return load_est(t, x)
+    if hasattr(load_est, 'batch'):
+        def batch(t, x):
+            token.check()
+            return load_est.batch(t, x)
+        future_loading.batch = batch
+    return future_loading
+
+def _merge(a, b):
+    # Merge two UnweightedSamplesPredictions from separate chunks
+    if a is None:
+        return b
+    times = a.times if len(a.times) >= len(b.times) else b.times
+    return UnweightedSamplesPrediction(times, list(a) + list(b))
+
+def _predict_chunked(session, x, time, load_est, token):
+    # Only MonteCarlo predictions are split into chunks, so only they can return a truncated result: the chunks completed by the deadline.
+    # If no chunk completes by then (e.g., samples never reach their events), the prediction is cancelled without a result, as for other predictors (see _predict_whole)
+    n_samples = session.pred.parameters.get('n_samples', None)
+    if isinstance(x, UnweightedSamples) and n_samples is None:
+        samples = list(x)
+    else:
+        samples = list(x.sample(n_samples or DEFAULT_N_SAMPLES))
+    chunk_size = ceil(len(samples)/PREDICTION_CHUNKS)
+
+    events, states, outputs, event_states = None, None, None, None
+    for i in range(0, len(samples), chunk_size):
+        if token.cancelled:
+            break
+        chunk = UnweightedSamples(samples[i:i+chunk_size])
+        try:
+            (_, _, states_i, outputs_i, event_states_i, events_i) = session.pred.predict(chunk, load_est, t0=time, n_samples=len(chunk))
+        except PredictionCancelled:
+            break
+        events = events_i if events is None else UnweightedSamples(list(events) + list(events_i))
+        states = _merge(states, states_i)
+        outputs = _merge(outputs, outputs_i)
+        event_states = _merge(event_states, event_states_i)
+    return (events, states, outputs, event_states)
 
 # Prediction Function
-def predict(session):
+def predict(session, queued_at=None):
+    metrics.pool_active.inc()
+    with session.locks['futures']:
+        session.update_prediction_status(queued=-1 if queued_at is not None else 0, running=1)
+    error = {}
+    try:
+        if _predict(session, queued_at):
+            metrics.predictions_total.inc('completed')
+        else:
+            metrics.predictions_total.inc('cancelled')
+    except PredictionCancelled:
+        metrics.predictions_total.inc('cancelled')
+        raise
+    except Exception as e:
+        metrics.predictions_total.inc('failed')
+        error = {'error': str(e)}
+        raise
+    finally:
+        with session.locks['futures']:
+            session.update_prediction_status(running=-1, **error)
+        metrics.pool_active.dec()
+
+def _predict_whole(session, x, time, load_est):
+    (_, _, states, outputs, event_states, events) = session.pred.predict(x, load_est, t0=time)
+    return (events, states, outputs, event_states)
+
+def _profiled(session):
+    # If a prediction is profiled: requested for the session (see controllers.set_profiling), or sampled
+    if session.profile_next or session.cprofile_next:
+        session.profile_next = False
+        return True
+    return profiling.is_sampled()
+
+def _predict(session, queued_at):
+    # Returns False if the session was closed before the prediction started
+    if not _profiled(session):
+        return _predict_profiled(session, queued_at, None)
+    profile = profiling.start()
+    try:
+        if not _predict_profiled(session, queued_at, profile):
+            return False
+    finally:
+        profiling.stop()
+    session.prediction_profile = profile.to_dict()
+    return True
+
+def _predict_profiled(session, queued_at, profile):
+    # profile is None if the prediction is not profiled
     with session.locks['execution']:
-        with session.locks['estimate']:
-            x = deepcopy(session.state_est.x)
-            time = session.state_est.t
-        
-        (_, _, states, outputs, event_states, events) = session.pred.predict(x, session.load_est, t0=time)
-
-    with session.locks['results']:
-        session.results = (
-            datetime.now(),
-            {
-                'time': time,
-                'time of event': events,
-                'states': states,
-                'outputs': outputs,
-                'event_states': event_states
-        })
+        if session.closed:
+            return False
+        start = monotonic()
+        if queued_at is not None:
+            metrics.prediction_queue_wait.observe(start - queued_at)
+            if profile is not None:
+                profile.add('queue_wait', start - queued_at)
+        token = CancellationToken(session.pred_deadline)
+        session.pred_token = token
+
+        with profiling.phase('copy_state'):
+            with session.locks['estimate']:
+                x = deepcopy(session.state_est.x)
+                time = session.state_est.t
+
+        if hasattr(session.load_est, 'reset'):
+            session.load_est.reset()
+        load_est = _cancellable(session.load_est, token)
+        chunked = isinstance(session.pred, MonteCarlo) and (session.pred_deadline is not None or session.cancel_superseded)
+        with profiling.phase('predict'):
+            if chunked:
+                run = partial(_predict_chunked, session, x, time, load_est, token)
+            else:
+                run = partial(_predict_whole, session, x, time, load_est)
+            if session.cprofile_next:
+                # Full cProfile output requested for this prediction
+                session.cprofile_next = False
+                ((events, states, outputs, event_states), session.cprofile_stats) = profiling.run_cprofile(run)
+            else:
+                (events, states, outputs, event_states) = run()
+        if events is None:
+            # Cancelled before any chunk completed - keep previous results
+            raise PredictionCancelled(token.reason)
+        duration = monotonic() - start
+        metrics.prediction_duration.observe(duration)
+
+    with profiling.phase('convert'):
+        # Stored as arrays, so queries don't have to convert per request.
+        # Outputs and event states are only computed (by progpy, from the states) and converted if queried
+        states = PredictionArrays.from_prediction(states)
+        outputs = prediction_arrays.LazyArrays(outputs)
+        event_states = prediction_arrays.LazyArrays(event_states)
+    _store_results(session, time, duration, events, states, outputs, event_states, token.reason is not None)
+    return True
+
+def _store_results(session, time, duration, events, states, outputs, event_states, truncated):
+    with profiling.phase('convert'):
+        states = prediction_arrays.spill(states)
+        outputs = prediction_arrays.spill(outputs)
+        event_states = prediction_arrays.spill(event_states)
+
+    with profiling.phase('store_results'):
+        with session.locks['results']:
+            session.results = (
+                datetime.now(),
+                {
+                    'time': time,
+                    'time of event': events,
+                    'states': states,
+                    'outputs': outputs,
+                    'event_states': event_states,
+                    'truncated': truncated
+            })
+
+    timestamp = wall_time()
+    with profiling.phase('summary'):
+        session.update_summary(
+            prediction_time=time,
+            last_prediction=timestamp,
+            time_of_event=events.metrics(),
+            truncated=truncated)
+        with session.locks['futures']:
+            session.update_prediction_status(
+                version=session.prediction_status['version'] + 1,
+                prediction_time=time,
+                last_prediction=timestamp,
+                truncated=truncated)
+    with profiling.phase('history'):
+        session.history.append(timestamp, time, duration, events, truncated)
+
+def predict_batch(entries):
+    """
+    Predict for several sessions sharing a model and predictor together, in one vectorized simulation (see batched_prediction). Results are stored in each session, as by predict. Sessions that fail in the batch (or all of them, if the simulation fails), and sessions not complete within BATCH_TIME_LIMIT, are predicted on their own, so one session does not fail or hold up the others.
+
+    Args:
+        entries (list[tuple]): Session, future (resolved when the prediction is complete), and time queued (monotonic) of each prediction. A session may have more than one entry (e.g., a queued and a superseding prediction), in which case it is predicted once
+    """
+    metrics.pool_active.inc()
+    try:
+        for (session, _, _) in entries:
+            with session.locks['futures']:
+                session.update_prediction_status(queued=-1, running=1)
+        try:
+            (predicted, errors, remaining) = _predict_batch(entries)
+        except Exception:
+            (predicted, errors, remaining) = ([], {}, list(dict.fromkeys(session for (session, _, _) in entries)))
+
+        # Sessions done in the batch are reported before the others are predicted, which may take longer
+        _finish_batch([entry for entry in entries if entry[0] not in remaining], predicted, errors)
+        for session in remaining:
+            try:
+                if _predict(session, None):
+                    predicted.append(session)
+            except Exception as e:
+                errors[session] = e
+        _finish_batch([entry for entry in entries if entry[0] in remaining], predicted, errors)
+    finally:
+        metrics.pool_active.dec()
+
+def _finish_batch(entries, predicted, errors):
+    # Resolve the futures of entries, and count each session's outcome once
+    counted = set()
+    for (session, future, _) in entries:
+        error = errors.get(session)
+        if session in counted:
+            # Predicted by the prediction counted for its first entry
+            metrics.predictions_total.inc('skipped')
+        elif error is None:
+            metrics.predictions_total.inc('completed' if session in predicted else 'cancelled')
+        else:
+            metrics.predictions_total.inc('cancelled' if isinstance(error, PredictionCancelled) else 'failed')
+        counted.add(session)
+        if error is None:
+            future.set_result(None)
+        else:
+            future.set_exception(error)
+        with session.locks['futures']:
+            status_error = {} if error is None or isinstance(error, PredictionCancelled) else {'error': str(error)}
+            session.update_prediction_status(running=-1, **status_error)
+
+def _batch_cancelled(session, token):
+    return session.closed or token.cancelled
+
+def _predict_batch(entries):
+    # Returns the sessions predicted, errors of sessions cancelled while running (PredictionCancelled), and sessions to predict on their own:
+    # those that failed on their own (e.g., sampling their state) or were not complete within BATCH_TIME_LIMIT. Others were closed before the prediction started.
+    # Raises if the batched simulation fails
+    queued_at = {}
+    for (session, _, queued) in entries:
+        queued_at.setdefault(session, queued)
+
+    errors = {}
+    remaining = []
+    with ExitStack() as locks:
+        sessions = []
+        # Locks are always acquired in the same order, so concurrent batches can't deadlock
+        for session in sorted(queued_at, key=id):
+            locks.enter_context(session.locks['execution'])
+            if not session.closed:
+                sessions.append(session)
+
+        start = monotonic()
+        prepared = []
+        profiles = []
+        starts = []
+        tokens = []
+        for session in sessions:
+            try:
+                with session.locks['estimate']:
+                    x = batched_prediction.sample_matrix(session.model, session.state_est.x, session.pred.parameters.get('n_samples', None))
+                    time = session.state_est.t
+                if hasattr(session.load_est, 'reset'):
+                    session.load_est.reset()
+            except Exception:
+                remaining.append(session)
+                continue
+            profile = profiling.Profile() if _profiled(session) else None
+            if profile is not None:
+                profile.add('queue_wait', start - queued_at[session])
+            metrics.prediction_queue_wait.observe(start - queued_at[session])
+            # Batched sessions have no deadline (see batched_prediction.supports), but can be cancelled (see cancel_predictions)
+            token = CancellationToken()
+            session.pred_token = token
+            prepared.append(session)
+            profiles.append(profile)
+            starts.append((x, time))
+            tokens.append(token)
+        if len(prepared) == 0:
+            return ([], errors, remaining)
+
+        results = batched_prediction.simulate(
+            prepared[0].model, prepared[0].pred.parameters, starts, [session.load_est.batch for session in prepared],
+            cancelled=[partial(_batch_cancelled, session, token) for (session, token) in zip(prepared, tokens)],
+            time_limit=BATCH_TIME_LIMIT)
+        duration = monotonic() - start
+        metrics.prediction_duration.observe(duration)
+        metrics.prediction_batch_size.observe(len(prepared))
+
+    predicted = []
+    for (session, profile, token, (_, time), result) in zip(prepared, profiles, tokens, starts, results):
+        if result is None:
+            # Stopped in the simulation
+            if token.cancelled:
+                errors[session] = PredictionCancelled(token.reason)
+            elif not session.closed:
+                remaining.append(session)
+            continue
+        (events, states, outputs, event_states) = result
+        try:
+            if profile is None:
+                _store_results(session, time, duration, events, states, outputs, event_states, False)
+            else:
+                profile.add('predict', duration)
+                profiling.start(profile)
+                try:
+                    _store_results(session, time, duration, events, states, outputs, event_states, False)
+                finally:
+                    profiling.stop()
+                session.prediction_profile = {**profile.to_dict(), 'batch_size': len(prepared)}
+        except Exception:
+            remaining.append(session)
+            continue
+        predicted.append(session)
+    return (predicted, errors, remaining)
+
+def _drain_batch(key):
+    # Predict the sessions waiting for a batch, until none are left
+    while True:
+        with _batch_lock:
+            pending = _batches[key]
+            if len(pending) == 0:
+                del _batches[key]
+                return
+            entries = pending[:MAX_BATCH_SESSIONS]
+            del pending[:MAX_BATCH_SESSIONS]
+        # Skip predictions cancelled while waiting (see cancel_predictions)
+        entries = [entry for entry in entries if entry[1].set_running_or_notify_cancel()]
+        if len(entries) > 0:
+            predict_batch(entries)
+
+def _submit(session):
+    # Queue a prediction for a session. Returns its future
+    if not (batching and batched_prediction.supports(session)):
+        return pool.submit(predict, session, monotonic())
+
+    # Sessions queued with the same model and predictor while a batch is waiting for a worker join that batch
+    future = Future()
+    key = (id(session.model), id(session.pred))
+    with _batch_lock:
+        if key not in _batches:
+            _batches[key] = []
+            pool.submit(_drain_batch, key)
+        _batches[key].append((session, future, monotonic()))
+    return future
+
+def predict_scenarios(session, load_ests):
+    """
+    Predict from the session's current state for each of several load estimators, in parallel on the scenario pool. Results are not stored in the session.
+
+    Args:
+        session (Session): Session to predict for
+        load_ests (list[Callable]): Load estimators, one per scenario
+
+    Returns:
+        tuple:
+            | float: Time of the state predicted from
+            | list[UnweightedSamples or Exception]: Time of event for each scenario, or the exception if it was cancelled (PredictionCancelled) or failed (e.g., invalid load estimator configuration)
+    """
+    with session.locks['estimate']:
+        x = deepcopy(session.state_est.x)
+        time = session.state_est.t
+
+    def run(load_est):
+        # Each scenario gets its own token so a slow scenario does not cancel the others
+        token = CancellationToken(session.pred_deadline)
+        (_, _, _, _, _, events) = session.pred.predict(x, _cancellable(load_est, token), t0=time)
+        return events
+
+    futures = [scenario_pool.submit(run, load_est) for load_est in load_ests]
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            results.append(e)
+    return (time, results)
 
 def add_to_predict_queue(session):
+    if session.closed:
+        return
     with session.locks['futures']:
+        if session.cancel_superseded and session.pred_token is not None:
+            # Newer state supersedes the prediction in progress
+            session.pred_token.cancel('superseded')
         if (session.futures[1] is None) or session.futures[1].done():
             # At least one open slot
             app.logger.debug(f"Performing Prediction for Session {session.session_id}")
             session.futures[1] = session.futures[0]
-            session.futures[0] = pool.submit(predict, session)
+            session.futures[0] = _submit(session)
+            session.update_prediction_status(queued=1)
+            metrics.predictions_total.inc('submitted')
         elif session.futures[0].done():
             # Session 1 finished before 0
             app.logger.debug(f"Performing Prediction for Session {session.session_id}")
-            session.futures[0] = pool.submit(predict, session)
+            session.futures[0] = _submit(session)
+            session.update_prediction_status(queued=1)
+            metrics.predictions_total.inc('submitted')
         else:
             app.logger.debug(f"Prediction skipped for Session {session.session_id}")
+            metrics.predictions_total.inc('skipped')
+
+def cancel_predictions(session):
+    """
+    Cancel all queued and in-progress predictions for a session. Used when the session is deleted.
+    """
+    session.closed = True
+    with session.locks['futures']:
+        for future in session.futures:
+            if future is not None and not future.done() and future.cancel():  # Only succeeds for queued predictions
+                session.update_prediction_status(queued=-1)
+        if session.pred_token is not None:
+            session.pred_token.cancel('session deleted')
@@ -0,0 +1,132 @@
+# Copyright © 2021 United States Government as represented by the Administrator of the
+# National Aeronautics and Space Administration.  All Rights Reserved.
+
+"""
+Opt-in, phase-level profiling of requests and predictions.
+
+A request is profiled if it has the header X-Profile: 1, the query argument profile=1, or is selected at random with probability sample_rate. A prediction is profiled if requested for the session (see controllers.set_profiling), or selected at random with the same probability. Phases are timed with `with phase(name):`, which does nothing when the current thread is not profiling.
+"""
+
+from contextlib import nullcontext
+import cProfile
+import io
+import pstats
+from random import random
+import threading
+from time import perf_counter
+
+sample_rate = 0  # Fraction of requests and predictions profiled without being requested
+
+_local = threading.local()
+_NULL_PHASE = nullcontext()
+
+class Profile():
+    """
+    Timing breakdown (seconds) by phase
+    """
+    def __init__(self):
+        self.start = perf_counter()
+        self.phases = {}
+
+    def add(self, name, duration):
+        self.phases[name] = self.phases.get(name, 0) + duration
+
+    def to_dict(self):
+        return {**self.phases, 'total': perf_counter() - self.start}
+
+    def server_timing(self):
+        """
+        Get the breakdown in the format of a Server-Timing header (durations in ms)
+        """
+        return ', '.join(f'{name};dur={duration*1000:.3f}' for (name, duration) in self.to_dict().items())
+
+class _Phase():
+    __slots__ = ('profile', 'name', 'start')
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+
+    def __exit__(self, *args):
+        self.profile.add(self.name, perf_counter() - self.start)
+
+def phase(name):
+    """
+    Time a phase of the current profile, if any
+
+    Example:
+        with phase('serialize'):
+            result = pickle.dumps(x)
+    """
+    profile = getattr(_local, 'profile', None)
+    if profile is None:
+        return _NULL_PHASE
+    return _Phase(profile, name)
+
+def start(profile=None):
+    """
+    Start profiling in the current thread
+
+    Args:
+        profile (Profile, optional): Profile to continue (e.g., one started before the work was handed to this thread). Defaults to a new profile
+
+    Returns:
+        Profile: The profile
+    """
+    _local.profile = profile or Profile()
+    return _local.profile
+
+def current():
+    """
+    Get the profile of the current thread
+
+    Returns:
+        Profile: The profile, or None if the thread is not profiling
+    """
+    return getattr(_local, 'profile', None)
+
+def stop():
+    """
+    Stop profiling in the current thread
+
+    Returns:
+        Profile: The finished profile, or None if the thread was not profiling
+    """
+    profile = getattr(_local, 'profile', None)
+    _local.profile = None
+    return profile
+
+def is_requested(request):
+    """
+    Check if a request should be profiled
+    """
+    flag = request.headers.get('X-Profile', request.args.get('profile', ''))
+    if flag.lower() in ('1', 'true'):
+        return True
+    return is_sampled()
+
+def is_sampled():
+    """
+    Check if work that was not requested to be profiled is selected at random (see sample_rate)
+    """
+    return sample_rate > 0 and random() < sample_rate
+
+def run_cprofile(fcn, *args, **kwargs):
+    """
+    Run a function with cProfile
+
+    Returns:
+        tuple:
+            | Any: Result of the function
+            | str: cProfile statistics, sorted by cumulative time
+    """
+    profiler = cProfile.Profile()
+    try:
+        result = profiler.runcall(fcn, *args, **kwargs)
+    finally:
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats()
+    return (result, stream.getvalue())
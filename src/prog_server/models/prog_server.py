@@ -2,7 +2,7 @@
 # National Aeronautics and Space Administration.  All Rights Reserved.
 
 from prog_server.app import app
-from prog_server.models import session
+from prog_server.models import compression, session, load_ests, prediction_arrays, prediction_handler, profiling
 
 from multiprocessing import Process
 import requests
@@ -19,7 +19,7 @@ class ProgServer():
     def __init__(self):
         self.process = None
 
-    def run(self, host=DEFAULT_HOST, port=DEFAULT_PORT, debug=False, models={}, predictors={}, state_estimators={}, **kwargs) -> None:
+    def run(self, host=DEFAULT_HOST, port=DEFAULT_PORT, debug=False, models={}, predictors={}, state_estimators={}, load_estimators={}, profile_sample_rate=0, spill_dir=None, spill_threshold=64*2**20, compress_min_size=1024, batch_predictions=True, **kwargs) -> None:
         """Run the server (blocking)
 
         Keyword Args:
@@ -29,6 +29,12 @@ class ProgServer():
             models (dict[str, PrognosticsModel]): a dictionary of extra models to consider. The key is the name used to identify it.
             predictors (dict[str, predictors.Predictor]): a dictionary of extra predictors to consider. The key is the name used to identify it.
             state_estimators (dict[str, state_estimators.StateEstimator]): a dictionary of extra estimators to consider. The key is the name used to identify it.
+            load_estimators (dict[str, function]): a dictionary of extra load estimators to consider. The key is the name used to identify it. Load estimators are functions f(t, x=None, session=None, cfg=None) -> load, optionally with a batched form as attribute `batch` (see load_ests.build_load_est)
+            profile_sample_rate (float, optional): Fraction of requests profiled without being requested (see models.profiling). Defaults to 0
+            spill_dir (str, optional): Directory where large prediction results are written as memory-mapped files instead of being kept in memory (see models.prediction_arrays). Defaults to None (results kept in memory)
+            spill_threshold (int, optional): Minimum size (bytes) of prediction results written to spill_dir. Defaults to 64 MiB
+            compress_min_size (int, optional): Minimum size (bytes) of responses compressed for clients that accept compression (see models.compression). Defaults to 1024
+            batch_predictions (bool, optional): If predictions of sessions sharing a model and predictor are computed together in one vectorized simulation, where supported (see models.batched_prediction). Defaults to True
         """
         if not isinstance(models, dict):
             raise TypeError("Extra models (`model` arg in prog_server.run() or start()) must be in a dictionary in the form `name: model_name`")
@@ -45,6 +51,20 @@ class ProgServer():
 
         session.extra_estimators.update(state_estimators)
 
+        if not isinstance(load_estimators, dict):
+            raise TypeError("Custom Load Estimators (`load_estimators` arg in prog_server.run() or start()) must be in a dictionary in the form `name: load_est_fcn`")
+
+        load_ests.extra_load_estimators.update(load_estimators)
+
+        profiling.sample_rate = profile_sample_rate
+
+        prediction_arrays.spill_dir = spill_dir
+        prediction_arrays.spill_threshold = spill_threshold
+
+        compression.min_size = compress_min_size
+
+        prediction_handler.batching = batch_predictions
+
         self.host = host
         self.port = port
         self.process = app.run(host=host, port=port, debug=debug)
@@ -1,26 +1,46 @@
 # Copyright © 2021 United States Government as represented by the Administrator of the
 # National Aeronautics and Space Administration.  All Rights Reserved.
 
-from prog_server.models.load_ests import build_load_est
+from prog_server.models import metrics
+from prog_server.models.history import PredictionHistory
+from prog_server.models.load_ests import build_load_est, MovingAverageBuffer, update_moving_avg
+from prog_server.models.model_cache import config_key, intern, rendering
 from prog_server.models.prediction_handler import add_to_predict_queue
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor as PoolExecutor
 from copy import deepcopy
 from flask import current_app as app
 from flask import abort
 import json
 from progpy import models, state_estimators, predictors, PrognosticsModel
 from threading import Lock
+from time import monotonic
 
 extra_models = {}
 extra_predictors = {}
 extra_estimators = {}
 
+# Pool used to build sessions in parallel (e.g., bulk session creation)
+creation_pool = PoolExecutor(max_workers=5)
+
+# Pool used to backfill sessions from historical data
+backfill_pool = PoolExecutor(max_workers=2)
+
+# Number of data points between updates of backfill progress
+BACKFILL_PROGRESS_INTERVAL = 100
+
+# Pool running state estimation for sessions with asynchronous ingestion. Each session has at most one task draining its queue at a time, so its data is estimated in order
+ingest_pool = PoolExecutor(max_workers=5)
+
 class Session():
     def __init__(self, session_id,
             model_name, model_cfg={}, x0=None,
             state_est_name='ParticleFilter', state_est_cfg={},
             load_est_name='MovingAverage', load_est_cfg={},
-            pred_name='MonteCarlo', pred_cfg={}):
+            pred_name='MonteCarlo', pred_cfg={},
+            pred_deadline=None, cancel_superseded=False, tags={},
+            history_size=100, async_ingest=False, predict_queue=True):
         
         # Save config
         self.session_id = session_id
@@ -28,17 +48,127 @@ class Session():
         self.state_est_name = state_est_name
         self.state_est_cfg = state_est_cfg
         self.pred_name = pred_name
+        self.pred_deadline = pred_deadline
+        self.cancel_superseded = cancel_superseded
+        self.async_ingest = async_ingest
+        self.tags = dict(tags)
         self.initialized = True
+        self.closed = False
         self.results = None
+        # Rendered responses for the current results, by (request path, encoding). Replaced when results change
+        self.render_cache = {'results': None}
         self.futures = [None, None]
+        self.pred_token = None
+        # Status of predictions, updated when they are queued, start, and finish, so it can be read in constant time. Replaced (not modified) on update
+        self.prediction_status = {
+            'version': 0,  # Number of prediction results stored
+            'prediction_time': None,
+            'last_prediction': None,
+            'queued': 0,
+            'running': 0,
+            'truncated': False,
+            'error': None
+        }
+        self.prediction_profile = None  # Profile of the latest profiled prediction
+        self.profile_next = False  # Profile the next prediction (see controllers.set_profiling)
+        self.backfill_status = None  # Progress of the latest backfill (see backfill). Replaced (not modified) on update
+        # Data waiting for state estimation (see queue_data), and whether a task is draining it
+        self.ingest_queue = deque()
+        self.ingest_draining = False
+        # Progress of state estimation relative to ingestion. Replaced (not modified) on update
+        self.ingest_status = {
+            'received': 0,
+            'estimated': 0,
+            'dropped': 0,  # Not estimated because estimation failed, for the data point or an earlier one in the same batch
+            'received_time': None,
+            'estimated_time': None,
+            'error': None
+        }
+        self.cprofile_next = False
+        self.cprofile_stats = None
+        # Summary used for fleet queries. Replaced (not modified) on update so it can be read without locks
+        # event_state is computed when read (see event_state_summary), so it is kept off the data path
+        self.state_version = 0
+        self._event_state = (0, None)  # (state_version, event state)
+        self.summary = {
+            'session_id': session_id,
+            'model': model_name,
+            'tags': self.tags,
+            'state_time': None,
+            'prediction_time': None,
+            'last_prediction': None,
+            'time_of_event': None,
+            'truncated': False
+        }
         self.locks = {
             'estimate': Lock(),
             'execution': Lock(),
             'futures': Lock(),
+            'ingest': Lock(),
             'results': Lock()
         }
 
         # Model
+        # Sessions with identical model configuration share a single model, unless the session's predictor or state estimator may change the model's parameters (see _shares_model)
+        # Shared models must not be changed. model_cfg is the session's own copy of the requested configuration
+        shared = Session._shares_model(state_est_name, pred_name, pred_cfg)
+        self.model_key = config_key('model', model_name, model_cfg) if shared else None  # None if the model is not shared (see model_cache.rendering)
+        self.model = intern(self.model_key, lambda: Session._build_model(model_name, model_cfg))
+        self.model_cfg = deepcopy(model_cfg)
+        self.history = PredictionHistory(self.model.events, history_size)
+        self.moving_avg_loads = MovingAverageBuffer(
+            self.model.inputs,
+            load_est_cfg.get('window_size', 10),
+            load_est_cfg.get('window_time', None))
+
+        # Load Estimator
+        self.set_load_estimator(load_est_name, load_est_cfg, predict_queue=False)
+
+        # Initial State
+        if x0 is None:
+            # If initial state not provided, try initializing model without data
+            try:
+                x0 = self.model.initialize()
+                app.logger.debug("Model initialized without data")
+            except TypeError:
+                # Model requires data to initialize. Must be initialized later
+                app.logger.debug("Model cannot be initialized without data")
+                self.initialized = False  
+        else:
+            self.set_state(x0, predict_queue=predict_queue)
+
+        # Predictor
+        # Predictors are stateless between predictions, so they are shared between sessions with the same model and predictor configuration
+        self.pred = intern(
+            config_key('predictor', model_name, model_cfg, pred_name, pred_cfg) if shared else None,
+            lambda: Session._build_predictor(pred_name, pred_cfg, self.model))
+
+        self.pred_cfg = self.pred.parameters
+        
+        # State Estimator
+        if self.initialized:
+            # If state is initialized, then state estimator and predictor can
+            # be created without data
+            self.__initialize(x0, predict_queue=predict_queue)
+        else:
+            # Otherwise, will have to be initialized later
+            # Check state estimator and predictor data
+            try:
+                if self.state_est_name not in extra_estimators:
+                    getattr(state_estimators, state_est_name)
+            except AttributeError:  
+                abort(400, f"Invalid state estimator name {state_est_name}")
+
+    @staticmethod
+    def _shares_model(state_est_name, pred_name, pred_cfg):
+        # MonteCarlo with constant_noise replaces the process noise of its model for each sample. Custom predictors and state estimators may change their model too
+        return (
+            not pred_cfg.get('constant_noise', False) and
+            pred_name not in extra_predictors and
+            state_est_name not in extra_estimators)
+
+    @staticmethod
+    def _build_model(model_name, model_cfg):
         try:
             if model_name in extra_models:
                 model_class = extra_models[model_name]
@@ -51,37 +181,21 @@ class Session():
         if isinstance(model_class, type) and issubclass(model_class, PrognosticsModel):
             # model_class is a class, either from progpy or custom classes
             try:
-                self.model = model_class(**model_cfg)
+                return model_class(**model_cfg)
             except Exception as e:
                 abort(400, f"Could not instantiate model with input: {e}")
         elif isinstance(model_class, PrognosticsModel):
             # model_class is an instance of a PrognosticsModel- use the object instead
             # This happens for user models that are added to the server at startup.
-            self.model = deepcopy(model_class)
+            model = deepcopy(model_class)
             # Apply any configuration changes, overriding model config.
-            self.model.parameters.update(model_cfg)
+            model.parameters.update(model_cfg)
+            return model
         else:
             abort(400, f"Invalid model type {type(model_name)} for model {model_name}. For custom classes, the model must be either an instantiated PrognosticsModel subclass or classmame")
-        self.model_cfg = self.model.parameters
-        self.moving_avg_loads = {key: [] for key in self.model.inputs}
 
-        # Load Estimator
-        self.set_load_estimator(load_est_name, load_est_cfg, predict_queue=False)
-
-        # Initial State
-        if x0 is None:
-            # If initial state not provided, try initializing model without data
-            try:
-                x0 = self.model.initialize()
-                app.logger.debug("Model initialized without data")
-            except TypeError:
-                # Model requires data to initialize. Must be initialized later
-                app.logger.debug("Model cannot be initialized without data")
-                self.initialized = False  
-        else:
-            self.set_state(x0)
-
-        # Predictor
+    @staticmethod
+    def _build_predictor(pred_name, pred_cfg, model):
         try:
             if pred_name in extra_predictors:
                 pred_class = extra_predictors[pred_name]
@@ -89,37 +203,22 @@ class Session():
                 pred_class = getattr(predictors, pred_name)
         except AttributeError:
             abort(400, f"Invalid predictor name {pred_name}")
-        app.logger.debug(f"Creating Predictor of type {self.pred_name}")
+        app.logger.debug(f"Creating Predictor of type {pred_name}")
         if isinstance(pred_class, type) and issubclass(pred_class, predictors.Predictor):
             # pred_class is a class, either from progpy or custom classes
             try:
-                self.pred = pred_class(self.model, **pred_cfg)
+                return pred_class(model, **pred_cfg)
             except Exception as e:
                 abort(400, f"Could not instantiate predictor with input: {e}")
         elif isinstance(pred_class, predictors.Predictor):
             # pred_class is an instance of predictors.Predictor - use the object instead
             # This happens for user predictors that are added to the server at startup.
-            self.pred = deepcopy(pred_class)
+            pred = deepcopy(pred_class)
             # Apply any configuration changes, overriding predictor config.
-            self.pred.parameters.update(pred_cfg)
+            pred.parameters.update(pred_cfg)
+            return pred
         else:
             abort(400, f"Invalid predictor type {type(pred_name)} for predictor {pred_name}. For custom classes, the predictor must be mentioned with quotes in the pred argument")
-            
-        self.pred_cfg = self.pred.parameters
-        
-        # State Estimator
-        if self.initialized:
-            # If state is initialized, then state estimator and predictor can
-            # be created without data
-            self.__initialize(x0)
-        else:
-            # Otherwise, will have to be initialized later
-            # Check state estimator and predictor data
-            try:
-                if self.state_est_name not in extra_estimators:
-                    getattr(state_estimators, state_est_name)
-            except AttributeError:  
-                abort(400, f"Invalid state estimator name {state_est_name}")
 
     def __initialize(self, x0, predict_queue=True):
         app.logger.debug("Initializing...")
@@ -153,13 +252,49 @@ class Session():
             abort(400, f"Invalid state estimator type {type(self.state_est_name)} for estimator {self.state_est_name}. For custom classes, the state estimator must be mentioned with quotes in the est argument")
 
         self.initialized = True
+        with self.locks['estimate']:
+            self._update_state_summary()
         if predict_queue:
             add_to_predict_queue(self)
 
-    def set_state(self, x):
+    def update_summary(self, **changes):
+        # Copy-on-write so fleet queries can read the summary without taking session locks
+        self.summary = {**self.summary, **changes}
+
+    def update_prediction_status(self, queued=0, running=0, **changes):
+        # Counts are incremented. Called with the futures lock held
+        self.prediction_status = {
+            **self.prediction_status,
+            'queued': self.prediction_status['queued'] + queued,
+            'running': self.prediction_status['running'] + running,
+            **changes}
+
+    def _update_state_summary(self):
+        # Called with the estimate lock held
+        self.state_version += 1
+        self.update_summary(state_time=self.state_est.t)
+
+    def event_state_summary(self):
+        """
+        Get the event state of the mean of the current state, for fleet queries. Computed on the first read after the state changes
+
+        Returns:
+            dict: Event state of each event, or None if the session is not initialized
+        """
+        (version, event_state) = self._event_state
+        if version == self.state_version or not self.initialized:
+            return event_state
+        with self.locks['estimate']:
+            version = self.state_version
+            x = self.state_est.x.mean
+        event_state = {key: float(value) for key, value in self.model.event_state(x).items()}
+        self._event_state = (version, event_state)
+        return event_state
+
+    def set_state(self, x, predict_queue=True):
         app.logger.debug(f"Setting state to {x}")
         # Initializes (or re-initializes) state estimator
-        self.__initialize(x)
+        self.__initialize(x, predict_queue)
 
     def set_load_estimator(self, name, cfg, predict_queue=True):
         app.logger.debug(f"Setting load estimator to {name}")
@@ -169,23 +304,156 @@ class Session():
         if predict_queue:
             add_to_predict_queue(self)
 
+    def set_tags(self, tags):
+        """
+        Update session tags. Tags with a value of None are removed.
+        """
+        new_tags = {**self.tags, **tags}
+        self.tags = {key: value for key, value in new_tags.items() if value is not None}
+        self.update_summary(tags=self.tags)
+
     def add_data(self, time, inputs, outputs):
         # Add data to state estimator
+        with self.locks['ingest']:
+            self._update_ingest_status(received=1, received_time=time)
+        estimated = []
+        try:
+            self._estimate_batch([(time, inputs, outputs)], estimated)
+        finally:
+            with self.locks['ingest']:
+                if len(estimated) > 0:
+                    self._update_ingest_status(estimated=1, estimated_time=time)
+                else:
+                    self._update_ingest_status(dropped=1)
+
+    def _update_ingest_status(self, received=0, estimated=0, dropped=0, **changes):
+        # Counts are incremented. Called with the ingest lock held
+        self.ingest_status = {
+            **self.ingest_status,
+            'received': self.ingest_status['received'] + received,
+            'estimated': self.ingest_status['estimated'] + estimated,
+            'dropped': self.ingest_status['dropped'] + dropped,
+            **changes}
+
+    def _estimate_batch(self, batch, estimated=None):
+        # Estimate state for data (list of (time, inputs, outputs)) in order, then queue one prediction.
+        # The time of each data point is appended to estimated (list) once it is estimated, so progress is known if estimation fails partway
+        estimated = [] if estimated is None else estimated
         if not self.initialized:
+            (time, inputs, outputs) = batch[0]
             x0 = self.model.initialize(inputs, outputs)
-            self.__initialize(x0)
-        else:
-            app.logger.debug("Adding data to state estimator")
+            self.__initialize(x0, predict_queue=len(batch) == 1)
+            estimated.append(time)
+            batch = batch[1:]
+            if len(batch) == 0:
+                return
+        app.logger.debug(f"Adding {len(batch)} data points to state estimator")
+        with self.locks['estimate']:
+            try:
+                for (time, inputs, outputs) in batch:
+                    start = monotonic()
+                    self.state_est.estimate(time, inputs, outputs)
+                    metrics.estimate_duration.observe(monotonic() - start)
+                    estimated.append(time)
+            finally:
+                if len(estimated) > 0:
+                    self._update_state_summary()
+        metrics.estimate_batch_size.observe(len(batch))
+        add_to_predict_queue(self)
+
+    def queue_data(self, time, inputs, outputs):
+        """
+        Queue data for state estimation on the ingest pool, instead of estimating in the calling (request) thread. Queued data is estimated in order. Data queued while estimation is running is estimated together as one batch, with one prediction queued after the batch. Progress is reported in ingest_status.
+
+        Args:
+            time (float): Time of data point
+            inputs (dict): Inputs
+            outputs (dict): Outputs
+        """
+        with self.locks['ingest']:
+            self.ingest_queue.append((time, inputs, outputs))
+            self._update_ingest_status(received=1, received_time=time)
+            if self.ingest_draining:
+                return
+            self.ingest_draining = True
+        ingest_pool.submit(self._drain_ingest_queue, app._get_current_object())
+
+    def _drain_ingest_queue(self, app_obj):
+        with app_obj.app_context():
+            while True:
+                with self.locks['ingest']:
+                    if len(self.ingest_queue) == 0 or self.closed:
+                        self.ingest_draining = False
+                        return
+                    batch = list(self.ingest_queue)
+                    self.ingest_queue.clear()
+                error = None
+                estimated = []
+                try:
+                    self._estimate_batch(batch, estimated)
+                except Exception as e:
+                    # No request to report the error to. Rest of batch (including the failed data point) is dropped
+                    error = getattr(e, 'description', str(e))
+                    app.logger.debug(f"Error estimating state for session {self.session_id}: {error}. Dropped {len(batch) - len(estimated)} data points")
+                with self.locks['ingest']:
+                    changes = {'error': error} if error is not None else {}
+                    if len(estimated) > 0:
+                        changes['estimated_time'] = estimated[-1]
+                    self._update_ingest_status(estimated=len(estimated), dropped=len(batch) - len(estimated), **changes)
+
+    def ingest_pending(self):
+        """
+        Returns:
+            int: Number of data points received but not yet estimated (or dropped)
+        """
+        status = self.ingest_status
+        return status['received'] - status['estimated'] - status['dropped']
+
+    def _update_backfill_status(self, **changes):
+        # Under the lock held by start_backfill and send_data while checking the status
+        with self.locks['futures']:
+            self.backfill_status = {**(self.backfill_status or {}), **changes}
+
+    def backfill(self, times, inputs, outputs, predict_queue=True):
+        """
+        Run state estimation through historical data as fast as possible. No predictions are made for the data points; one prediction is queued at the end. Progress is reported in backfill_status.
+
+        Args:
+            times (list[float]): Times, in increasing order
+            inputs (list[dict]): Inputs at each time
+            outputs (list[dict]): Outputs at each time
+            predict_queue (bool, optional): If a prediction is queued when complete. Defaults to True
+        """
+        start = monotonic()
+        self._update_backfill_status(status='running')
+        try:
+            for (i, (time, u, z)) in enumerate(zip(times, inputs, outputs)):
+                if self.closed:
+                    self._update_backfill_status(status='cancelled', processed=i, duration=monotonic() - start)
+                    return
+                update_moving_avg(u, self, self.load_est_cfg, time)
+                if not self.initialized:
+                    self.__initialize(self.model.initialize(u, z), predict_queue=False)
+                else:
+                    with self.locks['estimate']:
+                        self.state_est.estimate(time, u, z)
+                if (i + 1) % BACKFILL_PROGRESS_INTERVAL == 0:
+                    self._update_backfill_status(processed=i + 1, time=time, duration=monotonic() - start)
             with self.locks['estimate']:
-                self.state_est.estimate(time, inputs, outputs)
+                self._update_state_summary()
+        except Exception as e:
+            self._update_backfill_status(status='failed', error=getattr(e, 'description', str(e)), duration=monotonic() - start)
+            return
+        self._update_backfill_status(status='complete', processed=len(times), time=times[-1] if len(times) > 0 else None, duration=monotonic() - start)
+        if predict_queue:
             add_to_predict_queue(self)
-    
+
     def to_dict(self):
         return {
             'session_id': self.session_id,
             'model': {
                 'type': self.model_name,
-                'cfg': self.model_cfg.to_json()},
+                'cfg': rendering(self.model_key, self.model, 'parameters_json', self.model.parameters.to_json)},
             'state_estimator': {
                 'type': self.state_est_name,
                 'cfg': self.state_est_cfg},
@@ -194,6 +462,10 @@ class Session():
                 'cfg': self.load_est_cfg},
             'predictor': {
                 'type': self.pred_name,
-                'cfg': self.pred_cfg},
+                'cfg': self.pred_cfg,
+                'deadline': self.pred_deadline,
+                'cancel_superseded': self.cancel_superseded},
+            'async_ingest': self.async_ingest,
+            'tags': self.tags,
             'initialized': self.initialized
         }
@@ -0,0 +1,76 @@
+# Copyright © 2021 United States Government as represented by the Administrator of the
+# National Aeronautics and Space Administration.  All Rights Reserved.
+
+from collections import defaultdict
+from threading import Lock
+
+class SessionIndex():
+    """
+    Secondary indexes of sessions by model name, predictor name, and tag values. Used to filter sessions without visiting each one.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._by_model = defaultdict(set)
+        self._by_pred = defaultdict(set)
+        self._by_tag = defaultdict(set)  # (key, value) -> session ids
+        self._tags = {}  # session id -> tags currently indexed
+
+    def add(self, session):
+        with self._lock:
+            self._by_model[session.model_name].add(session.session_id)
+            self._by_pred[session.pred_name].add(session.session_id)
+            self._tags[session.session_id] = dict(session.tags)
+            for item in session.tags.items():
+                self._by_tag[item].add(session.session_id)
+
+    def remove(self, session):
+        with self._lock:
+            self._discard(self._by_model, session.model_name, session.session_id)
+            self._discard(self._by_pred, session.pred_name, session.session_id)
+            for item in self._tags.pop(session.session_id, {}).items():
+                self._discard(self._by_tag, item, session.session_id)
+
+    def update_tags(self, session):
+        """
+        Reindex the tags of a session after they have been changed
+        """
+        with self._lock:
+            for item in self._tags.get(session.session_id, {}).items():
+                self._discard(self._by_tag, item, session.session_id)
+            self._tags[session.session_id] = dict(session.tags)
+            for item in session.tags.items():
+                self._by_tag[item].add(session.session_id)
+
+    def query(self, model_name=None, pred_name=None, tags={}):
+        """
+        Get the IDs of sessions matching all of the given filters
+
+        Args:
+            model_name (str, optional): Model name
+            pred_name (str, optional): Predictor name
+            tags (dict, optional): Tag key: value pairs
+
+        Returns:
+            set[int]: Matching session IDs, or None if no filters were given
+        """
+        with self._lock:
+            matches = []
+            if model_name is not None:
+                matches.append(self._by_model.get(model_name, set()))
+            if pred_name is not None:
+                matches.append(self._by_pred.get(pred_name, set()))
+            for item in tags.items():
+                matches.append(self._by_tag.get(item, set()))
+            if len(matches) == 0:
+                return None
+            # Intersect starting with the smallest set
+            matches.sort(key=len)
+            return set(matches[0]).intersection(*matches[1:])
+
+    @staticmethod
+    def _discard(index, key, session_id):
+        ids = index.get(key)
+        if ids is not None:
+            ids.discard(session_id)
+            if len(ids) == 0:
+                del index[key]
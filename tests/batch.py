@@ -0,0 +1,82 @@
+# Copyright © 2021 United States Government as represented by the Administrator of the National Aeronautics and Space Administration. All Rights Reserved.
+
+import numpy as np
+import os
+import tempfile
+import unittest
+from prog_server import batch
+from progpy.models import ThrownObject
+
+CONFIG = {
+    'model': 'ThrownObject',
+    'state_est': 'UnscentedKalmanFilter',
+    'pred_cfg': {'n_samples': 10, 'save_freq': 0.1}}
+
+def _write_run(path, n):
+    m = ThrownObject()
+    x = m.initialize()
+    with open(path, 'w') as f:
+        f.write('time,x\n')
+        for i in range(1, n+1):
+            x = m.next_state(x, {}, 0.1)
+            f.write(f"{0.1*i},{m.output(x)['x']}\n")
+
+
+class BatchTest(unittest.TestCase):
+    def test_batch(self):
+        with tempfile.TemporaryDirectory() as directory:
+            _write_run(os.path.join(directory, 'a.csv'), 20)
+            _write_run(os.path.join(directory, 'b.csv'), 30)
+            with open(os.path.join(directory, 'c.csv'), 'w') as f:
+                f.write('time,y\n0.1,1\n')  # Missing output x
+            with open(os.path.join(directory, 'notes.txt'), 'w') as f:
+                f.write('Not a run')
+
+            paths = batch.find_runs(directory)
+            self.assertListEqual([os.path.basename(path) for path in paths], ['a.csv', 'b.csv', 'c.csv'])
+
+            (columns, errors) = batch.run(CONFIG, paths, predict_every=10, workers=2)
+            self.assertListEqual([error['run'] for error in errors], ['c'])
+            self.assertListEqual(columns['run'], ['a', 'a', 'b', 'b', 'b'])
+            np.testing.assert_allclose(columns['prediction_time'], [1, 2, 1, 2, 3])
+            for stat in ('mean', 'p5', 'p50', 'p95'):
+                self.assertEqual(len(columns[f'impact_{stat}']), 5)
+            self.assertTrue(all(7.5 < toe < 8.5 for toe in columns['impact_mean']))
+
+            # Columnar output
+            output = os.path.join(directory, 'toe.npz')
+            batch.write_columns(columns, output)
+            with np.load(output) as npz:
+                self.assertListEqual(npz['run'].tolist(), columns['run'])
+                np.testing.assert_array_equal(npz['impact_mean'], columns['impact_mean'])
+
+            # Invalid configuration is rejected as in PUT /session
+            with self.assertRaises(Exception):
+                batch.run({'model': 'ThrownObject', 'model_cfg': 'not json'}, paths)
+
+    def test_main(self):
+        with tempfile.TemporaryDirectory() as directory:
+            _write_run(os.path.join(directory, 'a.csv'), 10)
+            config = os.path.join(directory, 'config.json')
+            with open(config, 'w') as f:
+                f.write('{"model": "ThrownObject", "state_est": "UnscentedKalmanFilter", "pred_cfg": {"n_samples": 5}}')
+            output = os.path.join(directory, 'toe.csv')
+            self.assertEqual(batch.main([config, directory, '--output', output, '--workers', '1']), 0)
+            with open(output) as f:
+                lines = f.read().splitlines()
+            self.assertEqual(len(lines), 2)
+            self.assertTrue(lines[0].startswith('run,prediction_time,'))
+
+
+# This allows the module to be executed directly
+def run_tests():
+    l = unittest.TestLoader()
+    runner = unittest.TextTestRunner()
+    print("\n\nTesting batch prognostics")
+    result = runner.run(l.loadTestsFromTestCase(BatchTest)).wasSuccessful()
+
+    if not result:
+        raise Exception("Failed test")
+
+if __name__ == '__main__':
+    run_tests()
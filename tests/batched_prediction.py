@@ -0,0 +1,195 @@
+# Copyright © 2021 United States Government as represented by the Administrator of the National Aeronautics and Space Administration. All Rights Reserved.
+
+from concurrent.futures import Future
+from flask import Flask
+import numpy as np
+import threading
+import time
+import unittest
+from prog_server.models import metrics, prediction_handler
+from prog_server.models.batched_prediction import sample_matrix, simulate, supports
+from prog_server.models.prediction_arrays import PredictionArrays
+from prog_server.models.prediction_handler import cancel_predictions, predict_batch, PredictionCancelled
+from prog_server.models.session import Session
+from progpy.models import BatteryCircuit, ThrownObject
+from progpy.predictors import MonteCarlo
+from progpy.uncertain_data import MultivariateNormalDist, UnweightedSamples
+
+
+def _no_load(t, x):
+    return np.empty((0, x.shape[1]))
+
+class BatchedPredictionTest(unittest.TestCase):
+    def assertMatches(self, expected, result):
+        # Results of MonteCarlo.predict match simulate
+        (toe, states, outputs, event_states) = result
+        self.assertListEqual([dict(sample) for sample in expected[5]], list(toe))
+        for (prediction, arrays) in zip(expected[2:5], (states, outputs, event_states)):
+            prediction = PredictionArrays.from_prediction(prediction)
+            np.testing.assert_allclose(arrays.times, prediction.times)
+            np.testing.assert_array_equal(arrays.lengths, prediction.lengths)
+            np.testing.assert_allclose(arrays.values, prediction.values)
+
+    def test_matches_monte_carlo(self):
+        m = ThrownObject(process_noise=0)
+        x0 = m.initialize()
+        samples = UnweightedSamples([{'x': x0['x'], 'v': v} for v in np.linspace(30, 45, 7)])
+        for cfg in ({}, {'save_freq': 1}, {'save_freq': 0.5, 'dt': 0.05}, {'dt': ('constant', 0.1)}, {'event_strategy': 'first', 'save_freq': 0.3}, {'horizon': 5, 'save_freq': 2, 'dt': 'auto'}):
+            pred = MonteCarlo(m, **cfg)
+            expected = pred.predict(samples, lambda t, x=None: m.InputContainer({}), t0=2)
+            [result] = simulate(m, pred.parameters, [(sample_matrix(m, samples), 2)], [_no_load])
+            self.assertMatches(expected, result)
+
+    def test_sessions(self):
+        # Sessions with different times and loads are simulated together
+        m = BatteryCircuit(process_noise=0)
+        x0 = m.initialize()
+        pred = MonteCarlo(m, save_freq=50, dt=2)
+        expected, starts, loads = [], [], []
+        for (t0, current) in ((0, 2.0), (100, 3.0)):
+            samples = UnweightedSamples([{**x0, 'tb': x0['tb'] + d} for d in np.linspace(0, 5, 4)])
+            expected.append(pred.predict(samples, lambda t, x=None, current=current: m.InputContainer({'i': current}), t0=t0))
+            starts.append((sample_matrix(m, samples), t0))
+            loads.append(lambda t, x, current=current: np.full((1, x.shape[1]), current))
+        for (expected_i, result) in zip(expected, simulate(m, pred.parameters, starts, loads)):
+            self.assertMatches(expected_i, result)
+
+    def test_process_noise(self):
+        # With process noise, results match MonteCarlo in distribution
+        np.random.seed(0)
+        m = ThrownObject(process_noise={'x': 0.5, 'v': 0.5})
+        n = 300
+        samples = UnweightedSamples([m.initialize()]*n)
+        pred = MonteCarlo(m, dt=0.05, save_freq=1)
+        expected = pred.predict(samples, lambda t, x=None: m.InputContainer({}), n_samples=n)
+        [(toe, states, _, _)] = simulate(m, pred.parameters, [(sample_matrix(m, samples), 0)], [_no_load])
+        for event in m.events:
+            a = np.array([sample[event] for sample in expected[5]])
+            b = np.array([sample[event] for sample in toe])
+            self.assertLess(abs(a.mean() - b.mean()), 4*np.sqrt((a.var() + b.var())/n))
+            self.assertAlmostEqual(b.std()/a.std(), 1, delta=0.2)
+        expected_states = PredictionArrays.from_prediction(expected[2])
+        np.testing.assert_allclose(states.times[:4], expected_states.times[:4])  # Later times depend on when samples reach events
+        for i in range(1, 4):
+            # Spread of states grows with noise accumulated over time
+            spread = np.nanstd(states.values[:, i], axis=0)
+            expected_spread = np.nanstd(expected_states.values[:, i], axis=0)
+            np.testing.assert_allclose(spread, expected_spread, rtol=0.2)
+
+    def test_predict_batch(self):
+        with Flask('test').app_context():
+            a = Session(0, 'ThrownObject', pred_cfg={'n_samples': 5, 'save_freq': 1}, predict_queue=False)
+            b = Session(1, 'ThrownObject', pred_cfg={'n_samples': 5, 'save_freq': 1}, predict_queue=False)
+            self.assertTrue(supports(a) and supports(b))
+            b.state_est = None  # Fails on its own
+
+            outcomes = dict(metrics.predictions_total._values)
+            active = metrics.pool_active.value
+            entries = [(a, Future(), 0), (a, Future(), 0), (b, Future(), 0)]
+            for (_, future, _) in entries:
+                future.set_running_or_notify_cancel()
+            predict_batch(entries)
+
+            # Failure of one session does not fail the others
+            self.assertIsNone(entries[0][1].result())
+            self.assertIsNone(entries[1][1].result())
+            self.assertIsNotNone(a.results)
+            self.assertIsNotNone(entries[2][1].exception())
+            self.assertIsNone(b.results)
+            self.assertIsNotNone(b.prediction_status['error'])
+
+            # Counted once per session
+            def count(outcome):
+                return metrics.predictions_total._values.get((outcome,), 0) - outcomes.get((outcome,), 0)
+            self.assertEqual(count('completed'), 1)
+            self.assertEqual(count('skipped'), 1)
+            self.assertEqual(count('failed'), 1)
+            self.assertEqual(metrics.pool_active.value, active)
+
+    def test_stopped(self):
+        # Session with no load never reaches its event. It is stopped (at the time limit, or when cancelled), without stopping the others
+        m = BatteryCircuit(process_noise=0)
+        x0 = m.initialize()
+        pred = MonteCarlo(m, save_freq=100, dt=2)
+        samples = UnweightedSamples([x0]*4)
+        starts = [(sample_matrix(m, samples), 0)]*2
+        loads = [lambda t, x, current=current: np.full((1, x.shape[1]), current) for current in (0.0, 2.0)]
+        (never, result) = simulate(m, pred.parameters, starts, loads, time_limit=2)
+        self.assertIsNone(never)
+        self.assertEqual(len(result[0]), 4)
+
+        (never, result) = simulate(m, pred.parameters, starts, loads, cancelled=[lambda: True, lambda: False])
+        self.assertIsNone(never)
+        self.assertEqual(len(result[0]), 4)
+
+    def test_predict_batch_cancelled(self):
+        with Flask('test').app_context():
+            cfg = {'pred_cfg': {'n_samples': 4, 'save_freq': 100, 'dt': 2}, 'predict_queue': False}
+            a = Session(0, 'BatteryCircuit', load_est_name='Const', load_est_cfg={'load': {'i': 0}}, **cfg)
+            b = Session(1, 'BatteryCircuit', load_est_name='Const', load_est_cfg={'load': {'i': 2}}, **cfg)
+            self.assertTrue(supports(a) and supports(b))
+            self.assertIs(a.pred, b.pred)
+
+            entries = [(a, Future(), 0), (b, Future(), 0)]
+            for (_, future, _) in entries:
+                future.set_running_or_notify_cancel()
+            thread = threading.Thread(target=predict_batch, args=(entries,))
+            thread.start()
+
+            # Deleting the session that never ends lets the other complete
+            time.sleep(0.5)
+            self.assertTrue(thread.is_alive())
+            cancel_predictions(a)
+            thread.join(timeout=30)
+            self.assertFalse(thread.is_alive())
+            self.assertIsInstance(entries[0][1].exception(), PredictionCancelled)
+            self.assertIsNone(a.results)
+            self.assertIsNone(entries[1][1].result())
+            self.assertIsNotNone(b.results)
+
+    def test_predict_batch_time_limit(self):
+        with Flask('test').app_context():
+            cfg = {'pred_cfg': {'n_samples': 4, 'save_freq': 100, 'dt': 2}, 'predict_queue': False}
+            a = Session(0, 'BatteryCircuit', load_est_name='Const', load_est_cfg={'load': {'i': 0}}, **cfg)
+            b = Session(1, 'BatteryCircuit', load_est_name='Const', load_est_cfg={'load': {'i': 2}}, **cfg)
+
+            entries = [(a, Future(), 0), (b, Future(), 0)]
+            for (_, future, _) in entries:
+                future.set_running_or_notify_cancel()
+            (time_limit, prediction_handler.BATCH_TIME_LIMIT) = (prediction_handler.BATCH_TIME_LIMIT, 1)
+            try:
+                thread = threading.Thread(target=predict_batch, args=(entries,))
+                thread.start()
+
+                # Other session completes when the session that never ends is removed from the batch, while it is predicted on its own
+                self.assertIsNone(entries[1][1].result(timeout=30))
+                self.assertIsNotNone(b.results)
+                self.assertTrue(thread.is_alive())
+                self.assertFalse(entries[0][1].done())
+            finally:
+                prediction_handler.BATCH_TIME_LIMIT = time_limit
+                cancel_predictions(a)
+                thread.join(timeout=30)
+            self.assertFalse(thread.is_alive())
+            self.assertIsInstance(entries[0][1].exception(), PredictionCancelled)
+
+    def test_sample_matrix(self):
+        m = ThrownObject()
+        samples = UnweightedSamples([{'x': 1.0, 'v': v} for v in range(5)])
+        np.testing.assert_array_equal(sample_matrix(m, samples), [[1.0]*5, list(range(5))])
+        self.assertEqual(sample_matrix(m, samples, 3).shape, (2, 3))
+        self.assertEqual(sample_matrix(m, MultivariateNormalDist(['x', 'v'], [1.0, 2.0], np.eye(2))).shape, (2, 100))
+
+
+# This allows the module to be executed directly
+def run_tests():
+    l = unittest.TestLoader()
+    runner = unittest.TextTestRunner()
+    print("\n\nTesting batched prediction")
+    result = runner.run(l.loadTestsFromTestCase(BatchedPredictionTest)).wasSuccessful()
+
+    if not result:
+        raise Exception("Failed test")
+
+if __name__ == '__main__':
+    run_tests()
@@ -0,0 +1,44 @@
+# Copyright © 2021 United States Government as represented by the Administrator of the National Aeronautics and Space Administration. All Rights Reserved.
+
+import unittest
+import zlib
+from prog_server.models import compression
+
+
+class CompressionTest(unittest.TestCase):
+    def test_streamed_chunks(self):
+        lines = [f'{{"time": {i}, "state": {{"x": {i/10}}}}}\n' for i in range(50)]
+        for encoding in compression.ENCODINGS:
+            with self.subTest(encoding=encoding):
+                chunks = compression._compress_chunks(iter(lines), encoding)
+                if encoding == 'zstd':
+                    decompressor = compression.zstandard.ZstdDecompressor().decompressobj()
+                else:
+                    decompressor = zlib.decompressobj(31)
+
+                # Each line can be decompressed as soon as its chunk is received
+                for line in lines:
+                    self.assertEqual(decompressor.decompress(next(chunks)).decode(), line)
+                decompressor.decompress(b''.join(chunks))
+
+    def test_round_trip(self):
+        data = b'prediction' * 1000
+        for encoding in compression.ENCODINGS:
+            with self.subTest(encoding=encoding):
+                self.assertEqual(compression.decompress(compression.compress(data, encoding), encoding), data)
+                with self.assertRaises(compression.DataTooLarge):
+                    compression.decompress(compression.compress(data, encoding), encoding, max_size=100)
+
+
+# This allows the module to be executed directly
+def run_tests():
+    l = unittest.TestLoader()
+    runner = unittest.TextTestRunner()
+    print("\n\nTesting compression")
+    result = runner.run(l.loadTestsFromTestCase(CompressionTest)).wasSuccessful()
+
+    if not result:
+        raise Exception("Failed test")
+
+if __name__ == '__main__':
+    run_tests()
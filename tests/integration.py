@@ -1,5 +1,7 @@
 # Copyright © 2021 United States Government as represented by the Administrator of the National Aeronautics and Space Administration. All Rights Reserved.
 
+import gzip
+import requests
 import time
 import unittest
 import prog_client, prog_server
@@ -181,6 +183,485 @@ class IntegrationTest(unittest.TestCase):
         # because the time step is 1,
         # so it can't save as frequently
 
+    def test_pred_deadline(self):
+        # Deadline expires after a few of the 10 chunks (of 20 samples, about 0.5 s each), so the result is the chunks completed by then
+        session = prog_client.Session('ThrownObject', pred_deadline=1.5, pred_cfg={'n_samples': 200, 'save_freq': 0.1, 'dt': 1e-2})
+
+        for _ in range(20):
+            time.sleep(0.5)
+            status = session.get_prediction_status()
+            if status['in progress'] == 0 and status['last prediction'] is not None:
+                break
+
+        self.assertTrue(status['truncated'])
+        (_, toe) = session.get_predicted_toe()
+        self.assertLess(len(toe), 200)
+        self.assertEqual(len(toe) % 20, 0)
+
+        # Prediction that never ends (no load, so battery never discharges) is cancelled at the deadline, without a result
+        session = prog_client.Session('BatteryCircuit', load_est='Const', load_est_cfg={'load': {'i': 0}}, pred_deadline=0.5, pred_cfg={'save_freq': 100})
+        for _ in range(20):
+            time.sleep(0.25)
+            status = session.get_prediction_status()
+            if status['in progress'] == 0 and len(status['exceptions']) > 0:
+                break
+        self.assertEqual(status['in progress'], 0)
+        self.assertIn('deadline exceeded', status['exceptions'][0])
+        self.assertIsNone(status['last prediction'])
+
+        # Without deadline - not truncated
+        session = prog_client.Session('ThrownObject', pred_cfg={'save_freq': 0.1})
+        for _ in range(10):
+            time.sleep(0.5)
+            status = session.get_prediction_status()
+            if status['last prediction'] is not None:
+                break
+        self.assertFalse(status['truncated'])
+
+    def test_bulk_sessions(self):
+        x0s = [{'x': 1.0 + i, 'v': 20.0} for i in range(3)]
+        if 'max_x' in ThrownObject.states:
+            for x0 in x0s:
+                x0['max_x'] = x0['x']
+        sessions = prog_client.Session.create_many('ThrownObject', overrides=[{'x0': x0} for x0 in x0s], n=2)
+        self.assertEqual(len(sessions), 5)
+        self.assertEqual(len(set(session.session_id for session in sessions)), 5)
+
+        for session, x0 in zip(sessions, x0s):
+            (_, x) = session.get_state()
+            self.assertAlmostEqual(x.mean['x'], x0['x'])
+
+        prog_client.Session.delete_many(sessions)
+        with self.assertRaises(Exception):
+            sessions[0].get_state()
+
+        # Invalid override
+        with self.assertRaises(Exception):
+            prog_client.Session.create_many('ThrownObject', overrides=[{'model': 'BatteryCircuit'}])
+
+        # One invalid session - none are created
+        n_sessions = len(prog_client.Session.list_sessions())
+        with self.assertRaises(Exception):
+            prog_client.Session.create_many('ThrownObject', overrides=[{'x0': x0s[0]}, {'x0': {'x': 1.0}}])
+        self.assertEqual(len(prog_client.Session.list_sessions()), n_sessions)
+
+    def test_fleet_summary(self):
+        sessions = prog_client.Session.create_many('ThrownObject', n=3, pred_cfg={'save_freq': 0.1})
+        ids = [session.session_id for session in sessions]
+
+        for _ in range(10):
+            time.sleep(0.5)
+            summary = prog_client.Session.get_fleet_summary(ids=ids)
+            if all(s['last_prediction'] is not None for s in summary['sessions']):
+                break
+
+        self.assertEqual(summary['total'], 3)
+        for s in summary['sessions']:
+            self.assertIn(s['session_id'], ids)
+            self.assertAlmostEqual(s['time_of_event']['impact']['mean'], 7.9, delta=0.2)
+            self.assertIn('falling', s['event_state'])
+            self.assertGreaterEqual(s['prediction_age'], 0)
+
+        # Event state follows the state
+        x = {'x': 1.0, 'v': 1.0} if 'max_x' not in ThrownObject.states else {'x': 1.0, 'v': 1.0, 'max_x': 1.0}
+        sessions[0].set_state(x)
+        summary = prog_client.Session.get_fleet_summary(ids=ids[:1])
+        self.assertAlmostEqual(summary['sessions'][0]['event_state']['falling'], ThrownObject().event_state(x)['falling'], delta=0.01)
+
+        # Pagination and sorting
+        summary = prog_client.Session.get_fleet_summary(ids=ids, sort='toe', event='impact', page=1, page_size=2)
+        self.assertEqual(summary['total'], 3)
+        self.assertEqual(len(summary['sessions']), 1)
+
+        prog_client.Session.delete_many(sessions)
+
+    def test_tags(self):
+        session_a = prog_client.Session('ThrownObject', tags={'site': 'ames', 'asset': 'a'})
+        session_b = prog_client.Session('ThrownObject', tags={'site': 'ames', 'asset': 'b'})
+        session_c = prog_client.Session('BatteryCircuit', pred='MonteCarlo', tags={'site': 'jpl'})
+
+        self.assertDictEqual(session_a.get_tags(), {'site': 'ames', 'asset': 'a'})
+        self.assertListEqual(
+            prog_client.Session.list_sessions(tags={'site': 'ames'}),
+            [session_a.session_id, session_b.session_id])
+        self.assertListEqual(
+            prog_client.Session.list_sessions(tags={'site': 'ames', 'asset': 'b'}),
+            [session_b.session_id])
+        self.assertListEqual(
+            prog_client.Session.list_sessions(model='BatteryCircuit', tags={'site': 'jpl'}),
+            [session_c.session_id])
+        self.assertListEqual(
+            prog_client.Session.list_sessions(pred='MonteCarlo', tags={'site': 'jpl'}),
+            [session_c.session_id])
+        self.assertListEqual(prog_client.Session.list_sessions(pred='UnscentedTransformPredictor', tags={'site': 'jpl'}), [])
+        self.assertEqual(len(prog_client.Session.list_sessions(tags={'site': 'ames'}, page=0, page_size=1)), 1)
+
+        # Update tags
+        session_b.set_tags(site='jpl', asset=None)
+        self.assertDictEqual(session_b.get_tags(), {'site': 'jpl'})
+        self.assertListEqual(
+            prog_client.Session.list_sessions(tags={'site': 'ames'}),
+            [session_a.session_id])
+
+        # Fleet summary with tag filter
+        summary = prog_client.Session.get_fleet_summary(tags={'site': 'jpl'})
+        self.assertEqual(summary['total'], 2)
+
+        prog_client.Session.delete_many([session_a, session_b, session_c])
+        self.assertListEqual(prog_client.Session.list_sessions(tags={'site': 'jpl'}), [])
+
+    def test_scenarios(self):
+        session = prog_client.Session('BatteryCircuit', pred_cfg={'n_samples': 5, 'dt': 2, 'save_freq': 100})
+        result = session.score_scenarios([
+            {'name': 'high', 'type': 'Const', 'cfg': {'load': {'i': 4}}},
+            {'name': 'low', 'type': 'Const', 'cfg': {'load': {'i': 1}}},
+            {'name': 'variable', 'type': 'Variable', 'cfg': {'0': {'i': 1}, '1000': {'i': 4}}}])
+        self.assertEqual(result['event'], 'EOD')
+        self.assertListEqual([scenario['name'] for scenario in result['scenarios']], ['high', 'low', 'variable'])
+        # Lower load - later end of discharge
+        self.assertListEqual(result['ranking'], [1, 2, 0])
+        toe = [scenario['time_of_event']['EOD']['mean'] for scenario in result['scenarios']]
+        self.assertGreater(toe[1], toe[2])
+        self.assertGreater(toe[2], toe[0])
+
+        # Invalid scenarios
+        for scenarios in (
+                [],
+                [{'name': 'no type', 'cfg': {}}],
+                [{'type': 'NotALoadEstimator'}],
+                [{'type': 'Variable', 'cfg': {'0': {'i': 1}, 'interpolation': 'cubic'}}]):
+            with self.assertRaises(Exception):
+                session.score_scenarios(scenarios)
+        # Failure in prediction (load missing input)
+        with self.assertRaisesRegex(Exception, 'Scenario missing input failed'):
+            session.score_scenarios([{'type': 'Const', 'cfg': {'load': {'i': 1}}}, {'name': 'missing input', 'type': 'Const', 'cfg': {'load': {'current': 1}}}])
+        with self.assertRaises(Exception):
+            session.score_scenarios([{'type': 'Const', 'cfg': {'load': {'i': 1}}}], event='not an event')
+
+    def test_metrics(self):
+        session = prog_client.Session('ThrownObject')
+        session.get_state()
+        for _ in range(10):
+            time.sleep(0.5)
+            if session.get_prediction_status()['last prediction'] is not None:
+                break
+
+        result = requests.get('http://127.0.0.1:8555/api/v1/metrics')
+        self.assertEqual(result.status_code, 200)
+        self.assertIn('prog_server_requests_total{route="/api/v1/session/<int:session_id>/state",method="GET",status="200"}', result.text)
+        self.assertIn('prog_server_request_duration_seconds_bucket', result.text)
+        self.assertIn('prog_server_predictions_total{outcome="completed"}', result.text)
+        self.assertIn('prog_server_prediction_duration_seconds_count', result.text)
+        self.assertIn(f'prog_server_session_result_age_seconds{{session_id="{session.session_id}"}}', result.text)
+        self.assertIn('prog_server_active_sessions', result.text)
+
+    def test_profiling(self):
+        session = prog_client.Session('ThrownObject')
+        session.profile_next_prediction()
+        session.set_state({'x': 1.0, 'v': 20.0} if 'max_x' not in ThrownObject.states else {'x': 1.0, 'v': 20.0, 'max_x': 1.0})
+        for _ in range(10):
+            time.sleep(0.5)
+            profile = session.get_profile()
+            if profile['cprofile'] is not None and profile['prediction'] is not None:
+                break
+        self.assertIn('predict', profile['prediction'])
+        self.assertIn('total', profile['prediction'])
+        self.assertIn('cumulative', profile['cprofile'])
+
+        # Predictions are not profiled unless requested (or sampled)
+        session_2 = prog_client.Session('ThrownObject')
+        for _ in range(10):
+            time.sleep(0.5)
+            if session_2.get_prediction_status()['last prediction'] is not None:
+                break
+        self.assertIsNone(session_2.get_profile()['prediction'])
+
+        # Request profiling
+        result = requests.get(session.host + '/output', params={'return_format': 'metrics'}, headers={'X-Profile': '1'})
+        self.assertIn('sampling;dur=', result.headers['Server-Timing'])
+        self.assertIn('serialize;dur=', result.headers['Server-Timing'])
+        result = requests.get(session.host + '/output', params={'return_format': 'metrics'})
+        self.assertNotIn('Server-Timing', result.headers)
+
+    def test_prediction_history(self):
+        session = prog_client.Session('ThrownObject', history_size=3, pred_cfg={'save_freq': 0.1})
+        m = ThrownObject()
+        x = m.initialize()
+        for i in range(1, 6):
+            # Wait for each prediction, so none are skipped
+            for _ in range(20):
+                time.sleep(0.25)
+                if len(session.get_prediction_history()['prediction_time']) >= min(i, 3):
+                    break
+            x = m.next_state(x, {}, 0.1)
+            session.send_data(i/10, **m.output(x))
+
+        time.sleep(1)
+        history = session.get_prediction_history()
+        self.assertEqual(len(history['prediction_time']), 3)  # Limited to history size
+        self.assertListEqual(history['prediction_time'], sorted(history['prediction_time']))
+        self.assertAlmostEqual(history['time_of_event']['impact']['mean'][-1], 7.9, delta=0.3)
+        self.assertLessEqual(history['time_of_event']['impact']['p5'][-1], history['time_of_event']['impact']['p95'][-1])
+        self.assertGreater(history['n_samples'][-1], 0)
+
+        # Time range
+        history = session.get_prediction_history(start=history['prediction_time'][-1])
+        self.assertEqual(len(history['prediction_time']), 1)
+
+    def test_prediction_arrays(self):
+        session = prog_client.Session('ThrownObject', pred_cfg={'save_freq': 1})
+        for _ in range(20):
+            time.sleep(0.25)
+            if session.get_prediction_status()['last prediction'] is not None:
+                break
+
+        arrays = session.get_predicted_arrays()
+        (_, states) = session.get_predicted_state()
+        self.assertListEqual(arrays['times'].tolist(), list(states.times))
+        self.assertListEqual(arrays['keys'].tolist(), list(states[0].data[0].keys()))
+        self.assertEqual(arrays['values'].shape, (len(states), len(states.times), len(arrays['keys'])))
+        self.assertAlmostEqual(arrays['values'][0, 1, 0], states[0].data[1][arrays['keys'][0]])
+
+        arrays = session.get_predicted_arrays('event_state')
+        self.assertListEqual(arrays['keys'].tolist(), list(ThrownObject.events))
+
+        with self.assertRaises(Exception):
+            session.get_predicted_arrays('time_of_event')
+
+    def test_streamed_prediction(self):
+        session = prog_client.Session('ThrownObject', pred_cfg={'save_freq': 1})
+        for _ in range(20):
+            time.sleep(0.25)
+            if session.get_prediction_status()['last prediction'] is not None:
+                break
+
+        (prediction_time, states) = session.get_predicted_state()
+        (streamed_time, streamed) = session.iter_predicted_state()
+        self.assertEqual(streamed_time, prediction_time)
+        streamed = list(streamed)
+        self.assertListEqual([t for (t, _) in streamed], list(states.times))
+        for (i, (_, samples)) in enumerate(streamed):
+            self.assertEqual(len(samples), sum(len(sample) > i for sample in states))
+
+        # JSON formats
+        (_, means) = session.iter_predicted_output(return_format='mean')
+        means = list(means)
+        self.assertEqual(len(means), len(states.times))
+        self.assertIn('x', means[0][1])
+        (_, metrics) = session.iter_predicted_event_state(return_format='metrics')
+        self.assertIn('impact', next(metrics)[1])
+
+        with self.assertRaises(Exception):
+            session.iter_predicted_state(return_format='invalid')
+
+    def test_compression(self):
+        session = prog_client.Session('ThrownObject', pred_cfg={'save_freq': 0.1})
+        for _ in range(20):
+            time.sleep(0.25)
+            if session.get_prediction_status()['last prediction'] is not None:
+                break
+
+        url = session.host + '/prediction/state'
+        plain = requests.get(url, headers={'Accept-Encoding': 'identity'})
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertIn('gzip', plain.headers['Accept-Encoding'])  # Accepted for requests
+        compressed = requests.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(compressed.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(compressed.json(), plain.json())
+
+        # Cached rendering of unchanged results
+        cached = requests.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(cached.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(cached.content, compressed.content)
+
+        # Small responses are not compressed
+        status = requests.get(session.host + '/initialized', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', status.headers)
+
+        # Client negotiates automatically (including pickles and streams)
+        (_, states) = session.get_predicted_state()
+        self.assertEqual(len(states.times), len(plain.json()['states']))
+        (_, streamed) = session.iter_predicted_state()
+        self.assertEqual(len(list(streamed)), len(states.times))
+
+        # Compressed request bodies
+        data = 'time=0.1&x=1.8&' + '&'.join(f'pad{i}=0' for i in range(200))
+        result = requests.post(session.host + '/data', data=gzip.compress(data.encode()), headers={'Content-Type': 'application/x-www-form-urlencoded', 'Content-Encoding': 'gzip'})
+        self.assertEqual(result.status_code, 204)
+        self.assertAlmostEqual(session.get_state()[0], 0.1)
+        result = requests.post(session.host + '/data', data=b'not gzip', headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(result.status_code, 400)
+        result = requests.post(session.host + '/data', data=b'x', headers={'Content-Encoding': 'br'})
+        self.assertEqual(result.status_code, 415)
+
+    def test_backfill(self):
+        session = prog_client.Session('ThrownObject', pred_cfg={'save_freq': 0.1})
+        m = ThrownObject()
+        x = m.initialize()
+        times = [0.1*i for i in range(1, 301)]
+        rows = []
+        for t in times:
+            x = m.next_state(x, {}, 0.1)
+            rows.append(f"{t},{m.output(x)['x']}")
+        data = ('time,x\n' + '\n'.join(rows)).encode()
+
+        # Invalid data
+        result = requests.post(session.host + '/backfill', params={'format': 'xlsx'}, data=data)
+        self.assertEqual(result.status_code, 400)
+        result = requests.post(session.host + '/backfill', data=b'time,y\n0.1,1')
+        self.assertEqual(result.status_code, 400)
+
+        # Data points are rejected during backfill
+        status = session.backfill(data, wait=False)
+        self.assertIn(status['status'], ('queued', 'running', 'complete'))
+        if session.get_backfill_status()['status'] in ('queued', 'running'):
+            with self.assertRaises(Exception):
+                session.send_data(time=31, x=1)
+
+        while status['status'] in ('queued', 'running'):
+            time.sleep(0.1)
+            status = session.get_backfill_status()
+        self.assertEqual(status['status'], 'complete')
+
+        # Columns (sent as npz), waiting for completion
+        status = session.backfill({'time': [t + 30 for t in times], 'x': [float(row.split(',')[1]) for row in rows]}, poll_interval=0.05)
+        times = [t + 30 for t in times]
+        self.assertEqual(status['status'], 'complete')
+        self.assertEqual(status['processed'], len(times))
+        self.assertAlmostEqual(session.get_state()[0], times[-1])
+
+        # One prediction follows the backfill
+        for _ in range(20):
+            time.sleep(0.25)
+            if session.get_prediction_status()['last prediction'] is not None and abs(session.get_predicted_toe()[0] - times[-1]) < 1e-6:
+                break
+        (t_p, _) = session.get_predicted_toe()
+        self.assertAlmostEqual(t_p, times[-1])
+
+    def test_async_ingest(self):
+        session = prog_client.Session('ThrownObject', state_est='UnscentedKalmanFilter', pred_cfg={'save_freq': 0.1}, async_ingest=True)
+        m = ThrownObject()
+        x = m.initialize()
+        for i in range(1, 51):
+            x = m.next_state(x, {}, 0.1)
+            session.send_data(time=0.1*i, x=m.output(x)['x'])
+
+        status = session.get_data_status()
+        self.assertEqual(status['received'], 50)
+        self.assertAlmostEqual(status['received_time'], 5)
+        self.assertEqual(status['pending'], status['received'] - status['estimated'] - status['dropped'])
+        for _ in range(40):
+            if status['pending'] == 0:
+                break
+            time.sleep(0.05)
+            status = session.get_data_status()
+        self.assertEqual(status['estimated'], 50)
+        self.assertEqual(status['lag'], 0)
+        self.assertIsNone(status['error'])
+        self.assertAlmostEqual(session.get_state()[0], 5)
+
+        # Errors estimating queued data are reported in the status. The data point is dropped, not estimated
+        session.send_data(time=1, x=1)  # Earlier than current state
+        for _ in range(40):
+            status = session.get_data_status()
+            if status['pending'] == 0:
+                break
+            time.sleep(0.05)
+        self.assertIsNotNone(status['error'])
+        self.assertEqual(status['estimated'], 50)
+        self.assertEqual(status['dropped'], 1)
+        self.assertAlmostEqual(status['estimated_time'], 5)
+
+        # Synchronous sessions are never behind
+        session = prog_client.Session('ThrownObject', pred_cfg={'save_freq': 0.1})
+        session.send_data(time=0.1, x=1.8)
+        status = session.get_data_status()
+        self.assertEqual(status['pending'], 0)
+        self.assertEqual(status['lag'], 0)
+
+    def test_async_create(self):
+        session = prog_client.Session('ThrownObject', pred_cfg={'save_freq': 0.1}, async_create=True)
+        self.assertIn(requests.get(session.host + '/initialized').json()['status'], ('pending', 'ready'))
+        self.assertTrue(session.wait_until_ready())
+        self.assertEqual(requests.get(session.host).json()['model']['type'], 'ThrownObject')
+        self.assertAlmostEqual(session.get_state()[0], 0)
+
+        # Errors are reported when building
+        session = prog_client.Session('fake model', async_create=True)
+        for _ in range(40):
+            status = requests.get(session.host + '/initialized').json()
+            if status['status'] != 'pending':
+                break
+            time.sleep(0.05)
+        self.assertEqual(status['status'], 'failed')
+        self.assertIn('fake model', status['error'])
+
+        # Once, after which the session no longer exists
+        self.assertEqual(requests.get(session.host + '/initialized').status_code, 400)
+        self.assertEqual(requests.delete(session.host).status_code, 400)
+        session = prog_client.Session('fake model', async_create=True)
+        with self.assertRaisesRegex(Exception, 'fake model'):
+            session.wait_until_ready()
+
+        # Or until deleted
+        session = prog_client.Session('fake model', async_create=True)
+        self.assertEqual(requests.delete(session.host).status_code, 200)
+        self.assertEqual(requests.get(session.host + '/initialized').status_code, 400)
+
+    def test_model_rendering(self):
+        session_a = prog_client.Session('ThrownObject', model_cfg={'g': -10})
+        session_b = prog_client.Session('ThrownObject', model_cfg={'g': -10})
+
+        # Shared (cached) renderings of the same configuration
+        json_a = requests.get(session_a.host + '/model').text
+        self.assertEqual(requests.get(session_b.host + '/model').text, json_a)
+        self.assertEqual(requests.get(session_a.host + '/model').text, json_a)
+        self.assertEqual(requests.get(session_a.host).json()['model']['cfg'], requests.get(session_b.host).json()['model']['cfg'])
+        self.assertEqual(session_a.get_model().parameters['g'], -10)
+        self.assertEqual(session_b.get_model().parameters['g'], -10)
+
+    def test_status(self):
+        session = prog_client.Session('ThrownObject', pred_cfg={'save_freq': 0.1})
+        for _ in range(20):
+            status = session.get_status()
+            if status['version'] > 0 and not status['queued'] and not status['running']:
+                break
+            time.sleep(0.25)
+        self.assertEqual(status['version'], 1)
+        self.assertAlmostEqual(status['prediction_time'], 0)
+        self.assertAlmostEqual(status['state_time'], 0)
+        self.assertIsNone(status['error'])
+        self.assertIsNotNone(status['last_prediction'])
+
+        # Version increases with each prediction
+        session.send_data(time=0.1, x=1.8)
+        self.assertEqual(session.get_status()['state_time'], 0.1)
+        for _ in range(20):
+            status = session.get_status()
+            if status['version'] > 1 and not status['queued'] and not status['running']:
+                break
+            time.sleep(0.25)
+        self.assertEqual(status['version'], 2)
+        self.assertAlmostEqual(status['prediction_time'], 0.1)
+
+    def test_batched_predictions(self):
+        # Sessions with the same model and predictor are predicted together
+        sessions = prog_client.Session.create_many('ThrownObject', n=4, pred_cfg={'save_freq': 0.1})
+        for session in sessions:
+            for _ in range(20):
+                status = session.get_status()
+                if status['version'] > 0 and not status['queued'] and not status['running']:
+                    break
+                time.sleep(0.25)
+            self.assertIsNone(status['error'])
+            (_, toe) = session.get_predicted_toe()
+            self.assertAlmostEqual(toe.mean['impact'], 8.0, delta=0.5)
+            self.assertAlmostEqual(toe.mean['falling'], 4.0, delta=0.5)
+
+        result = requests.get('http://127.0.0.1:8555/api/v1/metrics')
+        self.assertIn('prog_server_prediction_batch_size_count', result.text)
+        prog_client.Session.delete_many(sessions)
+
     def test_error_in_init(self):
         # Invalid model name
         with self.assertRaises(Exception):
@@ -0,0 +1,176 @@
+# Copyright © 2021 United States Government as represented by the Administrator of the National Aeronautics and Space Administration. All Rights Reserved.
+
+import numpy as np
+import sys
+from threading import Thread
+from types import SimpleNamespace
+import unittest
+from prog_server.models import load_ests
+from prog_server.models.load_ests import build_load_est, MovingAverageBuffer, PiecewiseLoad, Variable
+
+
+class LoadEstTest(unittest.TestCase):
+    def test_variable_step(self):
+        cfg = {'0': {'u1': 0.1}, '100': {'u1': 0.2}, '300': {'u1': 0.3}, '500': {'u1': 0.0}}
+        profile = PiecewiseLoad(cfg)
+
+        # Same behavior as uncompiled configuration
+        for t in [0, 50, 100, 100.1, 299, 300, 301, 500, 1000]:
+            self.assertDictEqual(Variable(t, cfg=profile), Variable(t, cfg=cfg))
+
+        self.assertEqual(profile(0)['u1'], 0.1)
+        self.assertEqual(profile(100)['u1'], 0.1)  # Segment starts after starting time
+        self.assertEqual(profile(100.1)['u1'], 0.2)
+        self.assertEqual(profile(1000)['u1'], 0.0)
+
+        # Vectorized
+        loads = profile.at([0, 100, 100.1, 301, 1000])
+        self.assertListEqual(loads[:, 0].tolist(), [0.1, 0.1, 0.2, 0.3, 0.0])
+
+    def test_variable_unordered(self):
+        profile = PiecewiseLoad({'100': {'u1': 0.2}, '0': {'u1': 0.1}})
+        self.assertEqual(profile(50)['u1'], 0.1)
+        self.assertEqual(profile(150)['u1'], 0.2)
+
+    def test_variable_linear(self):
+        profile = PiecewiseLoad({'0': {'u1': 0, 'u2': 1}, '100': {'u1': 1, 'u2': 1}, 'interpolation': 'linear'})
+        self.assertAlmostEqual(profile(50)['u1'], 0.5)
+        self.assertAlmostEqual(profile(50)['u2'], 1)
+        self.assertEqual(profile(200)['u1'], 1)
+        self.assertEqual(profile(-1)['u1'], 0)
+
+        loads = profile.at(np.array([0, 25, 100, 200]))
+        np.testing.assert_allclose(loads[:, 0], [0, 0.25, 1, 1])
+        np.testing.assert_allclose(loads[:, 1], [1, 1, 1, 1])
+
+    def test_variable_invalid(self):
+        with self.assertRaises(ValueError):
+            PiecewiseLoad({'0': {'u1': 0}, 'interpolation': 'cubic'})
+        with self.assertRaises(ValueError):
+            PiecewiseLoad({})
+
+    def test_moving_average_count(self):
+        buffer = MovingAverageBuffer(['u1', 'u2'], window_size=3)
+        self.assertIsNone(buffer.mean)
+        with self.assertRaises(ValueError):
+            buffer.variance()
+
+        data = [1, 2, 3, 4, 5, 6, 7]
+        for (i, u) in enumerate(data):
+            buffer.append({'u1': u, 'u2': -u}, i)
+            window = data[max(0, i-2):i+1]
+            self.assertAlmostEqual(buffer.mean['u1'], np.mean(window))
+            self.assertAlmostEqual(buffer.mean['u2'], -np.mean(window))
+            self.assertAlmostEqual(buffer.variance()['u1'], np.var(window))
+        self.assertEqual(len(buffer), 3)
+
+        # Shrink window - keeps latest
+        buffer.configure(window_size=2)
+        self.assertEqual(len(buffer), 2)
+        self.assertAlmostEqual(buffer.mean['u1'], 6.5)
+
+    def test_moving_average_time(self):
+        buffer = MovingAverageBuffer(['u1'], window_time=10)
+        for t in range(100):
+            buffer.append({'u1': t}, t)
+            # Samples within 10s of t (i.e., t-10 to t)
+            window = range(max(0, t-10), t+1)
+            self.assertAlmostEqual(buffer.mean['u1'], np.mean(window))
+        self.assertEqual(len(buffer), 11)
+
+        # Switch to count-based window
+        buffer.configure(window_size=4)
+        self.assertAlmostEqual(buffer.mean['u1'], np.mean([96, 97, 98, 99]))
+
+    def test_moving_average_concurrent(self):
+        # Data sent concurrently for the same session (e.g., parallel send_data requests) is neither lost nor duplicated
+        session = SimpleNamespace(moving_avg_loads=MovingAverageBuffer(['u1']))
+        cfg = {'window_time': 1e6}  # Window grows to hold every sample
+        def send(thread):
+            for i in range(250):
+                load_ests.update_moving_avg({'u1': thread}, session, cfg, i)
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [Thread(target=send, args=(thread,)) for thread in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+        self.assertEqual(len(session.moving_avg_loads), 1000)
+        self.assertAlmostEqual(session.moving_avg_loads.mean['u1'], 1.5)
+
+    def test_batch(self):
+        session = SimpleNamespace(
+            model=SimpleNamespace(inputs=['u1', 'u2']),
+            moving_avg_loads=MovingAverageBuffer(['u1', 'u2']))
+        x = np.zeros((3, 5))  # 3 states, 5 samples
+
+        const = build_load_est('Const', {'load': {'u1': 1, 'u2': 2}}, session)
+        np.testing.assert_array_equal(const.batch(0, x), [[1]*5, [2]*5])
+
+        variable = build_load_est('Variable', {'0': {'u1': 1, 'u2': 2}, '10': {'u1': 3, 'u2': 4}}, session)
+        np.testing.assert_array_equal(variable.batch(20, x), [[3]*5, [4]*5])
+        self.assertDictEqual(variable(20), {'u1': 3, 'u2': 4})
+
+        session.moving_avg_loads.append({'u1': 1, 'u2': 3})
+        session.moving_avg_loads.append({'u1': 3, 'u2': 5})
+        moving_avg = build_load_est('MovingAverage', {}, session)
+        np.testing.assert_array_equal(moving_avg.batch(0, x), [[2]*5, [4]*5])
+        moving_avg = build_load_est('MovingAverage', {'base_std': 1}, session)
+        self.assertEqual(moving_avg.batch(0, x).shape, (2, 5))
+
+    def test_registry(self):
+        def custom(t, x=None, session=None, cfg=None):
+            return {'u1': t * cfg['slope']}
+
+        load_ests.extra_load_estimators['custom'] = custom
+        try:
+            load_est = build_load_est('custom', {'slope': 2}, None)
+            self.assertDictEqual(load_est(3), {'u1': 6})
+            self.assertFalse(hasattr(load_est, 'batch'))
+        finally:
+            del load_ests.extra_load_estimators['custom']
+
+    def test_moving_average_noise(self):
+        session = SimpleNamespace(
+            model=SimpleNamespace(inputs=['u1']),
+            moving_avg_loads=MovingAverageBuffer(['u1']))
+        session.moving_avg_loads.append({'u1': 1})
+
+        # Seeded - same noise for each prediction
+        load_est = build_load_est('MovingAverage', {'base_std': 0.5, 'seed': 42}, session)
+        first = [load_est(t)['u1'] for t in range(100)]
+        load_est.reset()
+        second = [load_est(t)['u1'] for t in range(100)]
+        self.assertListEqual(first, second)
+        self.assertEqual(len(set(first)), 100)
+
+        # Same statistical behavior (mean 1, std 0.5)
+        load_est = build_load_est('MovingAverage', {'base_std': 0.5}, session)
+        loads = [load_est(t)['u1'] for t in range(20000)]
+        self.assertAlmostEqual(np.mean(loads), 1, delta=0.02)
+        self.assertAlmostEqual(np.std(loads), 0.5, delta=0.02)
+
+        # Unseeded - reset does not repeat noise
+        first = [load_est(t)['u1'] for t in range(100)]
+        load_est.reset()
+        second = [load_est(t)['u1'] for t in range(100)]
+        self.assertNotEqual(first, second)
+
+
+# This allows the module to be executed directly
+def run_tests():
+    l = unittest.TestLoader()
+    runner = unittest.TextTestRunner()
+    print("\n\nTesting load estimators")
+    result = runner.run(l.loadTestsFromTestCase(LoadEstTest)).wasSuccessful()
+
+    if not result:
+        raise Exception("Failed test")
+
+if __name__ == '__main__':
+    run_tests()
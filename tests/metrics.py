@@ -0,0 +1,49 @@
+# Copyright © 2021 United States Government as represented by the Administrator of the National Aeronautics and Space Administration. All Rights Reserved.
+
+import threading
+import unittest
+from prog_server.models import metrics
+
+
+class MetricsTest(unittest.TestCase):
+    def test_concurrent_updates(self):
+        counter = metrics.Counter('test_total', 'Test counter', ('outcome',))
+        gauge = metrics.Gauge('test_active', 'Test gauge')
+        histogram = metrics.Histogram('test_seconds', 'Test histogram')
+
+        def update():
+            for _ in range(20000):
+                counter.inc('ok')
+                gauge.inc()
+                histogram.observe(0.01)
+                gauge.dec()
+        threads = [threading.Thread(target=update) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # No updates lost
+        self.assertEqual(counter._values[('ok',)], 160000)
+        self.assertEqual(gauge.value, 0)
+        registry = metrics.Registry()
+        for metric in (counter, gauge, histogram):
+            registry.add(metric)
+        text = registry.render()
+        self.assertIn('test_total{outcome="ok"} 160000.0', text)
+        self.assertIn('test_active 0.0', text)
+        self.assertIn('test_seconds_count 160000.0', text)
+
+
+# This allows the module to be executed directly
+def run_tests():
+    l = unittest.TestLoader()
+    runner = unittest.TextTestRunner()
+    print("\n\nTesting metrics")
+    result = runner.run(l.loadTestsFromTestCase(MetricsTest)).wasSuccessful()
+
+    if not result:
+        raise Exception("Failed test")
+
+if __name__ == '__main__':
+    run_tests()
@@ -0,0 +1,81 @@
+# Copyright © 2021 United States Government as represented by the Administrator of the National Aeronautics and Space Administration. All Rights Reserved.
+
+from flask import Flask
+import gc
+import unittest
+from prog_server.models import model_cache
+from prog_server.models.model_cache import config_key, intern, rendering
+from prog_server.models.prediction_handler import predict
+from prog_server.models.session import Session
+from progpy.models import ThrownObject
+
+
+class ModelCacheTest(unittest.TestCase):
+    def test_intern(self):
+        key = config_key('model', 'ThrownObject', {})
+        a = intern(key, ThrownObject)
+        self.assertIs(intern(key, ThrownObject), a)
+        self.assertIsNot(intern(config_key('model', 'ThrownObject', {'g': -10}), lambda: ThrownObject(g=-10)), a)
+        self.assertIsNot(intern(None, ThrownObject), a)  # Not hashable config
+
+    def test_rendering(self):
+        key = config_key('model', 'ThrownObject', {})
+        m = intern(key, ThrownObject)
+        calls = []
+        def render():
+            calls.append(None)
+            return m.to_json()
+
+        json = rendering(key, m, 'json', render)
+        self.assertEqual(json, m.to_json())
+        self.assertIs(rendering(key, m, 'json', render), json)
+        self.assertEqual(len(calls), 1)
+        self.assertIs(type(m.parameters), type(ThrownObject().parameters))  # Model is not modified
+
+        # Objects that are not shared may change, so are not cached
+        n = ThrownObject()
+        rendering(None, n, 'json', n.to_json)
+        n.parameters['g'] = -10
+        self.assertEqual(rendering(None, n, 'json', n.to_json), n.to_json())
+
+        # Removed with object
+        n_renderings = len(model_cache._renderings)
+        del m, render
+        gc.collect()
+        self.assertEqual(len(model_cache._renderings), n_renderings - 1)
+
+    def test_session_sharing(self):
+        with Flask('test').app_context():
+            a = Session(0, 'ThrownObject', model_cfg={'process_noise': 1}, pred_cfg={'n_samples': 5}, predict_queue=False)
+            b = Session(1, 'ThrownObject', model_cfg={'process_noise': 1}, pred_cfg={'n_samples': 5}, predict_queue=False)
+            self.assertIs(a.model, b.model)
+            self.assertIs(a.pred, b.pred)
+
+            # Predictor that changes its model's parameters does not share the model
+            c = Session(2, 'ThrownObject', model_cfg={'process_noise': 1}, pred_cfg={'n_samples': 5, 'constant_noise': True}, predict_queue=False)
+            self.assertIsNot(c.model, a.model)
+            self.assertIs(c.pred.model, c.model)
+
+            parameters = a.model.parameters.to_json()
+            predict(c)
+            self.assertNotEqual(c.model.parameters.to_json(), parameters)  # MonteCarlo sets process_noise_dist
+            self.assertEqual(a.model.parameters.to_json(), parameters)
+            predict(a)
+            self.assertEqual(b.model.parameters.to_json(), parameters)
+
+            # Sessions keep their own copy of the model configuration
+            self.assertIsNot(a.model_cfg, b.model_cfg)
+
+
+# This allows the module to be executed directly
+def run_tests():
+    l = unittest.TestLoader()
+    runner = unittest.TextTestRunner()
+    print("\n\nTesting model cache")
+    result = runner.run(l.loadTestsFromTestCase(ModelCacheTest)).wasSuccessful()
+
+    if not result:
+        raise Exception("Failed test")
+
+if __name__ == '__main__':
+    run_tests()
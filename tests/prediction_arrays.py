@@ -0,0 +1,138 @@
+# Copyright © 2021 United States Government as represented by the Administrator of the National Aeronautics and Space Administration. All Rights Reserved.
+
+import io
+import numpy as np
+import os
+import tempfile
+import unittest
+import warnings
+from prog_server.models.prediction_arrays import LazyArrays, PredictionArrays, PredictionView, resolve
+from progpy.predictors import UnweightedSamplesPrediction
+from progpy.sim_result import LazySimResult, SimResult
+
+
+def _prediction():
+    # Three samples, one of which ends (e.g., reaches event) after 2 of 3 times
+    times = [0, 1, 2]
+    samples = [
+        SimResult(times, [{'a': 1, 'b': 10}, {'a': 2, 'b': 20}, {'a': 3, 'b': 30}]),
+        SimResult(times, [{'a': 3, 'b': 12}, {'a': 4, 'b': 24}, {'a': 5, 'b': 36}]),
+        SimResult(times[:2], [{'a': 5, 'b': 14}, {'a': 6, 'b': 28}])]
+    return UnweightedSamplesPrediction(times, samples)
+
+
+class PredictionArraysTest(unittest.TestCase):
+    def test_conversion(self):
+        arrays = PredictionArrays.from_prediction(_prediction())
+        self.assertEqual(arrays.values.shape, (3, 3, 2))
+        self.assertListEqual(arrays.keys, ['a', 'b'])
+        self.assertListEqual(arrays.lengths.tolist(), [3, 3, 2])
+        self.assertTrue(np.isnan(arrays.values[2, 2, 0]))
+
+        # Round trip
+        prediction = arrays.to_prediction()
+        self.assertListEqual(prediction.times, [0, 1, 2])
+        self.assertEqual(len(prediction[2]), 2)
+        self.assertEqual(prediction[1].data[2]['b'], 36)
+
+    def test_slice(self):
+        arrays = PredictionArrays.from_prediction(_prediction())
+        block = arrays.slice(1, 5)
+        self.assertListEqual(block.times, [1, 2])
+        self.assertListEqual(block.lengths.tolist(), [2, 2, 1])
+        self.assertListEqual(block.means(), arrays.means()[1:])
+        self.assertEqual(block.metrics(), arrays.metrics()[1:])
+
+    def test_matches_snapshot(self):
+        # Random prediction, where samples end at different times
+        rng = np.random.default_rng(0)
+        times = list(range(10))
+        samples = []
+        for length in rng.integers(1, 11, 20):
+            samples.append(SimResult(times[:length], [{'a': a, 'b': b} for (a, b) in rng.normal(size=(length, 2))]))
+
+        for prediction in (_prediction(), UnweightedSamplesPrediction(times, samples)):
+            arrays = PredictionArrays.from_prediction(prediction)
+            means = arrays.means()
+            metrics = arrays.metrics()
+            mvn = arrays.mvn()
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                for i in range(len(prediction.times)):
+                    snapshot = prediction.snapshot(i)
+                    expected = snapshot.metrics()
+                    for key in ('a', 'b'):
+                        self.assertAlmostEqual(means[i][key], snapshot.mean[key])
+                        self.assertSetEqual(set(metrics[i][key].keys()), set(expected[key].keys()))
+                        for stat in ('min', 'max', 'mean', 'median', 'std', 'median absolute deviation', 'mean absolute deviation', 'number of samples'):
+                            self.assertAlmostEqual(metrics[i][key][stat], expected[key][stat])
+                        for (name, value) in expected[key]['percentiles'].items():
+                            if value is None:
+                                self.assertIsNone(metrics[i][key]['percentiles'][name])
+                            else:
+                                self.assertAlmostEqual(metrics[i][key]['percentiles'][name], value)
+                    np.testing.assert_allclose(mvn[i]['cov'], snapshot.cov)
+
+                    # Snapshot only includes samples that had not ended
+                    self.assertEqual(len(arrays.snapshot(i)), sum(sample is not None for sample in snapshot))
+
+    def test_spill(self):
+        arrays = PredictionArrays.from_prediction(_prediction())
+        expected = arrays.metrics()
+        with tempfile.TemporaryDirectory() as directory:
+            arrays.spill(directory)
+            self.assertTrue(os.path.exists(arrays.path))
+            self.assertIsInstance(arrays.values, np.memmap)
+            self.assertEqual(arrays.metrics(), expected)
+
+            # Streamed from file
+            with np.load(io.BytesIO(b''.join(arrays.iter_npz(prediction_time=0)))) as npz:
+                self.assertEqual(npz['prediction_time'], 0)
+                self.assertListEqual(npz['keys'].tolist(), ['a', 'b'])
+                np.testing.assert_array_equal(npz['values'], arrays.values)
+
+            # File removed with arrays
+            path = arrays.path
+            del arrays
+            self.assertFalse(os.path.exists(path))
+
+    def test_lazy(self):
+        # As progpy computes outputs from states: only when the data is used
+        calls = []
+        def output(x):
+            calls.append(x)
+            return {'z': 2*x['a']}
+        states = _prediction()
+        outputs = UnweightedSamplesPrediction(states.times, [LazySimResult(output, sample.times, sample.data) for sample in states])
+
+        lazy = LazyArrays(outputs)
+        self.assertEqual(len(calls), 0)
+        arrays = resolve(lazy)
+        self.assertEqual(len(calls), 8)
+        self.assertListEqual(arrays.keys, ['z'])
+        self.assertEqual(arrays.values[1, 2, 0], 10)
+
+        # Converted once
+        self.assertIs(resolve(lazy), arrays)
+        self.assertEqual(len(calls), 8)
+        self.assertIs(resolve(arrays), arrays)
+
+    def test_not_samples(self):
+        # Empty (or non-sample) predictions are wrapped, not converted
+        view = PredictionArrays.from_prediction(UnweightedSamplesPrediction([], []))
+        self.assertIsInstance(view, PredictionView)
+        self.assertListEqual(view.means(), [])
+
+
+# This allows the module to be executed directly
+def run_tests():
+    l = unittest.TestLoader()
+    runner = unittest.TextTestRunner()
+    print("\n\nTesting prediction arrays")
+    result = runner.run(l.loadTestsFromTestCase(PredictionArraysTest)).wasSuccessful()
+
+    if not result:
+        raise Exception("Failed test")
+
+if __name__ == '__main__':
+    run_tests()
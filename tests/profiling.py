@@ -0,0 +1,36 @@
+# Copyright © 2021 United States Government as represented by the Administrator of the National Aeronautics and Space Administration. All Rights Reserved.
+
+import unittest
+from prog_server.app import app
+from prog_server.models import profiling
+
+
+class ProfilingTest(unittest.TestCase):
+    def test_request_failed(self):
+        # after_request hooks are skipped when a view raises, so profiling is stopped on teardown
+        with app.test_request_context('/api/v1', headers={'X-Profile': '1'}):
+            app.preprocess_request()
+            self.assertIsNotNone(profiling.current())
+            app.do_teardown_request(RuntimeError('view failed'))
+        self.assertIsNone(profiling.current())
+
+        # Next request on the thread is not profiled
+        response = app.test_client().get('/api/v1')
+        self.assertNotIn('Server-Timing', response.headers)
+        response = app.test_client().get('/api/v1', headers={'X-Profile': '1'})
+        self.assertIn('total;dur=', response.headers['Server-Timing'])
+        self.assertIsNone(profiling.current())
+
+
+# This allows the module to be executed directly
+def run_tests():
+    l = unittest.TestLoader()
+    runner = unittest.TextTestRunner()
+    print("\n\nTesting profiling")
+    result = runner.run(l.loadTestsFromTestCase(ProfilingTest)).wasSuccessful()
+
+    if not result:
+        raise Exception("Failed test")
+
+if __name__ == '__main__':
+    run_tests()